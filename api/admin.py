@@ -1,3 +1,242 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from django.utils.functional import cached_property
 
-# Register your models here.
+from .analytics import schedule_rollups
+from .cache import invalidate_products
+from .models import Cart, CartItem, CustomUser, Order, OrderItem, Payment, Product, Review
+from .reservations import forget_counters
+from .search import get_search_backend
+
+
+#Admin for tables with millions of rows. Every changelist page is a fixed number of queries:
+#- list_select_related covers everything the columns (and the models' __str__) touch
+#- foreign keys are autocomplete widgets instead of <select>s listing every row
+#- no full result count next to the filtered one, and on Postgres the unfiltered count is
+#  the planner's estimate instead of a COUNT(*) over the whole table
+#- default orderings follow an index, list filters only use fields with choices (no DISTINCT scans)
+#- inlines select their related rows, and product/order references in them are read only
+#  (an autocomplete widget per inline row would query once per row)
+#- bulk actions are single UPDATEs
+
+#Below this many rows (by the estimate) an exact COUNT(*) is cheap enough
+ESTIMATE_COUNT_ABOVE = 100000
+
+
+class LargeTablePaginator(Paginator):
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_row_count(queryset.model, queryset.db)
+            if estimate is not None and estimate > ESTIMATE_COUNT_ABOVE:
+                return estimate
+        return super().count
+
+
+def estimated_row_count(model, using):
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [model._meta.db_table])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = LargeTablePaginator
+    show_full_result_count = False
+    list_per_page = 50
+
+    #Autocomplete results and change pages show __str__ too, not only the changelist
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if self.list_select_related and not isinstance(self.list_select_related, bool):
+            queryset = queryset.select_related(*self.list_select_related)
+        return queryset
+
+
+class ReadOnlyInline(admin.TabularInline):
+    extra = 0
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+#Needed by the autocomplete widgets that point at users
+@admin.register(CustomUser)
+class CustomUserAdmin(LargeTableAdmin):
+    list_display = ['username', 'email', 'role', 'is_seller', 'is_staff', 'date_joined']
+    list_filter = ['role', 'is_staff', 'is_active']
+    search_fields = ['username', 'email']
+    #The hash isn't editable here; passwords are set with manage.py changepassword
+    exclude = ['password']
+    readonly_fields = ['last_login', 'date_joined']
+    filter_horizontal = ['groups', 'user_permissions']
+
+
+class StockActionForm(ActionForm):
+    stock = forms.IntegerField(required=False, help_text='Units for the stock actions.')
+
+
+def stock_from_form(modeladmin, request):
+    try:
+        stock = StockActionForm.base_fields['stock'].clean(request.POST.get('stock'))
+    except ValidationError:
+        stock = None
+    if stock is None:
+        modeladmin.message_user(request, 'Enter a number of units for the stock action.', messages.ERROR)
+    return stock
+
+
+#One SELECT for the cache keys and one UPDATE. Queryset updates skip the Product signals,
+#so the catalog cache and the reservation counters are dropped here, like checkout does.
+def update_stock(queryset, stock):
+    with transaction.atomic():
+        products = [Product(pk=pk, category=category) for pk, category in queryset.values_list('pk', 'category')]
+        updated = queryset.update(stock=stock, updated_at=timezone.now())
+        transaction.on_commit(lambda: invalidate_products(products))
+        transaction.on_commit(lambda: forget_counters([product.pk for product in products]))
+    return updated
+
+
+@admin.register(Product)
+class ProductAdmin(LargeTableAdmin):
+    list_display = ['name', 'category', 'price', 'stock', 'seller', 'review_count', 'updated_at']
+    list_select_related = ['seller']
+    list_filter = ['category']
+    search_fields = ['name']
+    autocomplete_fields = ['seller']
+    readonly_fields = ['review_count', 'last_reviewed_at', 'updated_at']
+    action_form = StockActionForm
+    actions = ['set_stock', 'add_stock']
+
+    #Full text search through the catalog's search index rather than LIKE '%term%' over every row
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term.strip():
+            return queryset, False
+        return queryset.filter(pk__in=get_search_backend().matching(search_term).values('pk')), False
+
+    @admin.action(description='Set stock of selected products to the given units')
+    def set_stock(self, request, queryset):
+        stock = stock_from_form(self, request)
+        if stock is not None:
+            updated = update_stock(queryset, max(stock, 0))
+            self.message_user(request, f'Set the stock of {updated} products to {max(stock, 0)}.', messages.SUCCESS)
+
+    @admin.action(description='Add the given units (negative to remove) to selected products')
+    def add_stock(self, request, queryset):
+        stock = stock_from_form(self, request)
+        if stock is not None:
+            updated = update_stock(queryset, Greatest(F('stock') + stock, Value(0)))
+            self.message_user(request, f'Changed the stock of {updated} products by {stock}.', messages.SUCCESS)
+
+
+class OrderItemInline(admin.TabularInline):
+    model = OrderItem
+    extra = 0
+    fields = ['product', 'price', 'quantity', 'item_subtotal']
+    readonly_fields = ['product', 'item_subtotal']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product')
+
+    #Orders get their items at checkout
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class PaymentInline(ReadOnlyInline):
+    model = Payment
+    fields = ['transaction_id', 'amount', 'status', 'gateway', 'gateway_updated_at']
+
+
+def order_status_action(status):
+    def action(modeladmin, request, queryset):
+        updated = queryset.update(status=status, updated_at=timezone.now())
+        schedule_rollups()
+        modeladmin.message_user(request, f'Marked {updated} orders as {status}.', messages.SUCCESS)
+
+    action.__name__ = f'mark_{status.lower()}'
+    return admin.action(description=f'Mark selected orders as {status}')(action)
+
+
+@admin.register(Order)
+class OrderAdmin(LargeTableAdmin):
+    list_display = ['order_id', 'user', 'status', 'total', 'created_at']
+    list_select_related = ['user']
+    list_filter = ['status']
+    search_fields = ['=user__email', '=user__username']
+    autocomplete_fields = ['user']
+    readonly_fields = ['total', 'created_at', 'updated_at']
+    #Served by order_created_idx, and by order_status_created_idx when filtered by status
+    ordering = ['-created_at', '-order_id']
+    inlines = [OrderItemInline, PaymentInline]
+    actions = [order_status_action(status) for status in Order.Status.values]
+
+
+@admin.register(OrderItem)
+class OrderItemAdmin(LargeTableAdmin):
+    list_display = ['__str__', 'order', 'price', 'quantity']
+    list_select_related = ['product', 'order__user']
+    search_fields = ['=order__order_id']
+    autocomplete_fields = ['order', 'product']
+
+
+class CartItemInline(admin.TabularInline):
+    model = CartItem
+    extra = 0
+    fields = ['product', 'quantity']
+    readonly_fields = ['product']
+
+    #Each row's label (CartItem.__str__) names the product and the cart's owner
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product', 'cart__user')
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(Cart)
+class CartAdmin(LargeTableAdmin):
+    list_display = ['__str__', 'user', 'session_key', 'updated_at']
+    list_select_related = ['user']
+    search_fields = ['=user__email', '=session_key']
+    autocomplete_fields = ['user']
+    readonly_fields = ['session_key', 'updated_at']
+    inlines = [CartItemInline]
+
+
+@admin.register(Payment)
+class PaymentAdmin(LargeTableAdmin):
+    list_display = ['transaction_id', 'user', 'order', 'amount', 'status', 'gateway', 'created_at']
+    list_select_related = ['user', 'order__user']
+    list_filter = ['status']
+    search_fields = ['=transaction_id', '=user__email']
+    autocomplete_fields = ['user', 'order']
+    #Gateway state comes from webhooks and reconcile_payments (see payments.py)
+    readonly_fields = ['transaction_id', 'status', 'gateway', 'gateway_updated_at', 'created_at', 'updated_at']
+
+
+@admin.register(Review)
+class ReviewAdmin(LargeTableAdmin):
+    list_display = ['__str__', 'product', 'user', 'created']
+    list_select_related = ['product', 'user']
+    search_fields = ['=user__username']
+    autocomplete_fields = ['product', 'user']
+    #The primary key is the order reviews were written in
+    ordering = ['-id']
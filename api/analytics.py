@@ -0,0 +1,237 @@
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Count, DecimalField, F, Sum
+from django.db.models.functions import TruncDate, TruncMonth
+from django.utils import timezone
+
+from .jobs import enqueue, job
+from .models import ROLLUP_PENDING, Order, OrderItem, SalesRollup
+from .sqlite import retry_if_locked, write_transaction
+
+
+#Sales analytics over SalesRollup (day x category x seller x order status) instead of the
+#order tables. The rollups are kept up to date in two ways:
+#- incrementally: an order whose status differs from Order.rolled_up_status is "pending"
+#  (see ROLLUP_PENDING and its partial index). update_rollups() takes a batch of pending orders,
+#  aggregates their lines in one query, subtracts them from the buckets of the status they were
+#  counted under and adds them to the current one, then marks them counted. Reruns find nothing
+#  pending, so the update_sales_rollups job can safely run more than once.
+#- rebuild_sales_rollups recomputes whole ranges of days, a chunk of days per transaction, with
+#  one GROUP BY over the chunk's order lines (the database aggregates the whole chunk at once).
+#- an order whose lines are about to change (an OrderItem saved or deleted) is taken out of its
+#  buckets and made pending again, then queued to be counted with its new lines (recount_orders).
+
+DEFAULTS = {
+    'BATCH_SIZE': 1000,
+    'CHUNK_DAYS': 31,
+}
+
+#What reports can be grouped by: SalesRollup fields, or an expression over them
+DIMENSIONS = {
+    'day': None,
+    'month': TruncMonth('day'),
+    'category': None,
+    'seller': None,
+    'status': None,
+}
+
+MONEY = DecimalField(max_digits=14, decimal_places=2)
+
+
+def get_setting(name):
+    return getattr(settings, 'SALES_ROLLUPS', {}).get(name, DEFAULTS[name])
+
+
+#Units and revenue per (order, category, seller), one query for any number of orders
+def order_lines(order_ids):
+    return (
+        OrderItem.objects.filter(order_id__in=order_ids)
+        .values('order_id', category=F('product__category'), seller=F('product__seller'))
+        .annotate(units=Sum('quantity'), revenue=Sum(F('quantity') * F('price'), output_field=MONEY))
+        .order_by()
+    )
+
+
+def rollup_deltas(orders, lines):
+    deltas = defaultdict(lambda: [0, 0, Decimal('0')])
+    for line in lines:
+        status, counted_status, created_at = orders[line['order_id']]
+        day = timezone.localdate(created_at)
+        for bucket_status, sign in ((counted_status, -1), (status, 1)):
+            if bucket_status is None:
+                continue
+            delta = deltas[(day, line['category'], line['seller'], bucket_status)]
+            delta[0] += sign
+            delta[1] += sign * line['units']
+            delta[2] += sign * line['revenue']
+    return {key: delta for key, delta in deltas.items() if any(delta)}
+
+
+#Read the touched buckets, then one UPDATE, one INSERT and one DELETE (buckets that emptied).
+#Runs in the caller's write transaction, which serializes it with other rollup writers.
+def apply_deltas(deltas):
+    if not deltas:
+        return
+    existing = {
+        (row.day, row.category, row.seller_id, row.status): row
+        for row in SalesRollup.objects.select_for_update().filter(
+            day__in={key[0] for key in deltas},
+            category__in={key[1] for key in deltas},
+            status__in={key[3] for key in deltas},
+        )
+        if (row.day, row.category, row.seller_id, row.status) in deltas
+    }
+    changed, created, emptied = [], [], []
+    for key, (orders, units, revenue) in deltas.items():
+        row = existing.get(key) or SalesRollup(day=key[0], category=key[1], seller_id=key[2], status=key[3])
+        row.order_count += orders
+        row.units += units
+        row.revenue += revenue
+        if row.pk is None:
+            created.append(row)
+        elif row.order_count <= 0:
+            emptied.append(row.pk)
+        else:
+            changed.append(row)
+    if changed:
+        SalesRollup.objects.bulk_update(changed, ['order_count', 'units', 'revenue'])
+    if created:
+        SalesRollup.objects.bulk_create(created)
+    if emptied:
+        SalesRollup.objects.filter(pk__in=emptied).delete()
+
+
+#Count a batch of pending orders (those in order_ids, or the oldest ones) under their current status.
+#Returns how many orders were counted.
+@retry_if_locked
+def update_rollups(order_ids=None, limit=None):
+    with write_transaction():
+        pending = Order.objects.select_for_update().filter(ROLLUP_PENDING)
+        if order_ids is not None:
+            pending = pending.filter(pk__in=order_ids)
+        orders = {
+            pk: (status, counted_status, created_at)
+            for pk, status, counted_status, created_at in pending.order_by('created_at').values_list(
+                'pk', 'status', 'rolled_up_status', 'created_at'
+            )[:limit or get_setting('BATCH_SIZE')]
+        }
+        if not orders:
+            return 0
+        apply_deltas(rollup_deltas(orders, order_lines(list(orders))))
+        Order.objects.filter(pk__in=list(orders)).update(rolled_up_status=F('status'))
+    return len(orders)
+
+
+#Queued after checkout with the new order, and without ids after status updates that don't
+#know which orders they changed; then it works through every pending order a batch at a time.
+@job('update_sales_rollups')
+def update_sales_rollups(order_ids=None):
+    if order_ids is not None:
+        update_rollups(order_ids)
+        return
+    while update_rollups() == get_setting('BATCH_SIZE'):
+        pass
+
+
+def enqueue_rollup_update(order_ids):
+    enqueue('update_sales_rollups', {'order_ids': [str(pk) for pk in order_ids]})
+
+
+#For status updates that don't know which orders they changed
+def schedule_rollups():
+    enqueue('update_sales_rollups')
+
+
+#Take orders out of the buckets they are counted in and mark them not counted, with one query
+#for the orders and one for their lines. The counted status is read from the database, not from
+#instances, so an order is never taken out twice. Returns the ids of the orders that were counted.
+def uncount_orders(order_ids):
+    with write_transaction():
+        counted = {
+            pk: (None, counted_status, created_at)
+            for pk, counted_status, created_at in Order.objects.select_for_update()
+            .filter(pk__in=order_ids, rolled_up_status__isnull=False)
+            .values_list('pk', 'rolled_up_status', 'created_at')
+        }
+        if counted:
+            apply_deltas(rollup_deltas(counted, order_lines(list(counted))))
+            Order.objects.filter(pk__in=list(counted)).update(rolled_up_status=None)
+    return list(counted)
+
+
+#The lines of these orders are about to change: uncount them now, count them again once changed
+def recount_orders(order_ids):
+    counted = uncount_orders(order_ids)
+    if counted:
+        enqueue_rollup_update(counted)
+
+
+def day_bounds(day):
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    return start, timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min))
+
+
+#Recompute the rollups of the days first..last (inclusive) from the order tables
+@retry_if_locked
+def rebuild_days(first, last):
+    start, _ = day_bounds(first)
+    _, end = day_bounds(last)
+    with write_transaction():
+        rows = (
+            OrderItem.objects.filter(order__created_at__gte=start, order__created_at__lt=end)
+            .values(
+                day=TruncDate('order__created_at'), category=F('product__category'),
+                seller=F('product__seller'), status=F('order__status'),
+            )
+            .annotate(
+                order_count=Count('order', distinct=True), units=Sum('quantity'),
+                revenue=Sum(F('quantity') * F('price'), output_field=MONEY),
+            )
+            .order_by()
+        )
+        rollups = [
+            SalesRollup(
+                day=row['day'], category=row['category'], seller_id=row['seller'], status=row['status'],
+                order_count=row['order_count'], units=row['units'], revenue=row['revenue'],
+            )
+            for row in rows
+        ]
+        SalesRollup.objects.filter(day__gte=first, day__lte=last).delete()
+        SalesRollup.objects.bulk_create(rollups, batch_size=get_setting('BATCH_SIZE'))
+        Order.objects.filter(created_at__gte=start, created_at__lt=end).update(rolled_up_status=F('status'))
+    return len(rollups)
+
+
+def order_date_range():
+    first = Order.objects.order_by('created_at').values_list('created_at', flat=True).first()
+    last = Order.objects.order_by('-created_at').values_list('created_at', flat=True).first()
+    if first is None:
+        return None, None
+    return timezone.localdate(first), timezone.localdate(last)
+
+
+#Totals over the rollups grouped by any of DIMENSIONS, e.g.
+#sales_report(date(2026, 1, 1), date(2026, 12, 31), ['month', 'category'], statuses=['Paid', 'Shipped'])
+def sales_report(start=None, end=None, group_by=('day',), categories=None, seller_ids=None, statuses=None):
+    rows = SalesRollup.objects.all()
+    if start:
+        rows = rows.filter(day__gte=start)
+    if end:
+        rows = rows.filter(day__lte=end)
+    if categories:
+        rows = rows.filter(category__in=categories)
+    if seller_ids:
+        rows = rows.filter(seller__in=seller_ids)
+    if statuses:
+        rows = rows.filter(status__in=statuses)
+    group_by = list(group_by)
+    fields = [name for name in group_by if DIMENSIONS[name] is None]
+    expressions = {name: DIMENSIONS[name] for name in group_by if DIMENSIONS[name] is not None}
+    return (
+        rows.values(*fields, **expressions)
+        .annotate(orders=Sum('order_count'), units=Sum('units'), revenue=Sum('revenue'))
+        .order_by(*group_by)
+    )
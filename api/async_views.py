@@ -0,0 +1,108 @@
+from django.contrib import messages
+from django.http import Http404
+from django.shortcuts import redirect, render
+from django.views import View
+
+from .cache import acached_product, acached_product_fragment, acached_product_page
+from .cart import aadd_to_cart, aget_request_cart, aload_line_items, aremove_item, aset_item_quantity
+from .models import Product
+from .reservations import InsufficientStockError
+from .roles import aget_authorization
+
+
+#Async versions of the catalog and cart views for running under ASGI (uvicorn etc).
+#They use the async ORM and the catalog cache's async helpers end to end, so no request
+#has to hop onto a worker thread (only fragments missing from the cache are rendered on one).
+#Templates are rendered only after every query has run: the user and session are
+#resolved up front so nothing in base.html touches the database while rendering.
+async def arender(request, template_name, context):
+    request.user = await request.auser()
+    await aget_authorization(request)
+    return render(request, template_name, context)
+
+
+async def aproduct_cards(page):
+    return [(product, await acached_product_fragment(product, "api/includes/product_card.html")) for product in page]
+
+
+class AsyncProductListView(View):
+    async def get(self, request):
+        page = await acached_product_page(request)
+        return await arender(request, "api/product_list.html", {
+            "products": page,
+            "cards": await aproduct_cards(page),
+            "page": page,
+            "categories": Product.Categories.choices,
+        })
+
+
+class AsyncProductListByCategoryView(View):
+    async def get(self, request, category):
+        current_category = Product.normalize_category(category)
+        if current_category is None:
+            raise Http404("Unknown category")
+        page = await acached_product_page(request, current_category)
+        return await arender(request, "api/product_list.html", {
+            "products": page,
+            "cards": await aproduct_cards(page),
+            "page": page,
+            "categories": Product.Categories.choices,
+            "current_category": current_category,
+        })
+
+
+class AsyncProductDetailView(View):
+    async def get(self, request, pk):
+        product = await acached_product(pk)
+        return await arender(request, "api/product_detail.html", {
+            "product": product,
+            "detail_html": await acached_product_fragment(product, "api/includes/product_detail_body.html"),
+        })
+
+
+class AsyncCartView(View):
+    async def get(self, request):
+        user = await request.auser()
+        cart = await aget_request_cart(request, create=user.is_authenticated)
+        items = await aload_line_items(cart) if cart else []
+        return await arender(request, "api/cart.html", {
+            "cart": cart,
+            "cart_items": items,
+            "total": cart.get_total if cart else 0,
+        })
+
+
+class AsyncCartAddView(View):
+    async def post(self, request, pk):
+        cart = await aget_request_cart(request)
+        try:
+            await aadd_to_cart(cart, pk)
+        except Product.DoesNotExist:
+            raise Http404("Product not found")
+        except InsufficientStockError as e:
+            messages.error(request, str(e))
+        return redirect("async-cart")
+
+
+class AsyncCartUpdateView(View):
+    async def post(self, request, pk):
+        try:
+            quantity = int(request.POST.get("quantity", 1))
+        except ValueError:
+            quantity = 0
+        if quantity > 0:
+            cart = await aget_request_cart(request, create=False)
+            try:
+                if cart is None or not await aset_item_quantity(cart, pk, quantity):
+                    raise Http404("Cart item not found")
+            except InsufficientStockError as e:
+                messages.error(request, str(e))
+        return redirect("async-cart")
+
+
+class AsyncCartRemoveView(View):
+    async def post(self, request, pk):
+        cart = await aget_request_cart(request, create=False)
+        if cart is None or not await aremove_item(cart, pk):
+            raise Http404("Cart item not found")
+        return redirect("async-cart")
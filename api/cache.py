@@ -0,0 +1,397 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import Http404
+from django.template.loader import render_to_string
+from django.utils.text import slugify
+
+from .metrics import record_cache_access
+from .routers import reading_from_primary
+
+
+#Two tier cache for catalog data: a small per-process LRU in front of a Django cache every
+#worker shares (CACHE_ALIAS, see CACHES in settings).
+#Keys embed version numbers (per product, per category and for the whole catalog) which
+#Product signals bump, so invalidation never has to find and delete keys; old entries simply
+#stop being asked for and age out.
+#Values are built from the primary database, never from a replica that may not have seen
+#the write that bumped their version yet.
+
+DEFAULTS = {
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': 600,
+    'LOCAL_MAX_ENTRIES': 1000,
+    #How long a process may trust its local copy of a version number
+    'VERSION_TTL': 2,
+    #Stampede protection: how long a rebuild lock lives and how long others wait on it
+    'LOCK_TIMEOUT': 10,
+    'LOCK_WAIT': 2.0,
+}
+
+
+def get_setting(name):
+    return getattr(settings, 'CATALOG_CACHE', {}).get(name, DEFAULTS[name])
+
+
+class LocalLRU:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self.data[key]
+                return None
+            self.data.move_to_end(key)
+            return entry
+
+    def set(self, key, value, timeout=None):
+        expires = time.monotonic() + timeout if timeout else None
+        with self.lock:
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_entries:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class TieredCache:
+    def __init__(self):
+        self.local = LocalLRU(get_setting('LOCAL_MAX_ENTRIES'))
+        self.key_locks = {}
+        self.key_locks_guard = threading.Lock()
+        self.async_key_locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def shared(self):
+        return caches[get_setting('CACHE_ALIAS')]
+
+    #Versions
+    def version_key(self, scope):
+        return 'catalog:version:' + ':'.join(str(part) for part in scope)
+
+    def bump(self, scope):
+        key = self.version_key(scope)
+        try:
+            version = self.shared.incr(key)
+        except ValueError:
+            version = 2
+            self.shared.set(key, version, timeout=None)
+        self.local.set(key, version, get_setting('VERSION_TTL'))
+        return version
+
+    #Versions of several scopes with at most one round trip to the shared cache
+    def get_versions(self, scopes):
+        keys = [self.version_key(scope) for scope in scopes]
+        versions = {}
+        for key in keys:
+            entry = self.local.get(key)
+            if entry is not None:
+                versions[key] = entry[0]
+        missing = [key for key in keys if key not in versions]
+        if missing:
+            versions.update(self.shared.get_many(missing))
+            for key in missing:
+                if key not in versions:
+                    versions[key] = 1
+                    self.shared.add(key, 1, timeout=None)
+                self.local.set(key, versions[key], get_setting('VERSION_TTL'))
+        return [versions[key] for key in keys]
+
+    async def aget_versions(self, scopes):
+        keys = [self.version_key(scope) for scope in scopes]
+        versions = {}
+        for key in keys:
+            entry = self.local.get(key)
+            if entry is not None:
+                versions[key] = entry[0]
+        missing = [key for key in keys if key not in versions]
+        if missing:
+            versions.update(await self.shared.aget_many(missing))
+            for key in missing:
+                if key not in versions:
+                    versions[key] = 1
+                    await self.shared.aadd(key, 1, timeout=None)
+                self.local.set(key, versions[key], get_setting('VERSION_TTL'))
+        return [versions[key] for key in keys]
+
+    def format_key(self, name, versions, parts):
+        return ':'.join(['catalog', name, 'v' + '.'.join(str(version) for version in versions)] + [str(part) for part in parts])
+
+    def make_key(self, name, scopes, *parts):
+        return self.format_key(name, self.get_versions(scopes), parts)
+
+    async def amake_key(self, name, scopes, *parts):
+        return self.format_key(name, await self.aget_versions(scopes), parts)
+
+    #Values
+    def get(self, key):
+        entry = self.local.get(key)
+        if entry is not None:
+            self.hits += 1
+            record_cache_access(True)
+            return entry[0]
+        value = self.shared.get(key)
+        if value is not None:
+            self.hits += 1
+            self.local.set(key, value)
+        else:
+            self.misses += 1
+        record_cache_access(value is not None)
+        return value
+
+    def set(self, key, value, timeout=None):
+        timeout = timeout or get_setting('TIMEOUT')
+        self.shared.set(key, value, timeout)
+        self.local.set(key, value, timeout)
+
+    #get() and set() for async views, through the shared cache's async API
+    async def aget(self, key):
+        entry = self.local.get(key)
+        if entry is not None:
+            self.hits += 1
+            record_cache_access(True)
+            return entry[0]
+        value = await self.shared.aget(key)
+        if value is not None:
+            self.hits += 1
+            self.local.set(key, value)
+        else:
+            self.misses += 1
+        record_cache_access(value is not None)
+        return value
+
+    async def aset(self, key, value, timeout=None):
+        timeout = timeout or get_setting('TIMEOUT')
+        await self.shared.aset(key, value, timeout)
+        self.local.set(key, value, timeout)
+
+    def get_key_lock(self, key):
+        with self.key_locks_guard:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    #Return the cached value or build it once. Threads in this process queue on a
+    #per key lock; other processes see the shared "building" marker and wait briefly
+    #for the value instead of all hitting the database at the same time.
+    def get_or_set(self, key, producer, timeout=None):
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        key_lock = self.get_key_lock(key)
+        with key_lock:
+            value = self.get(key)
+            if value is not None:
+                return value
+
+            lock_key = key + ':lock'
+            locked = self.shared.add(lock_key, 1, get_setting('LOCK_TIMEOUT'))
+            if not locked:
+                deadline = time.monotonic() + get_setting('LOCK_WAIT')
+                while time.monotonic() < deadline:
+                    time.sleep(0.05)
+                    value = self.shared.get(key)
+                    if value is not None:
+                        self.local.set(key, value)
+                        return value
+            try:
+                with reading_from_primary():
+                    value = producer()
+                self.set(key, value, timeout)
+            finally:
+                #After a timed out wait the lock is still another worker's
+                if locked:
+                    self.shared.delete(lock_key)
+                with self.key_locks_guard:
+                    self.key_locks.pop(key, None)
+        return value
+
+    #Same as get_or_set for async views: producer is a coroutine function, concurrent
+    #requests in this event loop wait on one asyncio lock per key and other processes'
+    #builds are awaited with asyncio.sleep, so a cold key never blocks the loop
+    async def aget_or_set(self, key, producer, timeout=None):
+        value = await self.aget(key)
+        if value is not None:
+            return value
+
+        key_lock = self.async_key_locks.setdefault(key, asyncio.Lock())
+        try:
+            async with key_lock:
+                value = await self.aget(key)
+                if value is not None:
+                    return value
+
+                lock_key = key + ':lock'
+                locked = await self.shared.aadd(lock_key, 1, get_setting('LOCK_TIMEOUT'))
+                if not locked:
+                    deadline = time.monotonic() + get_setting('LOCK_WAIT')
+                    while time.monotonic() < deadline:
+                        await asyncio.sleep(0.05)
+                        value = await self.shared.aget(key)
+                        if value is not None:
+                            self.local.set(key, value)
+                            return value
+                try:
+                    with reading_from_primary():
+                        value = await producer()
+                    await self.aset(key, value, timeout)
+                finally:
+                    if locked:
+                        await self.shared.adelete(lock_key)
+        finally:
+            self.async_key_locks.pop(key, None)
+        return value
+
+    def clear_local(self):
+        self.local.clear()
+
+
+catalog_cache = TieredCache()
+
+
+#Scopes used by the catalog. A product change bumps its own scope and its category's;
+#CATALOG_SCOPE is only bumped by bulk loads that replace everything (seed_data).
+CATALOG_SCOPE = ('catalog',)
+
+
+def product_scope(product_id):
+    return ('product', product_id)
+
+
+def category_scope(category):
+    return ('category', slugify(category) if category else 'all')
+
+
+#Unfiltered lists show every category, so they follow every category's version; a sale
+#only drops the pages of the categories it touched instead of every cached list page
+def list_scopes(category=None):
+    from .models import Product
+
+    if category:
+        return [category_scope(category)]
+    return [CATALOG_SCOPE] + [category_scope(value) for value in Product.Categories.values]
+
+
+def invalidate_product(product, previous_category=None):
+    catalog_cache.bump(product_scope(product.pk))
+    catalog_cache.bump(category_scope(product.category))
+    if previous_category and previous_category != product.category:
+        catalog_cache.bump(category_scope(previous_category))
+
+
+#For updates that change a product row without loading it (review stats)
+def invalidate_product_id(product_id):
+    from .models import Product
+
+    category = Product.objects.filter(pk=product_id).values_list('category', flat=True).first()
+    if category is not None:
+        invalidate_product(Product(pk=product_id, category=category))
+
+
+#For bulk writes (checkout stock updates, imports) that bypass the Product signals
+def invalidate_products(products):
+    categories = set()
+    for product in products:
+        catalog_cache.bump(product_scope(product.pk))
+        categories.add(product.category)
+    for category in categories:
+        catalog_cache.bump(category_scope(category))
+
+
+#Catalog reads
+def product_key(product_id):
+    return catalog_cache.make_key('product', [product_scope(product_id)], product_id)
+
+
+async def aproduct_key(product_id):
+    return await catalog_cache.amake_key('product', [product_scope(product_id)], product_id)
+
+
+def cached_product(product_id):
+    from .models import Product
+
+    def load():
+        try:
+            return Product.objects.select_related('seller').get(pk=product_id)
+        except Product.DoesNotExist:
+            raise Http404("Product not found")
+
+    return catalog_cache.get_or_set(product_key(product_id), load)
+
+
+async def acached_product(product_id):
+    from .models import Product
+
+    async def load():
+        try:
+            return await Product.objects.select_related('seller').aget(pk=product_id)
+        except Product.DoesNotExist:
+            raise Http404("Product not found")
+
+    return await catalog_cache.aget_or_set(await aproduct_key(product_id), load)
+
+
+#Queryset and cache key parts of a catalog page
+def product_page_query(request, category=None):
+    from .models import Product
+    from .pagination import get_page_size, parse_cursor
+
+    queryset = Product.objects.filter(category=category) if category else Product.objects.all()
+    parts = (
+        slugify(category) if category else 'all',
+        parse_cursor(request.GET.get('after')),
+        parse_cursor(request.GET.get('before')),
+        get_page_size(request),
+    )
+    return queryset, parts
+
+
+def cached_product_page(request, category=None):
+    from .pagination import keyset_paginate
+
+    queryset, parts = product_page_query(request, category)
+    key = catalog_cache.make_key('product-page', list_scopes(category), *parts)
+    return catalog_cache.get_or_set(key, lambda: keyset_paginate(queryset, request))
+
+
+async def acached_product_page(request, category=None):
+    from .pagination import akeyset_paginate
+
+    queryset, parts = product_page_query(request, category)
+    key = await catalog_cache.amake_key('product-page', list_scopes(category), *parts)
+    return await catalog_cache.aget_or_set(key, lambda: akeyset_paginate(queryset, request))
+
+
+#Rendered HTML that doesn't depend on the user (no csrf tokens in here)
+def cached_product_fragment(product, template_name):
+    key = catalog_cache.make_key('fragment', [product_scope(product.pk)], template_name, product.pk)
+    return catalog_cache.get_or_set(key, lambda: render_to_string(template_name, {'product': product}))
+
+
+#Rendering happens on a worker thread, the event loop only waits for it
+async def acached_product_fragment(product, template_name):
+    async def render():
+        return await sync_to_async(render_to_string)(template_name, {'product': product})
+
+    key = await catalog_cache.amake_key('fragment', [product_scope(product.pk)], template_name, product.pk)
+    return await catalog_cache.aget_or_set(key, render)
@@ -0,0 +1,238 @@
+import uuid
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+
+from .models import Cart, CartItem, Product
+from .reservations import areserve, reserve, transfer_holds
+
+
+#Anonymous carts are keyed by session_key. The cart id is also kept in the session
+#data because login rotates the session key and we still need to find it to merge.
+SESSION_CART_ID = 'anonymous_cart_id'
+
+
+def get_user_cart(user):
+    cart, created = Cart.objects.get_or_create(user=user)
+    return cart
+
+
+def get_session_cart(request, create=True):
+    session = request.session
+    if session.session_key is None:
+        if not create:
+            return None
+        session.save()
+    if create:
+        cart, created = Cart.objects.get_or_create(session_key=session.session_key, user=None)
+    else:
+        cart = Cart.objects.filter(session_key=session.session_key, user=None).first()
+    if cart is not None and session.get(SESSION_CART_ID) != cart.pk:
+        session[SESSION_CART_ID] = cart.pk
+    return cart
+
+
+def get_request_cart(request, create=True):
+    if request.user.is_authenticated:
+        if create:
+            return get_user_cart(request.user)
+        return Cart.objects.filter(user=request.user).first()
+    return get_session_cart(request, create=create)
+
+
+#Fold an anonymous cart into the user's cart with a fixed number of statements:
+#add quantities onto lines the user already has, re-point the other lines, drop the old cart.
+def merge_carts(source, target):
+    if source.pk == target.pk:
+        return
+    with transaction.atomic():
+        source_lines = CartItem.objects.filter(cart=source)
+        overlapping = CartItem.objects.filter(cart=target, product__in=source_lines.values('product'))
+        overlapping.update(
+            quantity=F('quantity') + Subquery(
+                source_lines.filter(product=OuterRef('product')).values('quantity')[:1]
+            )
+        )
+        source_lines.exclude(product__in=CartItem.objects.filter(cart=target).values('product')).update(cart=target)
+        transfer_holds(source, target)
+        source.delete()
+        touch_cart(target.pk)
+
+
+def merge_session_cart(session, user):
+    cart_id = session.pop(SESSION_CART_ID, None)
+    if cart_id is None:
+        return
+    source = Cart.objects.filter(pk=cart_id, user=None).first()
+    if source is not None:
+        merge_carts(source, get_user_cart(user))
+
+
+#Line changes go through queryset update()/delete(), so bump the cart's
+#updated_at explicitly to keep its ETag/Last-Modified honest
+def touch_cart(cart_id):
+    Cart.objects.filter(pk=cart_id).update(updated_at=timezone.now())
+
+
+#Increment a line with a single UPDATE ... SET quantity = quantity + n.
+#Only when the line doesn't exist yet do we INSERT, and if another request beat us
+#to it the unique (cart, product) constraint fails and we fall back to the UPDATE again,
+#so concurrent adds never lose an increment.
+#Stock is held first (see reservations.py) and raises InsufficientStockError when it runs out.
+def add_to_cart(cart, product_id, quantity=1):
+    if quantity < 1:
+        raise ValueError('Quantity must be at least 1.')
+    reserve(cart, product_id, quantity)
+    try:
+        lines = CartItem.objects.filter(cart=cart, product_id=product_id)
+        if not lines.update(quantity=F('quantity') + quantity):
+            if not Product.objects.filter(pk=product_id).exists():
+                raise Product.DoesNotExist(product_id)
+            try:
+                with transaction.atomic():
+                    CartItem.objects.create(cart=cart, product_id=product_id, quantity=quantity)
+            except IntegrityError:
+                lines.update(quantity=F('quantity') + quantity)
+    except Exception:
+        reserve(cart, product_id, -quantity)
+        raise
+    touch_cart(cart.pk)
+
+
+def set_item_quantity(cart, cart_item_id, quantity):
+    #Returns the number of rows changed so callers can 404 on someone else's item
+    line = CartItem.objects.filter(pk=cart_item_id, cart=cart).values_list('product_id', 'quantity').first()
+    if line is None:
+        return 0
+    product_id, current = line
+    reserve(cart, product_id, quantity - current)
+    updated = CartItem.objects.filter(pk=cart_item_id, cart=cart).update(quantity=quantity)
+    if updated:
+        touch_cart(cart.pk)
+    return updated
+
+
+def remove_item(cart, cart_item_id):
+    line = CartItem.objects.filter(pk=cart_item_id, cart=cart).values_list('product_id', 'quantity').first()
+    if line is None:
+        return 0
+    deleted, _ = CartItem.objects.filter(pk=cart_item_id, cart=cart).delete()
+    if deleted:
+        reserve(cart, line[0], -line[1])
+        touch_cart(cart.pk)
+    return deleted
+
+
+#Set many lines at once: one lookup to drop unknown products, stock holds for the changed
+#lines, one INSERT ... ON CONFLICT (cart, product) DO UPDATE for the rest and one DELETE for zeros.
+def update_cart_items(cart, quantities):
+    quantities = {uuid.UUID(str(product_id)): int(quantity) for product_id, quantity in quantities.items()}
+    for quantity in quantities.values():
+        if quantity < 0:
+            raise ValueError('Quantity cannot be negative.')
+
+    removed = [product_id for product_id, quantity in quantities.items() if quantity == 0]
+    wanted = {product_id: quantity for product_id, quantity in quantities.items() if quantity > 0}
+    known = set(Product.objects.filter(pk__in=wanted.keys()).values_list('pk', flat=True)) if wanted else set()
+    current = dict(CartItem.objects.filter(cart=cart, product_id__in=quantities.keys()).values_list('product_id', 'quantity'))
+
+    #Hold the new quantities first; if one product runs out, give back what was already taken
+    changed = []
+    try:
+        for product_id in sorted(known) + removed:
+            delta = quantities[product_id] - current.get(product_id, 0)
+            reserve(cart, product_id, delta)
+            changed.append((product_id, delta))
+    except Exception:
+        for product_id, delta in changed:
+            reserve(cart, product_id, -delta)
+        raise
+
+    with transaction.atomic():
+        if known:
+            CartItem.objects.bulk_create(
+                [CartItem(cart=cart, product_id=product_id, quantity=wanted[product_id]) for product_id in known],
+                update_conflicts=True,
+                unique_fields=['cart', 'product'],
+                update_fields=['quantity'],
+            )
+        if removed:
+            CartItem.objects.filter(cart=cart, product_id__in=removed).delete()
+        touch_cart(cart.pk)
+    return [product_id for product_id in wanted if product_id not in known]
+
+
+#Async versions of the cart helpers for api.async_views, same statements via the async ORM
+async def aget_request_cart(request, create=True):
+    user = await request.auser()
+    if user.is_authenticated:
+        if create:
+            cart, created = await Cart.objects.aget_or_create(user=user)
+            return cart
+        return await Cart.objects.filter(user=user).afirst()
+    session = request.session
+    if session.session_key is None:
+        if not create:
+            return None
+        await session.asave()
+    if create:
+        cart, created = await Cart.objects.aget_or_create(session_key=session.session_key, user=None)
+    else:
+        cart = await Cart.objects.filter(session_key=session.session_key, user=None).afirst()
+    if cart is not None and await session.aget(SESSION_CART_ID) != cart.pk:
+        await session.aset(SESSION_CART_ID, cart.pk)
+    return cart
+
+
+async def aload_line_items(cart):
+    #Fills the same cache Cart.line_items uses, so get_total needs no extra query
+    cart.__dict__['line_items'] = [item async for item in cart.cartitem_set.with_subtotals()]
+    return cart.line_items
+
+
+async def atouch_cart(cart_id):
+    await Cart.objects.filter(pk=cart_id).aupdate(updated_at=timezone.now())
+
+
+async def aadd_to_cart(cart, product_id, quantity=1):
+    if quantity < 1:
+        raise ValueError('Quantity must be at least 1.')
+    await areserve(cart, product_id, quantity)
+    try:
+        lines = CartItem.objects.filter(cart=cart, product_id=product_id)
+        if not await lines.aupdate(quantity=F('quantity') + quantity):
+            if not await Product.objects.filter(pk=product_id).aexists():
+                raise Product.DoesNotExist(product_id)
+            #Runs in autocommit, so a failed INSERT doesn't need a savepoint to recover
+            try:
+                await CartItem.objects.acreate(cart=cart, product_id=product_id, quantity=quantity)
+            except IntegrityError:
+                await lines.aupdate(quantity=F('quantity') + quantity)
+    except Exception:
+        await areserve(cart, product_id, -quantity)
+        raise
+    await atouch_cart(cart.pk)
+
+
+async def aset_item_quantity(cart, cart_item_id, quantity):
+    line = await CartItem.objects.filter(pk=cart_item_id, cart=cart).values_list('product_id', 'quantity').afirst()
+    if line is None:
+        return 0
+    product_id, current = line
+    await areserve(cart, product_id, quantity - current)
+    updated = await CartItem.objects.filter(pk=cart_item_id, cart=cart).aupdate(quantity=quantity)
+    if updated:
+        await atouch_cart(cart.pk)
+    return updated
+
+
+async def aremove_item(cart, cart_item_id):
+    line = await CartItem.objects.filter(pk=cart_item_id, cart=cart).values_list('product_id', 'quantity').afirst()
+    if line is None:
+        return 0
+    deleted, _ = await CartItem.objects.filter(pk=cart_item_id, cart=cart).adelete()
+    if deleted:
+        await areserve(cart, line[0], -line[1])
+        await atouch_cart(cart.pk)
+    return deleted
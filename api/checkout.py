@@ -0,0 +1,85 @@
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, F, Q, When, PositiveIntegerField
+from django.utils import timezone
+
+from .cache import invalidate_products
+from .models import Cart, CartItem, Order, OrderItem, Product, StockReservation
+from .reservations import checkout_holds, settle_checkout
+from .sqlite import retry_if_locked, write_transaction
+from .tasks import enqueue_checkout_jobs
+
+
+class CheckoutError(Exception):
+    pass
+
+
+class EmptyCartError(CheckoutError):
+    pass
+
+
+class OutOfStockError(CheckoutError):
+    def __init__(self, products):
+        self.products = products
+        names = ', '.join(product.name for product in products)
+        super().__init__(f'Not enough stock for: {names}')
+
+
+#Turn a cart into an order with a fixed number of queries regardless of cart size:
+#read items, lock products, read holds, insert order, one conditional stock UPDATE,
+#one bulk INSERT for the order items, DELETEs for the cart lines and their holds
+#and one INSERT queueing the post-checkout jobs.
+#On SQLite the transaction takes the write lock up front and is replayed on lock conflicts.
+@retry_if_locked
+def checkout_cart(cart, user=None):
+    with write_transaction():
+        items = list(CartItem.objects.filter(cart=cart).values_list('product_id', 'quantity'))
+        if not items:
+            raise EmptyCartError('Cart is empty.')
+        quantities = dict(items)
+
+        #Lock the rows in a stable order so concurrent checkouts can't deadlock each other
+        products = list(
+            Product.objects.select_for_update()
+            .filter(pk__in=quantities.keys())
+            .order_by('pk')
+            .only('id', 'name', 'price', 'stock', 'category')
+        )
+        #Stock other carts are still holding isn't ours to sell
+        own_holds, other_holds = checkout_holds(cart, quantities.keys())
+        short = [product for product in products if product.stock - other_holds[product.pk] < quantities[product.pk]]
+        if short:
+            raise OutOfStockError(short)
+
+        #Every row must still have enough stock at UPDATE time, otherwise roll everything back
+        enough_stock = Q()
+        for product_id, quantity in quantities.items():
+            enough_stock |= Q(pk=product_id, stock__gte=quantity)
+        updated = Product.objects.filter(enough_stock).update(
+            stock=Case(
+                *[When(pk=product_id, then=F('stock') - quantity) for product_id, quantity in quantities.items()],
+                default=F('stock'),
+                output_field=PositiveIntegerField(),
+            ),
+            updated_at=timezone.now(),
+        )
+        if updated != len(quantities):
+            raise OutOfStockError(products)
+
+        #bulk_create skips the OrderItem signals, so the order total is written up front
+        total = sum((product.price * quantities[product.pk] for product in products), Decimal('0'))
+        order = Order.objects.create(user=user or cart.user, total=total)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, price=product.price, quantity=quantities[product.pk])
+            for product in products
+        ])
+        CartItem.objects.filter(cart=cart).delete()
+        StockReservation.objects.filter(cart=cart).delete()
+        Cart.objects.filter(pk=cart.pk).update(updated_at=timezone.now())
+        #Email, payment record and stock alerts are queued in the same transaction and run in the worker
+        enqueue_checkout_jobs(order, quantities.keys())
+        #The stock UPDATE skips Product signals, refresh cached product pages ourselves
+        transaction.on_commit(lambda: invalidate_products(products))
+        transaction.on_commit(lambda: settle_checkout(quantities, own_holds))
+    return order
@@ -15,9 +15,22 @@ class CustomUserCreationForm(UserCreationForm):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        #Admins are made by staff, nobody can sign up as one
+        self.fields["role"].choices = [choice for choice in CustomUser.ROLE_CHOICES if choice[0] != "admin"]
         for field in self.fields.values():
             field.widget.attrs.update({'class': 'form-control'})
 
+#Shared with the bulk importer (api/product_io.py) so both apply the same rules
+def validate_price(price):
+    if price <= 0:
+        raise forms.ValidationError("Price must be greater than zero.")
+    return price
+
+def validate_stock(stock):
+    if stock < 0:
+        raise forms.ValidationError("Stock cannot be negative.")
+    return stock
+
 class ProductForm(forms.ModelForm):
     class Meta:
         model = Product
@@ -28,13 +41,7 @@ class ProductForm(forms.ModelForm):
         }
 
     def clean_price(self):
-        price = self.cleaned_data['price']
-        if price <= 0:
-            raise forms.ValidationError("Price must be greater than zero.")
-        return price
+        return validate_price(self.cleaned_data['price'])
 
     def clean_stock(self):
-        stock = self.cleaned_data['stock']
-        if stock < 0:
-            raise forms.ValidationError("Stock cannot be negative.")
-        return stock
\ No newline at end of file
+        return validate_stock(self.cleaned_data['stock'])
\ No newline at end of file
@@ -0,0 +1,113 @@
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connection, transaction
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+
+#Background image pipeline: after an upload is committed, a small thread pool makes
+#WebP copies of Product.image and CustomUser.profile_image at a few fixed widths so
+#pages can serve kilobyte thumbnails instead of the original upload.
+#Variant names derive from the (already content hashed) original name, so they are
+#immutable and can be served with far-future cache headers.
+
+DEFAULTS = {
+    'ASYNC': True,
+    'WORKERS': 2,
+    'QUALITY': 80,
+    'SIZES': {'thumb': 160, 'card': 400, 'large': 1200},
+}
+
+
+def get_setting(name):
+    return getattr(settings, 'IMAGE_PIPELINE', {}).get(name, DEFAULTS[name])
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=get_setting('WORKERS'), thread_name_prefix='image-pipeline')
+        return _executor
+
+
+def variant_name(source_name, size):
+    directory, filename = os.path.split(source_name)
+    stem = os.path.splitext(filename)[0]
+    return f'{directory}/variants/{stem}-{size}.webp'
+
+
+def make_variants(source_name):
+    sizes = get_setting('SIZES')
+    quality = get_setting('QUALITY')
+    variants = {'source': source_name}
+    with default_storage.open(source_name, 'rb') as source:
+        image = Image.open(source)
+        #Let the JPEG decoder downscale while decoding, we never need more than the largest variant
+        largest = max(sizes.values())
+        image.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'P') else 'RGB')
+
+        for size, width in sizes.items():
+            name = variant_name(source_name, size)
+            if not default_storage.exists(name):
+                copy = image.copy()
+                copy.thumbnail((width, width), Image.LANCZOS)
+                buffer = io.BytesIO()
+                copy.save(buffer, 'WEBP', quality=quality, method=4)
+                default_storage.save(name, ContentFile(buffer.getvalue()))
+            variants[size] = name
+    return variants
+
+
+def process_image(model, pk, field_name, variants_field):
+    try:
+        instance = model._default_manager.filter(pk=pk).only('pk', field_name).first()
+        source = getattr(instance, field_name, None) if instance else None
+        if not source:
+            return
+        variants = make_variants(source.name)
+        #Only record the variants if the image wasn't replaced while we were working
+        model._default_manager.filter(pk=pk, **{field_name: source.name}).update(**{variants_field: variants})
+        if model._meta.label == 'api.Product':
+            from .cache import invalidate_product
+            invalidate_product(model._default_manager.only('pk', 'category').get(pk=pk))
+    except Exception:
+        logger.exception("Could not build image variants for %s %s", model._meta.label, pk)
+    finally:
+        if get_setting('ASYNC'):
+            connection.close()
+
+
+def run_image_job(model, pk, field_name, variants_field):
+    if get_setting('ASYNC'):
+        def job():
+            close_old_connections()
+            process_image(model, pk, field_name, variants_field)
+        get_executor().submit(job)
+    else:
+        process_image(model, pk, field_name, variants_field)
+
+
+#Called from the post_save signals; waits for the transaction so the worker sees the row
+def schedule_variants(instance, field_name, variants_field):
+    image = getattr(instance, field_name)
+    variants = getattr(instance, variants_field) or {}
+    if not image or variants.get('source') == image.name:
+        return
+    model, pk = type(instance), instance.pk
+    transaction.on_commit(lambda: run_image_job(model, pk, field_name, variants_field))
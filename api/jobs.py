@@ -0,0 +1,192 @@
+import logging
+import random
+import threading
+import traceback
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Job
+from .sqlite import retry_if_locked, write_transaction
+
+logger = logging.getLogger(__name__)
+
+
+#Small database backed job queue with at-least-once delivery.
+#- enqueue() inserts a row, ignoring duplicates of the same idempotency key
+#- workers claim due rows with a conditional UPDATE so two workers never get the same job
+#- while a handler runs, its worker refreshes the job's lock every HEARTBEAT_INTERVAL; a job
+#  whose lock is older than LOCK_TIMEOUT lost its worker and is handed out again, or marked
+#  failed when it already used up its attempts
+#- failures are retried with exponential backoff until max_attempts
+#- done jobs are deleted by prune_jobs once they are RETENTION_DAYS old, failed ones are kept
+#  for someone to look at
+#Handlers must therefore be idempotent; register them with @job('name').
+
+DEFAULTS = {
+    'LOCK_TIMEOUT': 300,
+    'HEARTBEAT_INTERVAL': 30,
+    'BACKOFF_BASE': 5,
+    'BACKOFF_MAX': 3600,
+    'RETENTION_DAYS': 7,
+}
+
+registry = {}
+
+
+def get_setting(name):
+    return getattr(settings, 'JOB_QUEUE', {}).get(name, DEFAULTS[name])
+
+
+def job(name):
+    def register(func):
+        registry[name] = func
+        return func
+    return register
+
+
+def build_job(name, payload=None, idempotency_key=None, run_at=None, max_attempts=5):
+    return Job(
+        name=name,
+        payload=payload or {},
+        idempotency_key=idempotency_key,
+        run_at=run_at or timezone.now(),
+        max_attempts=max_attempts,
+    )
+
+
+#One INSERT for any number of jobs; rows whose idempotency key already exists are skipped
+def enqueue_many(jobs):
+    Job.objects.bulk_create(jobs, ignore_conflicts=True)
+
+
+def enqueue(name, payload=None, idempotency_key=None, run_at=None, max_attempts=5):
+    enqueue_many([build_job(name, payload, idempotency_key, run_at, max_attempts)])
+
+
+#For recurring work under a fixed key: queue the job, or queue the key's existing row again
+#whatever its status, so the key never has more than one row. A run of that row still in
+#progress loses its claim and the job simply runs once more.
+REQUEUE_FIELDS = ['name', 'payload', 'status', 'attempts', 'max_attempts', 'run_at', 'claim_token', 'locked_at', 'last_error', 'updated_at']
+
+
+def requeue(name, payload, idempotency_key, run_at=None, max_attempts=5):
+    Job.objects.bulk_create(
+        [build_job(name, payload, idempotency_key, run_at, max_attempts)],
+        update_conflicts=True, unique_fields=['idempotency_key'], update_fields=REQUEUE_FIELDS,
+    )
+
+
+async def arequeue(name, payload, idempotency_key, run_at=None, max_attempts=5):
+    await Job.objects.abulk_create(
+        [build_job(name, payload, idempotency_key, run_at, max_attempts)],
+        update_conflicts=True, unique_fields=['idempotency_key'], update_fields=REQUEUE_FIELDS,
+    )
+
+
+def backoff_delay(attempts):
+    delay = min(get_setting('BACKOFF_BASE') * 2 ** (attempts - 1), get_setting('BACKOFF_MAX'))
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+@retry_if_locked
+def claim_jobs(limit=10):
+    now = timezone.now()
+    stale = now - timedelta(seconds=get_setting('LOCK_TIMEOUT'))
+    token = uuid.uuid4()
+    #Queued jobs that are due, plus running jobs whose worker stopped heartbeating and that have attempts left
+    abandoned = Q(status=Job.Status.RUNNING, locked_at__lt=stale)
+    claimable = Q(status=Job.Status.QUEUED, run_at__lte=now) | (abandoned & Q(attempts__lt=F('max_attempts')))
+    with write_transaction():
+        Job.objects.filter(abandoned, attempts__gte=F('max_attempts')).update(
+            status=Job.Status.FAILED, claim_token=None, locked_at=None, updated_at=now,
+            last_error='The worker stopped responding during the last attempt.',
+        )
+        ids = list(Job.objects.filter(claimable).order_by('run_at').values_list('pk', flat=True)[:limit])
+        if not ids:
+            return []
+        #The condition is re-checked by the UPDATE, so a row another worker claimed in between is skipped
+        Job.objects.filter(claimable, pk__in=ids).update(
+            status=Job.Status.RUNNING, claim_token=token, locked_at=now, attempts=F('attempts') + 1, updated_at=now
+        )
+    return list(Job.objects.filter(claim_token=token))
+
+
+def extend_lock(claimed):
+    return Job.objects.filter(pk=claimed.pk, claim_token=claimed.claim_token).update(locked_at=timezone.now())
+
+
+#Keeps a running job's lock fresh from a thread of its own, so a handler that runs longer
+#than LOCK_TIMEOUT isn't mistaken for one whose worker died and run a second time
+class Heartbeat:
+    def __init__(self, claimed):
+        self.claimed = claimed
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f'job-heartbeat-{claimed.pk}', daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(get_setting('HEARTBEAT_INTERVAL')):
+                try:
+                    extend_lock(self.claimed)
+                except DatabaseError:
+                    logger.warning("Could not refresh the lock of job %s", self.claimed.pk, exc_info=True)
+        finally:
+            connection.close()
+
+
+def run_job(claimed):
+    handler = registry.get(claimed.name)
+    try:
+        if handler is None:
+            raise LookupError(f'No handler registered for job {claimed.name!r}')
+        with Heartbeat(claimed):
+            handler(**claimed.payload)
+    except Exception:
+        error = traceback.format_exc()
+        logger.exception("Job %s (%s) failed on attempt %s", claimed.pk, claimed.name, claimed.attempts)
+        if claimed.attempts >= claimed.max_attempts:
+            fields = {'status': Job.Status.FAILED}
+        else:
+            fields = {'status': Job.Status.QUEUED, 'run_at': timezone.now() + backoff_delay(claimed.attempts)}
+        Job.objects.filter(pk=claimed.pk, claim_token=claimed.claim_token).update(
+            last_error=error[-4000:], claim_token=None, locked_at=None, updated_at=timezone.now(), **fields
+        )
+        return False
+    Job.objects.filter(pk=claimed.pk, claim_token=claimed.claim_token).update(
+        status=Job.Status.DONE, claim_token=None, locked_at=None, last_error='', updated_at=timezone.now()
+    )
+    return True
+
+
+def run_pending(limit=10):
+    claimed = claim_jobs(limit)
+    return [run_job(item) for item in claimed]
+
+
+#Delete done jobs older than RETENTION_DAYS, batch_size rows per DELETE. Their idempotency keys
+#go with them, so a key only dedupes enqueues within that window.
+def prune_jobs(batch_size=1000, retention_days=None):
+    days = get_setting('RETENTION_DAYS') if retention_days is None else retention_days
+    finished = Job.objects.filter(status=Job.Status.DONE, updated_at__lt=timezone.now() - timedelta(days=days))
+    deleted = 0
+    while True:
+        ids = list(finished.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            break
+        deleted += Job.objects.filter(pk__in=ids).delete()[0]
+        if len(ids) < batch_size:
+            break
+    return deleted
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from api.models import Order, order_items_total_expression
+
+
+class Command(BaseCommand):
+    help = "Backfill Order.total from the order items in batches, or verify it with --verify."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--verify', action='store_true', help="Only report orders whose stored total is wrong.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        verify = options['verify']
+        processed = mismatched = 0
+        last_pk = None
+
+        #Walk the orders by primary key so every batch is an index range scan
+        while True:
+            batch = Order.objects.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            pks = list(batch.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            orders = Order.objects.filter(pk__in=pks)
+
+            wrong = list(
+                orders.annotate(expected=order_items_total_expression()).exclude(total=F('expected')).values_list('pk', flat=True)
+            )
+            mismatched += len(wrong)
+            if wrong and not verify:
+                with transaction.atomic():
+                    Order.objects.filter(pk__in=wrong).refresh_totals()
+            processed += len(pks)
+            self.stdout.write(f"{processed} orders checked, {mismatched} mismatched")
+
+        if verify:
+            style = self.style.SUCCESS if not mismatched else self.style.ERROR
+            self.stdout.write(style(f"Verified {processed} orders: {mismatched} with a wrong total."))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Backfilled {processed} orders, fixed {mismatched}."))
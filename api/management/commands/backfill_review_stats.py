@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.models import Product, latest_review_expression, review_count_expression
+
+
+class Command(BaseCommand):
+    help = "Backfill Product.review_count and last_reviewed_at from the reviews in batches, or verify them with --verify."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--verify', action='store_true', help="Only report products whose stored stats are wrong.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        verify = options['verify']
+        processed = mismatched = 0
+        last_pk = None
+
+        #Walk the products by primary key so every batch is an index range scan
+        while True:
+            batch = Product.objects.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            pks = list(batch.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            products = Product.objects.filter(pk__in=pks).annotate(
+                expected_count=review_count_expression(), expected_latest=latest_review_expression()
+            )
+
+            wrong = [
+                pk for pk, count, latest, expected_count, expected_latest in products.values_list(
+                    'pk', 'review_count', 'last_reviewed_at', 'expected_count', 'expected_latest'
+                )
+                if (count, latest) != (expected_count, expected_latest)
+            ]
+            mismatched += len(wrong)
+            if wrong and not verify:
+                with transaction.atomic():
+                    Product.objects.filter(pk__in=wrong).refresh_review_stats()
+            processed += len(pks)
+            self.stdout.write(f"{processed} products checked, {mismatched} mismatched")
+
+        if verify:
+            style = self.style.SUCCESS if not mismatched else self.style.ERROR
+            self.stdout.write(style(f"Verified {processed} products: {mismatched} with wrong review stats."))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Backfilled {processed} products, fixed {mismatched}."))
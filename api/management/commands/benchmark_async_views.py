@@ -0,0 +1,80 @@
+import asyncio
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client
+
+
+def summarize(label, latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'label': label,
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 2),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the sync (WSGI handler) and async (ASGI handler) versions of a catalog page "
+        "in-process: requests per second and p50/p99 latency at a given concurrency."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sync-path', default='/products/')
+        parser.add_argument('--async-path', default='/async/products/')
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--json', action='store_true', help="Print machine readable results.")
+
+    def handle(self, *args, **options):
+        total = options['requests']
+        concurrency = options['concurrency']
+        results = [
+            self.run_sync(options['sync_path'], total, concurrency),
+            asyncio.run(self.run_async(options['async_path'], total, concurrency)),
+        ]
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        for result in results:
+            self.stdout.write(
+                f"{result['label']:<6} {result['requests']} requests  {result['rps']} req/s  "
+                f"p50 {result['p50_ms']} ms  p99 {result['p99_ms']} ms"
+            )
+
+    def run_sync(self, path, total, concurrency):
+        def worker(count):
+            client = Client(HTTP_HOST='localhost')
+            latencies = []
+            for _ in range(count):
+                started = time.perf_counter()
+                client.get(path)
+                latencies.append(time.perf_counter() - started)
+            return latencies
+
+        shares = [total // concurrency + (1 if i < total % concurrency else 0) for i in range(concurrency)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = [latency for chunk in pool.map(worker, shares) for latency in chunk]
+        return summarize('sync', latencies, time.perf_counter() - started)
+
+    async def run_async(self, path, total, concurrency):
+        client = AsyncClient(HTTP_HOST='localhost')
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+
+        async def one():
+            async with semaphore:
+                started = time.perf_counter()
+                await client.get(path)
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(total)))
+        return summarize('async', latencies, time.perf_counter() - started)
@@ -0,0 +1,135 @@
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.sqlite import get_setting, is_locked_error, pragmas
+
+
+#The rollback journal defaults Django gets from sqlite3.connect(): 5 second busy timeout
+DEFAULT_PROFILE = ['PRAGMA journal_mode=delete', 'PRAGMA synchronous=full']
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Concurrent read/write load against a scratch SQLite file (db.sqlite3 is never touched), "
+        "once with SQLite's defaults and once with the SQLITE_TUNING profile."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--duration', type=float, default=5.0, help="Seconds per profile.")
+        parser.add_argument('--rows', type=int, default=5000)
+        parser.add_argument('--write-ratio', type=float, default=0.2, help="Share of operations that are checkout-like writes.")
+        parser.add_argument('--json', action='store_true', help="Print machine readable results.")
+
+    def handle(self, *args, **options):
+        results = [
+            self.run_profile('default', DEFAULT_PROFILE, False, options),
+            self.run_profile('tuned', pragmas(), True, options),
+        ]
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        for result in results:
+            self.stdout.write(
+                f"{result['label']:<8} {result['reads_per_s']} reads/s  {result['writes_per_s']} writes/s  "
+                f"read p99 {result['read_p99_ms']} ms  write p99 {result['write_p99_ms']} ms  "
+                f"{result['lock_errors']} lock errors"
+            )
+
+    def run_profile(self, label, statements, immediate, options):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bench.sqlite3')
+            self.create_database(path, options['rows'])
+            stop = time.perf_counter() + options['duration']
+            results = []
+            lock = threading.Lock()
+
+            def worker(seed):
+                rng = random.Random(seed)
+                connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+                for statement in statements:
+                    connection.execute(statement)
+                reads, writes, errors = [], [], 0
+                while time.perf_counter() < stop:
+                    started = time.perf_counter()
+                    if rng.random() < options['write_ratio']:
+                        if self.write(connection, rng, options['rows'], immediate):
+                            writes.append(time.perf_counter() - started)
+                        else:
+                            errors += 1
+                    else:
+                        offset = rng.randrange(max(options['rows'] - 24, 1))
+                        connection.execute('SELECT id, name, price FROM items ORDER BY id LIMIT 24 OFFSET ?', [offset]).fetchall()
+                        reads.append(time.perf_counter() - started)
+                connection.close()
+                with lock:
+                    results.append((reads, writes, errors))
+
+            started = time.perf_counter()
+            threads = [threading.Thread(target=worker, args=(i,)) for i in range(options['threads'])]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+
+        reads = [latency for chunk in results for latency in chunk[0]]
+        writes = [latency for chunk in results for latency in chunk[1]]
+        return {
+            'label': label,
+            'reads_per_s': round(len(reads) / elapsed, 1),
+            'writes_per_s': round(len(writes) / elapsed, 1),
+            'read_p50_ms': round(statistics.median(reads) * 1000, 2) if reads else 0,
+            'read_p99_ms': round(percentile(reads, 0.99) * 1000, 2),
+            'write_p99_ms': round(percentile(writes, 0.99) * 1000, 2),
+            'lock_errors': sum(chunk[2] for chunk in results),
+        }
+
+    def create_database(self, path, rows):
+        connection = sqlite3.connect(path)
+        connection.executescript(
+            'CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT, price REAL, stock INTEGER);'
+            'CREATE TABLE orders (id INTEGER PRIMARY KEY, item_id INTEGER, created REAL);'
+        )
+        connection.executemany(
+            'INSERT INTO items (name, price, stock) VALUES (?, ?, ?)',
+            [(f'Item {i}', 9.99, 1_000_000) for i in range(rows)],
+        )
+        connection.commit()
+        connection.close()
+
+    #Same shape as checkout: read the stock, then decrement it and insert the order.
+    #Tuned: BEGIN IMMEDIATE plus retries; default: a deferred BEGIN that fails on lock upgrades.
+    def write(self, connection, rng, rows, immediate):
+        retries = get_setting('LOCK_RETRIES') if immediate else 0
+        for attempt in range(retries + 1):
+            item_id = rng.randrange(1, rows + 1)
+            try:
+                connection.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+                connection.execute('SELECT stock FROM items WHERE id = ?', [item_id]).fetchone()
+                connection.execute('UPDATE items SET stock = stock - 1 WHERE id = ?', [item_id])
+                connection.execute('INSERT INTO orders (item_id, created) VALUES (?, ?)', [item_id, time.time()])
+                connection.execute('COMMIT')
+                return True
+            except sqlite3.OperationalError as e:
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')
+                if not is_locked_error(e) or attempt == retries:
+                    return False
+                time.sleep(get_setting('RETRY_DELAY') * 2 ** attempt * rng.uniform(0.5, 1.5))
+        return False
@@ -0,0 +1,148 @@
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+
+import django
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from api.cache import catalog_cache
+from api.cart import add_to_cart, get_user_cart
+from api.checkout import checkout_cart
+from api.models import CustomUser, Product
+from api.seed import seed_database
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(timings, queries):
+    timings = sorted(timings)
+    return {
+        'runs': len(timings),
+        'min_ms': round(timings[0] * 1000, 3),
+        'median_ms': round(statistics.median(timings) * 1000, 3),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000, 3),
+        'queries': queries,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a throwaway test database and time the hot paths (catalog listing, cart add, checkout). "
+        "Writes JSON that --compare can check against a previous run to catch regressions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=5000)
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--order-items', type=int, default=20000)
+        parser.add_argument('--runs', type=int, default=50, help="Timed runs per benchmark.")
+        parser.add_argument('--output', help="Write the results to this JSON file.")
+        parser.add_argument('--compare', help="Previous results JSON; fail if a median got slower than --threshold.")
+        parser.add_argument('--threshold', type=float, default=0.25, help="Allowed slowdown, 0.25 = 25%%.")
+
+    def handle(self, *args, **options):
+        #Never benchmark against the real database: build a test database like the test runner does.
+        #The test environment also lets the test Client through ALLOWED_HOSTS and keeps mail local.
+        old_name = connection.settings_dict['NAME']
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            seed_database(
+                users=options['users'], products=options['products'],
+                order_items=options['order_items'], reviews=0, prefix='bench',
+            )
+            results = self.run_benchmarks(options['runs'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'volumes': {key: options[key] for key in ('products', 'users', 'order_items')},
+            'results': results,
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        self.stdout.write(output)
+        if options['compare']:
+            self.compare(results, options['compare'], options['threshold'])
+
+    def measure(self, runs, setup, action):
+        timings = []
+        queries = None
+        for i in range(runs):
+            state = setup()
+            if queries is None:
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    action(state)
+                    timings.append(time.perf_counter() - started)
+                queries = len(captured)
+                continue
+            started = time.perf_counter()
+            action(state)
+            timings.append(time.perf_counter() - started)
+        return summarize(timings, queries)
+
+    def run_benchmarks(self, runs):
+        rng = random.Random(0)
+        product_ids = list(Product.objects.filter(stock__gt=100).values_list('pk', flat=True)[:500])
+        shopper = CustomUser.objects.filter(username__startswith='bench').order_by('pk').first()
+        client = Client()
+        list_url = reverse('product-list')
+
+        def cold_cache():
+            cache.clear()
+            catalog_cache.clear_local()
+
+        def fill_cart():
+            cart = get_user_cart(shopper)
+            for product_id in rng.sample(product_ids, 5):
+                add_to_cart(cart, product_id)
+            return cart
+
+        return {
+            'catalog_listing_cold': self.measure(runs, cold_cache, lambda state: client.get(list_url)),
+            'catalog_listing_warm': self.measure(runs, lambda: None, lambda state: client.get(list_url)),
+            'api_product_list': self.measure(runs, cold_cache, lambda state: client.get(reverse('api-product-list'))),
+            'cart_add': self.measure(
+                runs, lambda: get_user_cart(shopper), lambda cart: add_to_cart(cart, rng.choice(product_ids))
+            ),
+            'checkout': self.measure(runs, fill_cart, lambda cart: checkout_cart(cart, shopper)),
+        }
+
+    def compare(self, results, path, threshold):
+        with open(path) as f:
+            baseline = json.load(f)['results']
+        regressions = []
+        for name, result in results.items():
+            if name not in baseline or not baseline[name]['median_ms']:
+                continue
+            ratio = result['median_ms'] / baseline[name]['median_ms']
+            queries_grew = (result['queries'] or 0) > (baseline[name]['queries'] or 0)
+            self.stdout.write(f"{name:<24} {ratio:6.2f}x  queries {baseline[name]['queries']} -> {result['queries']}")
+            if ratio > 1 + threshold or queries_grew:
+                regressions.append(name)
+        if regressions:
+            raise CommandError(f"Regressed: {', '.join(regressions)}")
+        self.stdout.write(self.style.SUCCESS("No regressions."))
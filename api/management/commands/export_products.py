@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import Product
+from api.product_io import detect_format, export_products
+
+
+class Command(BaseCommand):
+    help = "Stream every product (or one category) to a CSV or JSONL file, or - for stdout."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help="Defaults to the file extension.")
+        parser.add_argument('--category')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = detect_format(path, options['format'])
+        queryset = Product.objects.all()
+        if options['category']:
+            category = Product.normalize_category(options['category'])
+            if category is None:
+                raise CommandError(f"Unknown category {options['category']!r}.")
+            queryset = queryset.filter(category=category)
+
+        started = time.monotonic()
+        if path == '-':
+            export_products(self.stdout, fmt, queryset, options['chunk_size'])
+            return
+        with open(path, 'w', newline='', encoding='utf-8') as target:
+            count = export_products(target, fmt, queryset, options['chunk_size'])
+        seconds = time.monotonic() - started
+        rate = count / seconds if seconds else 0
+        self.stdout.write(self.style.SUCCESS(f"Exported {count} products in {seconds:.1f}s ({rate:,.0f} rows/s)."))
@@ -0,0 +1,69 @@
+import csv
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import CustomUser
+from api.product_io import detect_format, import_products
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream products from a CSV or JSONL file (or - for stdin) and upsert them by id in batches. "
+        "Invalid rows are reported and skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help="Defaults to the file extension.")
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--seller', help="Username used for rows without a seller (otherwise they keep the stored one).")
+        parser.add_argument('--rejects', help="Write rejected rows with their errors to this CSV file.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = detect_format(path, options['format'])
+        shown = 0
+        rejects_file = open(options['rejects'], 'w', newline='', encoding='utf-8') if options['rejects'] else None
+        rejects_writer = None
+        if rejects_file:
+            rejects_writer = csv.writer(rejects_file)
+            rejects_writer.writerow(['line', 'errors', 'row'])
+
+        def on_reject(number, row, errors):
+            nonlocal shown
+            if rejects_writer:
+                rejects_writer.writerow([number, ' | '.join(errors), json.dumps(row)])
+            elif shown < 20:
+                shown += 1
+                self.stderr.write(f"line {number}: {' | '.join(errors)}")
+
+        def on_batch(result):
+            if options['verbosity'] > 1:
+                self.stdout.write(
+                    f"{result.read} rows read, {result.imported} imported, {result.rejected} rejected "
+                    f"({result.rate:,.0f} rows/s)"
+                )
+
+        source = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        try:
+            result = import_products(
+                source, fmt,
+                batch_size=options['batch_size'],
+                seller=options['seller'],
+                on_reject=on_reject,
+                on_batch=on_batch,
+            )
+        except CustomUser.DoesNotExist:
+            raise CommandError(f"Unknown seller {options['seller']!r}.")
+        finally:
+            if source is not sys.stdin:
+                source.close()
+            if rejects_file:
+                rejects_file.close()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {result.imported} of {result.read} rows in {result.seconds:.1f}s "
+            f"({result.rate:,.0f} rows/s), {result.rejected} rejected."
+        ))
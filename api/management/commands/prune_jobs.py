@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from api.jobs import prune_jobs
+
+
+class Command(BaseCommand):
+    help = "Delete done background jobs older than JOB_QUEUE['RETENTION_DAYS'] in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help="Keep done jobs this many days instead.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        deleted = prune_jobs(options['batch_size'], options['days'])
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} done jobs."))
@@ -0,0 +1,52 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.analytics import get_setting, order_date_range, rebuild_days, update_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the sales rollups from the orders, a chunk of days per transaction, "
+        "or with --pending only count the orders whose status changed since they were counted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="First day to rebuild (YYYY-MM-DD), default the first order.")
+        parser.add_argument('--until', help="Last day to rebuild (YYYY-MM-DD), default the latest order.")
+        parser.add_argument('--chunk-days', type=int, default=None)
+        parser.add_argument('--pending', action='store_true', help="Catch up with pending orders instead of rebuilding.")
+
+    def parse_day(self, value, option):
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            raise CommandError(f"{option}: not a YYYY-MM-DD date: {value}")
+
+    def handle(self, *args, **options):
+        if options['pending']:
+            counted = batch = update_rollups()
+            while batch == get_setting('BATCH_SIZE'):
+                batch = update_rollups()
+                counted += batch
+            self.stdout.write(self.style.SUCCESS(f"Counted {counted} pending orders."))
+            return
+
+        first, last = order_date_range()
+        if options['since']:
+            first = self.parse_day(options['since'], '--since')
+        if options['until']:
+            last = self.parse_day(options['until'], '--until')
+        if first is None or last is None:
+            self.stdout.write("No orders, nothing to rebuild.")
+            return
+        chunk = timedelta(days=options['chunk_days'] or get_setting('CHUNK_DAYS'))
+
+        rows = 0
+        start = first
+        while start <= last:
+            end = min(start + chunk - timedelta(days=1), last)
+            rows += rebuild_days(start, end)
+            self.stdout.write(f"{start} .. {end}: {rows} rollup rows so far")
+            start = end + timedelta(days=1)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt the sales rollups from {first} to {last}: {rows} rows."))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product full text search index, e.g. after bulk imports that skip signals."
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            get_search_backend().rebuild()
+        self.stdout.write(self.style.SUCCESS("Search index rebuilt."))
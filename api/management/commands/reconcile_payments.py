@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from api.models import Payment
+from api.payments import apply_events, get_gateway, get_setting, latest_events
+from api.product_io import batched
+
+
+class Command(BaseCommand):
+    help = (
+        "Match the gateway's settlements against the stored payments and orders in batches: "
+        "one lookup, one upsert and the order status updates per batch. --dry-run only reports."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="Only settlements that changed at or after this ISO 8601 time.")
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--dry-run', action='store_true', help="Report differences without writing anything.")
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError(f"--since: not an ISO 8601 datetime: {options['since']}")
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+        batch_size = options['batch_size'] or get_setting('BATCH_SIZE')
+        dry_run = options['dry_run']
+        gateway = get_gateway()
+        settled = missing = changed = mismatched = unmatched = 0
+
+        for batch in batched(gateway.settlements(since), batch_size):
+            batch = latest_events(batch)
+            stored = {
+                transaction_id: (status, amount, order_total)
+                for transaction_id, status, amount, order_total in Payment.objects.filter(
+                    transaction_id__in=[event.transaction_id for event in batch]
+                ).values_list('transaction_id', 'status', 'amount', 'order__total')
+            }
+            for event in batch:
+                if event.transaction_id not in stored:
+                    missing += 1
+                    continue
+                status, amount, order_total = stored[event.transaction_id]
+                if status != event.status:
+                    changed += 1
+                if event.amount != amount or (order_total is not None and event.amount != order_total):
+                    mismatched += 1
+                    self.stdout.write(self.style.WARNING(
+                        f"{event.transaction_id}: settled {event.amount}, recorded {amount}, order total {order_total}"
+                    ))
+            if not dry_run:
+                unmatched += len(apply_events(batch, gateway.name))
+            settled += len(batch)
+            self.stdout.write(f"{settled} settlements checked")
+
+        summary = (
+            f"{settled} settlements: {missing} missing payments, {changed} status changes, "
+            f"{mismatched} amount mismatches"
+        )
+        if dry_run:
+            self.stdout.write(f"Dry run, nothing written. {summary}.")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Reconciled {summary}, {unmatched} without a known order."))
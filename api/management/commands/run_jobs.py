@@ -0,0 +1,49 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from api.jobs import claim_jobs, run_job
+
+
+class Command(BaseCommand):
+    help = "Run queued background jobs (order emails, payments, stock alerts)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4, help="Number of jobs run at the same time.")
+        parser.add_argument('--batch-size', type=int, default=20, help="Jobs claimed per poll.")
+        parser.add_argument('--poll-interval', type=float, default=1.0, help="Seconds to sleep when the queue is empty.")
+        parser.add_argument('--once', action='store_true', help="Drain the due jobs and exit.")
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options['concurrency'])
+        done = failed = 0
+
+        def work(claimed):
+            close_old_connections()
+            try:
+                return run_job(claimed)
+            finally:
+                if concurrency > 1:
+                    connection.close()
+
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='job-worker') if concurrency > 1 else None
+        try:
+            while True:
+                claimed = claim_jobs(options['batch_size'])
+                if not claimed:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+                results = list(executor.map(work, claimed)) if executor else [run_job(item) for item in claimed]
+                done += results.count(True)
+                failed += results.count(False)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if executor:
+                executor.shutdown(wait=True)
+
+        self.stdout.write(self.style.SUCCESS(f"Ran {done} jobs, {failed} failed."))
@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import CustomUser
+from api.seed import seed_database
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the database with synthetic users, products, orders and reviews for benchmarks. "
+        "Defaults to 10k users, 100k products and 1M order items."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--products', type=int, default=100000)
+        parser.add_argument('--order-items', type=int, default=1000000)
+        parser.add_argument('--reviews', type=int, default=50000)
+        parser.add_argument('--seed', type=int, default=0, help="Random seed, the same seed gives the same data.")
+        parser.add_argument('--prefix', default='seed', help="Username prefix for the generated users.")
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        if CustomUser.objects.filter(username__startswith=options['prefix']).exists():
+            raise CommandError(f"Users named {options['prefix']}* already exist, pass another --prefix.")
+        started = time.monotonic()
+        counts = seed_database(
+            users=options['users'],
+            products=options['products'],
+            order_items=options['order_items'],
+            reviews=options['reviews'],
+            seed=options['seed'],
+            prefix=options['prefix'],
+            batch_size=options['batch_size'],
+            progress=lambda message: self.stdout.write(f"  {message} ({time.monotonic() - started:.1f}s)"),
+        )
+        summary = ', '.join(f"{value} {name.replace('_', ' ')}" for name, value in counts.items())
+        self.stdout.write(self.style.SUCCESS(f"Seeded {summary} in {time.monotonic() - started:.1f}s."))
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.reservations import reconcile_counters, sweep_expired_holds
+
+
+class Command(BaseCommand):
+    help = "Release expired stock holds and recompute the cached stock counters in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--reconcile', action='store_true', help="Also recompute the counters of every product with holds.")
+        parser.add_argument('--interval', type=float, default=0, help="Keep sweeping every N seconds instead of once.")
+
+    def handle(self, *args, **options):
+        while True:
+            released = sweep_expired_holds(options['batch_size'])
+            message = f"Released {released} expired holds."
+            if options['reconcile']:
+                message += f" Reconciled {reconcile_counters(options['batch_size'])} products."
+            self.stdout.write(message)
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
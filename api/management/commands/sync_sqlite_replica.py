@@ -0,0 +1,41 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the SQLite primary into the SQLite replica files with the online backup API. "
+        "A local stand-in for replication when trying the read replica router."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0, help="Keep copying every N seconds instead of once.")
+
+    def handle(self, *args, **options):
+        aliases = getattr(settings, 'REPLICA_DATABASES', [])
+        if not aliases:
+            raise CommandError("No REPLICA_DATABASES configured (set DB_REPLICA=1).")
+        if any(connections[alias].vendor != 'sqlite' for alias in ['default', *aliases]):
+            raise CommandError("Only SQLite primaries and replicas can be synced this way.")
+
+        while True:
+            started = time.monotonic()
+            source = sqlite3.connect(settings.DATABASES['default']['NAME'])
+            try:
+                for alias in aliases:
+                    connections[alias].close()
+                    target = sqlite3.connect(settings.DATABASES[alias]['NAME'])
+                    try:
+                        source.backup(target)
+                    finally:
+                        target.close()
+            finally:
+                source.close()
+            self.stdout.write(f"Synced {', '.join(aliases)} in {time.monotonic() - started:.2f}s")
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
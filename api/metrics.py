@@ -0,0 +1,262 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+#Per request instrumentation: wall time, query count and time, template time and catalog
+#cache hits/misses. Each response gets a Server-Timing header and every request is folded
+#into per URL name totals that metrics_view serves in the Prometheus text format.
+#Disabled (the default) the middleware removes itself at startup, so it costs nothing.
+#Totals are per process; scrape every worker.
+
+DEFAULTS = {
+    'ENABLED': False,
+    'SERVER_TIMING': True,
+    #Log queries slower than this; None turns the log off
+    'SLOW_QUERY_MS': 100,
+    #Latest request durations kept per URL name for the percentiles
+    'SAMPLE_SIZE': 1000,
+}
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def get_setting(name):
+    return getattr(settings, 'INSTRUMENTATION', {}).get(name, DEFAULTS[name])
+
+
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.duplicate_queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.seen_sql = set()
+
+
+_current = ContextVar('request_stats', default=None)
+
+
+def record_cache_access(hit):
+    stats = _current.get()
+    if stats is not None:
+        if hit:
+            stats.cache_hits += 1
+        else:
+            stats.cache_misses += 1
+
+
+class QueryTimer:
+    def __init__(self, stats, alias):
+        self.stats = stats
+        self.alias = alias
+        self.slow_ms = get_setting('SLOW_QUERY_MS')
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            stats = self.stats
+            stats.queries += 1
+            stats.db_time += elapsed
+            #The same parametrized SQL twice in one request is usually a loop doing N+1 lookups
+            if sql in stats.seen_sql:
+                stats.duplicate_queries += 1
+            else:
+                stats.seen_sql.add(sql)
+            if self.slow_ms is not None and elapsed * 1000 >= self.slow_ms:
+                logger.warning("Slow query (%.1f ms) on %s: %s", elapsed * 1000, self.alias, sql)
+
+
+_templates_instrumented = False
+
+
+#Times the outermost Template.render of a request; includes are part of their parent
+def instrument_templates():
+    global _templates_instrumented
+    if _templates_instrumented:
+        return
+    from django.template.base import Template
+    original = Template.render
+
+    def render(self, context):
+        stats = _current.get()
+        if stats is None:
+            return original(self, context)
+        stats.template_depth += 1
+        started = time.perf_counter()
+        try:
+            return original(self, context)
+        finally:
+            stats.template_depth -= 1
+            if not stats.template_depth:
+                stats.template_time += time.perf_counter() - started
+
+    Template.render = render
+    _templates_instrumented = True
+
+
+class ViewMetrics:
+    def __init__(self, sample_size):
+        self.count = 0
+        self.duration_sum = 0.0
+        self.queries = 0
+        self.duplicate_queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.samples = deque(maxlen=sample_size)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def record(self, view, duration, stats):
+        with self.lock:
+            metrics = self.views.get(view)
+            if metrics is None:
+                metrics = self.views[view] = ViewMetrics(get_setting('SAMPLE_SIZE'))
+            metrics.count += 1
+            metrics.duration_sum += duration
+            metrics.queries += stats.queries
+            metrics.duplicate_queries += stats.duplicate_queries
+            metrics.db_time += stats.db_time
+            metrics.template_time += stats.template_time
+            metrics.cache_hits += stats.cache_hits
+            metrics.cache_misses += stats.cache_misses
+            metrics.samples.append(duration)
+
+    def reset(self):
+        with self.lock:
+            self.views.clear()
+
+    #Copies of every view's totals plus its sorted samples, taken under the lock
+    def snapshot(self):
+        with self.lock:
+            return {
+                view: (dict(vars(metrics), samples=None), sorted(metrics.samples))
+                for view, metrics in self.views.items()
+            }
+
+    def render_prometheus(self):
+        snapshot = self.snapshot()
+        views = sorted(snapshot)
+        lines = [
+            '# HELP http_request_duration_seconds Request wall time per URL name.',
+            '# TYPE http_request_duration_seconds summary',
+        ]
+        for view in views:
+            totals, samples = snapshot[view]
+            label = prometheus_label(view)
+            for q in QUANTILES:
+                value = samples[min(len(samples) - 1, int(len(samples) * q))]
+                lines.append(f'http_request_duration_seconds{{view="{label}",quantile="{q}"}} {value:.6f}')
+            lines.append(f'http_request_duration_seconds_sum{{view="{label}"}} {totals["duration_sum"]:.6f}')
+            lines.append(f'http_request_duration_seconds_count{{view="{label}"}} {totals["count"]}')
+        counters = (
+            ('http_request_db_queries_total', 'Database queries run.', 'queries', 'd'),
+            ('http_request_db_duplicate_queries_total', 'Queries whose SQL already ran in the same request.', 'duplicate_queries', 'd'),
+            ('http_request_db_seconds_total', 'Time spent in the database.', 'db_time', '.6f'),
+            ('http_request_template_seconds_total', 'Time spent rendering templates.', 'template_time', '.6f'),
+            ('http_request_cache_hits_total', 'Catalog cache hits.', 'cache_hits', 'd'),
+            ('http_request_cache_misses_total', 'Catalog cache misses.', 'cache_misses', 'd'),
+        )
+        for name, help_text, attribute, fmt in counters:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for view in views:
+                lines.append(f'{name}{{view="{prometheus_label(view)}"}} {format(snapshot[view][0][attribute], fmt)}')
+        return '\n'.join(lines) + '\n'
+
+
+def prometheus_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+registry = MetricsRegistry()
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    return match.view_name or match._func_path
+
+
+def server_timing(duration, stats):
+    return ', '.join([
+        f'total;dur={duration * 1000:.1f}',
+        f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries, {stats.duplicate_queries} repeated"',
+        f'tpl;dur={stats.template_time * 1000:.1f}',
+        f'cache;desc="{stats.cache_hits} hits, {stats.cache_misses} misses"',
+    ])
+
+
+class InstrumentationMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not get_setting('ENABLED'):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        instrument_templates()
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def start(self):
+        stats = RequestStats()
+        token = _current.set(stats)
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(QueryTimer(stats, connection.alias)))
+        return stats, token, stack, time.perf_counter()
+
+    def finish(self, request, response, stats, token, stack, started):
+        stack.close()
+        _current.reset(token)
+        duration = time.perf_counter() - started
+        registry.record(view_name(request), duration, stats)
+        if get_setting('SERVER_TIMING'):
+            response['Server-Timing'] = server_timing(duration, stats)
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats, token, stack, started = self.start()
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            stack.close()
+            _current.reset(token)
+            raise
+        return self.finish(request, response, stats, token, stack, started)
+
+    async def __acall__(self, request):
+        stats, token, stack, started = self.start()
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            stack.close()
+            _current.reset(token)
+            raise
+        return self.finish(request, response, stats, token, stack, started)
@@ -0,0 +1,40 @@
+from django.db import migrations
+
+
+#Full text index for api.search: an FTS5 table on SQLite, a GIN expression index on Postgres
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS api_product_fts USING fts5("
+            "product_id UNINDEXED, name, description, prefix='2 3', tokenize='porter unicode61')"
+        )
+        schema_editor.execute(
+            "INSERT INTO api_product_fts (product_id, name, description) "
+            "SELECT id, name, description FROM api_product"
+        )
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS api_product_search_idx ON api_product USING GIN (("
+            "setweight(to_tsvector('english'::regconfig, COALESCE(name, '')), 'A') || "
+            "setweight(to_tsvector('english'::regconfig, COALESCE(description, '')), 'B')))"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS api_product_fts")
+    elif vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS api_product_search_idx")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_product_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations
+
+
+#Key the FTS5 rows by api.search.search_rowid() so index updates delete by rowid instead of
+#scanning the UNINDEXED product_id column. Same table, refilled with the new rowids.
+def search_rowid(hex_id):
+    return int.from_bytes(bytes.fromhex(hex_id)[8:], 'big', signed=True)
+
+
+def key_by_rowid(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("DELETE FROM api_product_fts")
+        cursor.execute("SELECT id, name, description FROM api_product")
+        while True:
+            rows = cursor.fetchmany(2000)
+            if not rows:
+                break
+            with schema_editor.connection.cursor() as insert:
+                insert.executemany(
+                    "INSERT INTO api_product_fts (rowid, product_id, name, description) VALUES (%s, %s, %s, %s)",
+                    [(search_rowid(pk), pk, name, description) for pk, name, description in rows],
+                )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_sales_rollups'),
+    ]
+
+    operations = [
+        #The old code deletes by product_id, which still finds these rows
+        migrations.RunPython(key_by_rowid, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,84 @@
+import hashlib
+from calendar import timegm
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+
+#Applies the serializer's declared queryset shape (select_related/prefetch_related/only)
+#to a DRF generic view, so the view never has to repeat it.
+class EagerLoadingQuerysetMixin:
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        serializer_class = self.get_serializer_class()
+        if hasattr(serializer_class, 'setup_eager_loading'):
+            queryset = serializer_class.setup_eager_loading(queryset)
+        return queryset
+
+
+#ETag / Last-Modified for list and detail endpoints, derived from each row's
+#modification timestamp. The page (or object) is still read, but when the client
+#already has it we answer 304 before any serialization work.
+class ConditionalGetMixin:
+    last_modified_field = 'updated_at'
+    #Responses that differ per user must include the user in the ETag
+    etag_per_user = True
+
+    #Modification time and ETag input of one object. Views whose payload also depends on
+    #other rows extend them.
+    def object_stamp(self, obj):
+        return getattr(obj, self.last_modified_field)
+
+    def object_validator(self, obj, stamp):
+        return f'{obj.pk}:{stamp.isoformat()}'
+
+    def get_validators(self, objects):
+        stamps = [self.object_stamp(obj) for obj in objects]
+        digest = hashlib.md5(usedforsecurity=False)
+        digest.update(self.request.get_full_path().encode())
+        if self.etag_per_user:
+            digest.update(str(getattr(self.request.user, 'pk', None)).encode())
+        for obj, stamp in zip(objects, stamps):
+            digest.update(self.object_validator(obj, stamp).encode())
+        last_modified = max(stamps) if stamps else None
+        return f'"{digest.hexdigest()}"', (timegm(last_modified.utctimetuple()) if last_modified else None)
+
+    def conditional_response(self, objects, build_response):
+        etag, last_modified = self.get_validators(objects)
+        return self.respond_conditionally(etag, last_modified, build_response)
+
+    def respond_conditionally(self, etag, last_modified, build_response):
+        response = get_conditional_response(self.request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = build_response()
+        response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        objects = list(page if page is not None else queryset)
+
+        def build_response():
+            serializer = self.get_serializer(objects, many=True)
+            if page is not None:
+                return self.get_paginated_response(serializer.data)
+            return Response(serializer.data)
+
+        return self.conditional_response(objects, build_response)
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        return self.conditional_response([instance], lambda: Response(self.get_serializer(instance).data))
+
+
+#?fields=name,price returns only those fields
+class SparseFieldsetViewMixin:
+    def get_serializer(self, *args, **kwargs):
+        fields = self.request.query_params.get('fields') if self.request else None
+        if fields:
+            kwargs['fields'] = [name.strip() for name in fields.split(',') if name.strip()]
+        return super().get_serializer(*args, **kwargs)
@@ -1,4 +1,12 @@
+import hashlib
+import os
+from decimal import Decimal
+from django.conf import settings
 from django.db import models
+from django.db.models import F, Q, Sum, DecimalField, ExpressionWrapper, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Now
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django.contrib.auth.models import PermissionsMixin, AbstractBaseUser, BaseUserManager
 import uuid
 from django.core.validators import RegexValidator
@@ -52,9 +60,40 @@ class CustomUserManager(BaseUserManager):
     
         
 
+#Uploaded images are stored under the hash of their content, so a URL never changes
+#meaning and can be cached forever. The upload is read in chunks from the temporary
+#file Django streamed it to, never loaded whole into memory.
+def content_hash(field_file):
+    digest = hashlib.sha256()
+    upload = field_file.file
+    upload.seek(0)
+    for chunk in upload.chunks() if hasattr(upload, 'chunks') else iter(lambda: upload.read(65536), b''):
+        digest.update(chunk)
+    upload.seek(0)
+    return digest.hexdigest()[:32]
+
+
+def hashed_image_name(field_file, filename):
+    extension = os.path.splitext(filename)[1].lower() or '.img'
+    return f'{content_hash(field_file)}{extension}'
+
+
 def get_profile_image_path(self, filename):
-    return f'profile_images/{self.pk}/{"profile_image.png"}'
+    return f'profile_images/{hashed_image_name(self.profile_image, filename)}'
+
 
+def get_product_image_path(self, filename):
+    return f'products/{hashed_image_name(self.image, filename)}'
+
+
+
+#URL of a resized variant, falling back to the original until the worker has made it
+def variant_url(image, variants, size):
+    if not image:
+        return ''
+    if variants.get('source') == image.name and size in variants:
+        return settings.MEDIA_URL + variants[size]
+    return image.url
 
 
 # Create your models here.
@@ -76,6 +115,8 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
     last_login = models.DateTimeField(auto_now=True,null=True, blank=True)
     phone_number = models.CharField(validators=[phone_regex], max_length=15, blank=True)
     profile_image = models.ImageField(upload_to=get_profile_image_path, blank=True, null=True)
+    #Resized WebP copies written by api.images, {"source": <image name>, "<size>": <name>}
+    profile_image_variants = models.JSONField(default=dict, blank=True, editable=False)
     date_of_birth = models.DateField(blank=True, null=True)
     hide_email = models.BooleanField(default=True)
     
@@ -89,11 +130,54 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
         return self.username
     
     def get_profile_image_filename(self):
-        return str(self.profile_image)[str(self.profile_image).index(f'profile_image/{self.pk}/'):]
+        return os.path.basename(str(self.profile_image))
+
+    @property
+    def avatar_url(self):
+        return variant_url(self.profile_image, self.profile_image_variants, 'thumb')
     
 
 
 
+#Sum of quantity * price over an order's items, as a correlated subquery
+def order_items_total_expression():
+    amount = DecimalField(max_digits=12, decimal_places=2)
+    item_totals = (
+        OrderItem.objects.filter(order=OuterRef('pk'))
+        .values('order')
+        .annotate(amount=Sum(F('quantity') * F('price'), output_field=amount))
+        .values('amount')
+    )
+    return Coalesce(Subquery(item_totals), Decimal('0'), output_field=amount)
+
+
+#Orders whose current status isn't what the sales rollups count them under
+ROLLUP_PENDING = Q(rolled_up_status__isnull=True) | ~Q(rolled_up_status=F('status'))
+
+
+class OrderQuerySet(models.QuerySet):
+    #Recompute the stored totals from the order items in one UPDATE for the whole queryset
+    def refresh_totals(self):
+        return self.update(total=order_items_total_expression(), updated_at=Now())
+
+    #Take the orders out of the sales rollups in one go before deleting them. The pre_delete
+    #signal then finds them uncounted instead of doing it an order at a time.
+    def delete(self):
+        from .analytics import uncount_orders
+        from .sqlite import write_transaction
+        with write_transaction():
+            uncount_orders(self.values('pk'))
+            return super().delete()
+
+    #Order history rows: the stored total plus the number of units annotated by a subquery
+    #on the order's items, so a page of summaries is one query and no items are loaded
+    def summaries(self):
+        units = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order').annotate(n=Sum('quantity')).values('n')
+        return self.only('order_id', 'user_id', 'created_at', 'updated_at', 'status', 'total').annotate(
+            item_count=Coalesce(Subquery(units), 0)
+        )
+
+
 class Order(models.Model):
     class Status(models.TextChoices):
         PENDING = 'Pending'
@@ -107,6 +191,12 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     status = models.CharField(max_length=20, choices=Status.choices, default=Status.PENDING)
+    #Sum of the order item subtotals, kept up to date by the OrderItem signals in signals.py
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    #The status this order is counted under in SalesRollup, None until it is counted (see analytics.py)
+    rolled_up_status = models.CharField(max_length=20, choices=Status.choices, null=True, blank=True, editable=False)
+
+    objects = OrderQuerySet.as_manager()
 
     @property
     def order_items(self):
@@ -115,11 +205,25 @@ class Order(models.Model):
 
     @property
     def total_price(self):
-        return sum(item.item_subtotal for item in self.orderitem_set.all())
+        return self.total
 
 
     def __str__(self):
-        return f'Order {self.order_id} {self.status} made by {self.user.username} on {self.created_at}'
+        customer = self.user.username if self.user_id else 'a guest'
+        return f'Order {self.order_id} {self.status} made by {customer} on {self.created_at}'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['total'], name='order_total_idx'),
+            #Order history, newest first: per customer, and per status for staff. The primary
+            #key breaks ties between orders placed in the same instant.
+            models.Index(fields=['user', '-created_at', '-order_id'], name='order_user_created_idx'),
+            models.Index(fields=['status', '-created_at', '-order_id'], name='order_status_created_idx'),
+            #Every order, newest first (the admin changelist)
+            models.Index(fields=['-created_at', '-order_id'], name='order_created_idx'),
+            #Only the orders the sales rollups haven't caught up with yet
+            models.Index(fields=['created_at'], condition=ROLLUP_PENDING, name='order_rollup_pending_idx'),
+        ]
     
 
 
@@ -148,6 +252,27 @@ class Address(models.Model):
         return f'{self.street_address}, {self.city}, {self.region}'
 
 #Manage Items Availabe for sale
+#Review count and newest review time of the outer product, read with index lookups on
+#review_product_created_idx
+def review_count_expression():
+    counts = Review.objects.filter(product=OuterRef('pk')).order_by().values('product').annotate(n=models.Count('pk')).values('n')
+    return Coalesce(Subquery(counts), 0)
+
+
+def latest_review_expression():
+    return Subquery(Review.objects.filter(product=OuterRef('pk')).order_by('-created').values('created')[:1])
+
+
+class ProductQuerySet(models.QuerySet):
+    #The products a seller manages; admins pass everything=True to manage the whole catalog
+    def managed_by(self, user, everything=False):
+        return self if everything else self.filter(seller_id=user.pk)
+
+    #Recompute the stored review stats in one UPDATE, for writes that bypass the Review signals
+    def refresh_review_stats(self):
+        return self.update(review_count=review_count_expression(), last_reviewed_at=latest_review_expression(), updated_at=Now())
+
+
 class Product(models.Model):
     class Categories(models.TextChoices):
         ELECTRONICS = 'Electronics & Accessories'
@@ -164,27 +289,115 @@ class Product(models.Model):
     description = models.TextField()
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.PositiveIntegerField()
-    image = models.ImageField(upload_to='products/', blank=True, null=True)
+    image = models.ImageField(upload_to=get_product_image_path, blank=True, null=True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     category = models.CharField(max_length=40, choices=Categories.choices)
+    updated_at = models.DateTimeField(auto_now=True)
+    #Maintained by the Review signals in signals.py so product cards never count reviews
+    review_count = models.PositiveIntegerField(default=0, editable=False)
+    last_reviewed_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    objects = ProductQuerySet.as_manager()
+
+    #Remember the stored category so a save that moves the product can invalidate both category caches
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_category = instance.__dict__.get('category')
+        instance._loaded_search_text = (instance.__dict__.get('name'), instance.__dict__.get('description'))
+        return instance
 
     @property
     def in_stock(self):
         return self.stock > 0
+
+    @property
+    def thumbnail_url(self):
+        return variant_url(self.image, self.image_variants, 'thumb')
+
+    @property
+    def card_image_url(self):
+        return variant_url(self.image, self.image_variants, 'card')
+
+    @property
+    def large_image_url(self):
+        return variant_url(self.image, self.image_variants, 'large')
+
+    #Map a category from the URL onto the stored choice value so lookups can use
+    #an exact match (and the category index) instead of category__iexact
+    @classmethod
+    def normalize_category(cls, value):
+        if not value:
+            return None
+        value = value.strip().lower()
+        for choice_value, label in cls.Categories.choices:
+            if value in (choice_value.lower(), label.lower(), cls.Categories(choice_value).name.lower()):
+                return choice_value
+        return None
     
     def __str__(self):
         return self.name
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['category', 'id', 'price'], name='product_category_id_price_idx'),
+        ]
+
+
+#quantity * price computed by the database instead of per item in Python
+def line_subtotal_expression(prefix=''):
+    return ExpressionWrapper(
+        F(f'{prefix}quantity') * F(f'{prefix}product__price'),
+        output_field=DecimalField(max_digits=12, decimal_places=2),
+    )
+
+
+class CartQuerySet(models.QuerySet):
+    def with_totals(self):
+        #Grand total per cart in the same query as the carts themselves
+        return self.annotate(
+            total_amount=Coalesce(
+                Sum(line_subtotal_expression('cartitem__')),
+                Decimal('0'),
+                output_field=DecimalField(max_digits=12, decimal_places=2),
+            )
+        )
+
+
+class CartItemQuerySet(models.QuerySet):
+    def with_subtotals(self):
+        return self.select_related('product').annotate(line_subtotal=line_subtotal_expression())
+
 
 class Cart(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=True, blank=True)
-    session_key = models.CharField(max_length=40, null=True, blank=True)
+    session_key = models.CharField(max_length=40, null=True, blank=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CartQuerySet.as_manager()
+
+    #Items with their products and subtotals, loaded once per cart instance
+    @cached_property
+    def line_items(self):
+        return list(self.cartitem_set.with_subtotals())
+
     @property
     def get_total(self):
-        return sum(item.subtotal for item in self.cartitem_set.all())
+        if hasattr(self, 'total_amount'):
+            return self.total_amount
+        if 'line_items' in self.__dict__:
+            return sum((item.subtotal for item in self.line_items), Decimal('0'))
+        return self.cartitem_set.aggregate(
+            total=Coalesce(
+                Sum(line_subtotal_expression()),
+                Decimal('0'),
+                output_field=DecimalField(max_digits=12, decimal_places=2),
+            )
+        )['total']
 
     def __str__(self):
+        if self.user_id is None:
+            return f'Anonymous cart {self.session_key}'
         return f'Cart of {self.user.email}'
 
 class CartItem(models.Model):
@@ -192,24 +405,56 @@ class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
 
+    objects = CartItemQuerySet.as_manager()
+
     @property
     def subtotal(self):
+        if hasattr(self, 'line_subtotal'):
+            return self.line_subtotal
         return self.quantity * self.product.price
     
     def __str__(self):
-        return f'{self.cart.user.email} added {self.quantity} x {self.product.name} to their cart'
+        return f'{self.cart} has {self.quantity} x {self.product.name}'
     
     class Meta:
         unique_together = ('cart', 'product')
     
 
 
+#A short lived hold on stock for one cart line, see api/reservations.py
+class StockReservation(models.Model):
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.quantity} x {self.product_id} held for cart {self.cart_id} until {self.expires_at}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='reservation_cart_product_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['product', 'expires_at'], name='reservation_product_exp_idx'),
+            models.Index(fields=['expires_at'], name='reservation_expires_at_idx'),
+        ]
+
+
 class OrderItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='items')
     price = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField()
 
+    #Remember what was loaded so a later save only applies the difference to Order.total
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_state = (instance.__dict__.get('order_id'), instance.__dict__.get('quantity'), instance.__dict__.get('price'))
+        return instance
+
     @property
     def item_subtotal(self):
         return self.quantity * self.price
@@ -230,6 +475,10 @@ class Payment(models.Model):
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     status = models.CharField(max_length=20, choices=PaymentStatus.choices, default=PaymentStatus.PENDING)
     transaction_id = models.CharField(max_length=128, unique=True, null=True, blank=True)
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='payments')
+    gateway = models.CharField(max_length=32, blank=True, default='')
+    #When the gateway produced the state stored here, events older than this are ignored (see payments.py)
+    gateway_updated_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -237,7 +486,10 @@ class Payment(models.Model):
         return f'{self.transaction_id} total is {self.amount} for {self.user.username}'
     
     class Meta:
-        ordering = ['-created_at']
+        ordering = ['-created_at', '-id']
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='payment_created_idx'),
+        ]
 
 
 class Review(models.Model):
@@ -246,5 +498,74 @@ class Review(models.Model):
     comment = models.TextField()
     created = models.DateTimeField(auto_now_add=True)
 
+    #Remember the stored product so a save that moves the review can fix both products' stats
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_product_id = instance.__dict__.get('product_id')
+        return instance
+
+    def __str__(self):
+        return f"Review by {self.user.username} about {self.product.name}"
+
+    class Meta:
+        indexes = [
+            #Per product feed, newest first, and the review stats subqueries
+            models.Index(fields=['product', '-created'], name='review_product_created_idx'),
+        ]
+
+#Background work queued in the database (see jobs.py). Rows are inserted in the same
+#transaction as the change that needs them, and a worker picks them up afterwards.
+class Job(models.Model):
+    class Status(models.TextChoices):
+        QUEUED = 'Queued'
+        RUNNING = 'Running'
+        DONE = 'Done'
+        FAILED = 'Failed'
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    idempotency_key = models.CharField(max_length=200, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    claim_token = models.UUIDField(null=True, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
     def __str__(self):
-        return f"Review by {self.user.username} about {self.product.name}"
\ No newline at end of file
+        return f'{self.name} ({self.status}, attempt {self.attempts})'
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='job_status_run_at_idx'),
+            models.Index(fields=['claim_token'], name='job_claim_token_idx'),
+        ]
+
+
+#Sales per day, product category, seller and order status, maintained by api/analytics.py so
+#reports read a few rows per day instead of aggregating the order tables.
+#order_count is the number of orders with a line in the bucket.
+class SalesRollup(models.Model):
+    day = models.DateField()
+    category = models.CharField(max_length=40, choices=Product.Categories.choices)
+    seller = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    status = models.CharField(max_length=20, choices=Order.Status.choices)
+    order_count = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f'{self.day} {self.category} seller {self.seller_id} {self.status}: {self.revenue}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'category', 'seller', 'status'], name='sales_rollup_key_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['category', 'day'], name='sales_rollup_category_day_idx'),
+            models.Index(fields=['seller', 'day'], name='sales_rollup_seller_day_idx'),
+        ]
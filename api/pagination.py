@@ -0,0 +1,151 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+import uuid
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.pagination import CursorPagination
+
+
+#Keyset (cursor) pagination for the HTML catalog views.
+#Instead of OFFSET, each page is fetched with "WHERE key > last_seen ORDER BY key LIMIT n"
+#so deep pages cost the same as the first one when the key is indexed.
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+
+@dataclass
+class KeysetPage:
+    items: list = field(default_factory=list)
+    next_cursor: str = None
+    previous_cursor: str = None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def parse_cursor(value):
+    #Cursors are the primary key of the boundary row, anything else is ignored
+    if not value:
+        return None
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        return None
+
+
+def get_page_size(request, default=DEFAULT_PAGE_SIZE):
+    try:
+        size = int(request.GET.get('page_size', default))
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def keyset_query(queryset, request, key='id', page_size=None):
+    page_size = page_size or get_page_size(request)
+    after = parse_cursor(request.GET.get('after'))
+    before = parse_cursor(request.GET.get('before'))
+    if before is not None:
+        #Walk backwards from the cursor, build_keyset_page flips the rows back
+        return queryset.filter(**{f'{key}__lt': before}).order_by(f'-{key}')[:page_size + 1], page_size, after, before
+    if after is not None:
+        queryset = queryset.filter(**{f'{key}__gt': after})
+    return queryset.order_by(key)[:page_size + 1], page_size, after, before
+
+
+def build_keyset_page(rows, page_size, after, before, key='id'):
+    has_more = len(rows) > page_size
+    items = rows[:page_size]
+    if before is not None:
+        items = items[::-1]
+    page = KeysetPage(items=items)
+    if not items:
+        return page
+    if before is not None:
+        page.next_cursor = str(getattr(items[-1], key))
+        if has_more:
+            page.previous_cursor = str(getattr(items[0], key))
+    else:
+        if has_more:
+            page.next_cursor = str(getattr(items[-1], key))
+        if after is not None:
+            page.previous_cursor = str(getattr(items[0], key))
+    return page
+
+
+def keyset_paginate(queryset, request, key='id', page_size=None):
+    rows, page_size, after, before = keyset_query(queryset, request, key, page_size)
+    return build_keyset_page(list(rows), page_size, after, before, key)
+
+
+async def akeyset_paginate(queryset, request, key='id', page_size=None):
+    rows, page_size, after, before = keyset_query(queryset, request, key, page_size)
+    return build_keyset_page([row async for row in rows], page_size, after, before, key)
+
+
+#Newest first keyset pagination over (timestamp, primary key), for histories where many
+#rows can share a timestamp. The cursor is "<microseconds since epoch>_<pk>" of the last
+#row shown; pages only go forward ("older").
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def timeline_cursor(row, key):
+    return f'{(getattr(row, key) - EPOCH) // timedelta(microseconds=1)}_{row.pk}'
+
+
+def parse_timeline_cursor(value, model):
+    try:
+        micros, pk = value.split('_', 1)
+        return EPOCH + timedelta(microseconds=int(micros)), model._meta.pk.to_python(pk)
+    except (AttributeError, ValueError, OverflowError, ValidationError):
+        return None
+
+
+def timeline_paginate(queryset, request, key='created_at', page_size=None):
+    page_size = page_size or get_page_size(request)
+    cursor = parse_timeline_cursor(request.GET.get('after'), queryset.model)
+    if cursor is not None:
+        stamp, pk = cursor
+        #The plain range condition lets the (..., key) index seek, the OR only breaks ties
+        queryset = queryset.filter(**{f'{key}__lte': stamp}).filter(Q(**{f'{key}__lt': stamp}) | Q(pk__lt=pk))
+    rows = list(queryset.order_by(f'-{key}', '-pk')[:page_size + 1])
+    page = KeysetPage(items=rows[:page_size])
+    if len(rows) > page_size:
+        page.next_cursor = timeline_cursor(rows[page_size - 1], key)
+    return page
+
+
+#Cursor pagination for the REST API, same idea as keyset_paginate above
+class ApiCursorPagination(CursorPagination):
+    page_size = DEFAULT_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = MAX_PAGE_SIZE
+    ordering = '-created_at'
+
+
+class ProductCursorPagination(ApiCursorPagination):
+    ordering = 'id'
+
+
+class ReviewCursorPagination(ApiCursorPagination):
+    ordering = '-created'
+
+
+class CartCursorPagination(ApiCursorPagination):
+    ordering = '-updated_at'
+
+
+class OrderCursorPagination(ApiCursorPagination):
+    ordering = ('-created_at', '-order_id')
@@ -0,0 +1,290 @@
+import hashlib
+import hmac
+import json
+import threading
+import uuid
+from dataclasses import dataclass
+from datetime import timezone as dt_timezone
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router
+from django.db.models import CharField, Value
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
+
+from .analytics import schedule_rollups
+from .models import Order, Payment
+from .sqlite import retry_if_locked, write_transaction
+
+
+#Payment gateways and the bookkeeping of what they tell us.
+#A gateway charges orders, signs the webhooks it sends and lists its settlements. Whatever
+#the source (charge result, webhook, settlement report), gateway state arrives as PaymentEvents
+#and goes through apply_events(): one INSERT ... ON CONFLICT (transaction_id) DO UPDATE for the
+#whole batch, guarded by the event time so redeliveries and late, older events change nothing,
+#then one UPDATE per payment status for the orders they belong to. Nothing runs per event.
+
+DEFAULTS = {
+    'GATEWAY': 'api.payments.LocalGateway',
+    'WEBHOOK_SECRET': None,
+    'BATCH_SIZE': 1000,
+}
+
+Status = Payment.PaymentStatus
+
+#Order status a payment status moves the order to, and the order statuses it moves it from
+ORDER_TRANSITIONS = {
+    Status.COMPLETED: (Order.Status.PAID, [Order.Status.PENDING]),
+    Status.REFUNDED: (Order.Status.CANCELLED, [Order.Status.PENDING, Order.Status.PAID]),
+}
+
+
+def get_setting(name):
+    return getattr(settings, 'PAYMENTS', {}).get(name, DEFAULTS[name])
+
+
+#Webhooks are verified with a secret shared with the gateway only, never one derived from SECRET_KEY
+def webhook_secret():
+    secret = get_setting('WEBHOOK_SECRET')
+    if not secret:
+        raise ImproperlyConfigured("PAYMENTS['WEBHOOK_SECRET'] must be set to sign or verify payment webhooks.")
+    return secret.encode()
+
+
+@dataclass(frozen=True)
+class PaymentEvent:
+    transaction_id: str
+    status: str
+    amount: Decimal
+    occurred_at: object
+    order_id: uuid.UUID = None
+
+    @classmethod
+    def from_dict(cls, data):
+        try:
+            transaction_id = str(data['transaction_id'])
+            status = data['status']
+            amount = Decimal(str(data['amount']))
+            occurred_at = parse_datetime(data['occurred_at'])
+            order_id = uuid.UUID(str(data['order_id'])) if data.get('order_id') else None
+        except (KeyError, TypeError, InvalidOperation) as e:
+            raise ValueError(f'invalid payment event: {e!r}')
+        if not transaction_id or len(transaction_id) > 128:
+            raise ValueError('invalid transaction_id')
+        if status not in Status.values:
+            raise ValueError(f'unknown payment status {status!r}')
+        if occurred_at is None:
+            raise ValueError('invalid occurred_at')
+        if timezone.is_naive(occurred_at):
+            occurred_at = timezone.make_aware(occurred_at, dt_timezone.utc)
+        return cls(transaction_id, status, amount, occurred_at, order_id)
+
+    def to_dict(self):
+        return {
+            'transaction_id': self.transaction_id,
+            'status': self.status,
+            'amount': str(self.amount),
+            'occurred_at': self.occurred_at.isoformat(),
+            'order_id': str(self.order_id) if self.order_id else None,
+        }
+
+
+#Gateway interface. Subclasses talk to the payment provider; webhook signing is HMAC-SHA256
+#of the raw body here, override verify_signature/parse_webhook for providers that differ.
+class PaymentGateway:
+    name = None
+    signature_header = 'X-Payment-Signature'
+
+    #Charge an order. Retrying with the same idempotency key must not charge twice.
+    def charge(self, order, idempotency_key):
+        raise NotImplementedError
+
+    #Settled transactions (any status) that changed at or after since, oldest first
+    def settlements(self, since=None):
+        raise NotImplementedError
+
+    def sign(self, body):
+        return hmac.new(webhook_secret(), body, hashlib.sha256).hexdigest()
+
+    #Without a configured secret nothing can be verified, so every webhook is rejected
+    def verify_signature(self, body, signature):
+        if not signature or not get_setting('WEBHOOK_SECRET'):
+            return False
+        return hmac.compare_digest(self.sign(body), signature)
+
+    #Body: one event object or {"events": [...]}. Raises ValueError for anything else.
+    def parse_webhook(self, body):
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            raise ValueError('webhook body is not JSON')
+        items = payload.get('events') if isinstance(payload, dict) and 'events' in payload else [payload]
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise ValueError('expected an event object or a list of them')
+        return [PaymentEvent.from_dict(item) for item in items]
+
+
+#In-process gateway for development and tests. Charges succeed for any positive total,
+#transaction ids are the idempotency keys, and every process shares one ledger.
+class LocalGateway(PaymentGateway):
+    name = 'local'
+    _lock = threading.Lock()
+    _ledger = {}
+
+    def charge(self, order, idempotency_key):
+        with self._lock:
+            event = self._ledger.get(idempotency_key)
+            if event is None:
+                status = Status.COMPLETED if order.total > 0 else Status.FAILED
+                event = PaymentEvent(idempotency_key, status, order.total, timezone.now(), order.pk)
+                self._ledger[idempotency_key] = event
+        return event
+
+    #Change a transaction on the gateway side (a refund, a late failure) like the provider would
+    def update(self, transaction_id, status, amount=None):
+        with self._lock:
+            previous = self._ledger[transaction_id]
+            event = PaymentEvent(
+                transaction_id, status, previous.amount if amount is None else amount, timezone.now(), previous.order_id
+            )
+            self._ledger[transaction_id] = event
+        return event
+
+    def settlements(self, since=None):
+        with self._lock:
+            events = list(self._ledger.values())
+        return sorted((event for event in events if since is None or event.occurred_at >= since), key=lambda event: event.occurred_at)
+
+    #Body and signature of the webhook the gateway would send for these events
+    def webhook(self, events):
+        body = json.dumps({'events': [event.to_dict() for event in events]}).encode()
+        return body, self.sign(body)
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._ledger.clear()
+
+
+def get_gateway():
+    return import_string(get_setting('GATEWAY'))()
+
+
+#Keep the newest event of every transaction, Postgres refuses to upsert one row twice in a statement
+def latest_events(events):
+    latest = {}
+    for event in events:
+        current = latest.get(event.transaction_id)
+        if current is None or event.occurred_at > current.occurred_at:
+            latest[event.transaction_id] = event
+    return list(latest.values())
+
+
+UPSERT_COLUMNS = ['id', 'transaction_id', 'user', 'order', 'amount', 'status', 'gateway', 'gateway_updated_at', 'created_at', 'updated_at']
+
+
+def upsert_sql(connection, rows):
+    quote = connection.ops.quote_name
+    table = quote(Payment._meta.db_table)
+    fields = [Payment._meta.get_field(name) for name in UPSERT_COLUMNS]
+    row = '(' + ', '.join(['%s'] * len(fields)) + ')'
+    #amount and user stay as first recorded; reconcile_payments reports amounts that differ
+    return (
+        f"INSERT INTO {table} ({', '.join(quote(field.column) for field in fields)}) VALUES {', '.join([row] * rows)} "
+        f"ON CONFLICT ({quote('transaction_id')}) DO UPDATE SET "
+        f"{quote('status')} = excluded.{quote('status')}, "
+        f"{quote('gateway_updated_at')} = excluded.{quote('gateway_updated_at')}, "
+        f"{quote('updated_at')} = excluded.{quote('updated_at')}, "
+        f"{quote('order_id')} = COALESCE({table}.{quote('order_id')}, excluded.{quote('order_id')}) "
+        f"WHERE {table}.{quote('gateway_updated_at')} IS NULL "
+        f"OR {table}.{quote('gateway_updated_at')} < excluded.{quote('gateway_updated_at')}"
+    )
+
+
+#Store a batch of gateway events: one query for the owners, then the upsert. Events that name
+#an order take its customer; refunds and disputes often arrive without one and are matched to
+#the payment already recorded under their transaction_id (same query, a UNION).
+#Events for unknown orders (or orders without a customer) and unknown orderless transactions
+#can't become payments and are returned.
+def record_events(events, gateway_name=''):
+    events = latest_events(events)
+    orders = (
+        Order.objects.filter(pk__in={event.order_id for event in events if event.order_id}, user__isnull=False)
+        .order_by().values_list('pk', 'user_id', Value(None, output_field=CharField()))
+    )
+    payments = (
+        Payment.objects.filter(transaction_id__in=[event.transaction_id for event in events if not event.order_id])
+        .order_by().values_list('order_id', 'user_id', 'transaction_id')
+    )
+    customers = {}
+    known = {}
+    for order_id, user_id, transaction_id in orders.union(payments, all=True):
+        if transaction_id is None:
+            customers[order_id] = (user_id, order_id)
+        else:
+            known[transaction_id] = (user_id, order_id)
+    owners = {}
+    for event in events:
+        owner = customers.get(event.order_id) if event.order_id else known.get(event.transaction_id)
+        if owner:
+            owners[event.transaction_id] = owner
+    matched = [event for event in events if event.transaction_id in owners]
+    if matched:
+        upsert_payments(matched, owners, gateway_name)
+    return [event for event in events if event.transaction_id not in owners]
+
+
+def upsert_payments(events, owners, gateway_name):
+    connection = connections[router.db_for_write(Payment)]
+    now = timezone.now()
+    payments = [
+        Payment(
+            id=uuid.uuid4(), transaction_id=event.transaction_id, user_id=user_id, order_id=order_id,
+            amount=event.amount, status=event.status, gateway=gateway_name, gateway_updated_at=event.occurred_at,
+            created_at=now, updated_at=now,
+        )
+        for event in events
+        for user_id, order_id in [owners[event.transaction_id]]
+    ]
+    if connection.vendor not in ('sqlite', 'postgresql'):
+        #No conditional ON CONFLICT here (MySQL): last write wins
+        Payment.objects.bulk_create(
+            payments, update_conflicts=True, unique_fields=['transaction_id'],
+            update_fields=['status', 'gateway_updated_at', 'updated_at'],
+        )
+        return
+    fields = [Payment._meta.get_field(name) for name in UPSERT_COLUMNS]
+    size = connection.ops.bulk_batch_size(fields, payments)
+    with connection.cursor() as cursor:
+        for start in range(0, len(payments), size):
+            chunk = payments[start:start + size]
+            params = [field.get_db_prep_save(getattr(payment, field.attname), connection) for payment in chunk for field in fields]
+            cursor.execute(upsert_sql(connection, len(chunk)), params)
+
+
+#Move the orders of these events' payments along, one UPDATE per payment status in the batch.
+#The stored status decides, so a stale event can't move an order back.
+def sync_orders(events):
+    now = timezone.now()
+    changed = 0
+    for payment_status in {event.status for event in events} & ORDER_TRANSITIONS.keys():
+        order_status, from_statuses = ORDER_TRANSITIONS[payment_status]
+        changed += Order.objects.filter(
+            status__in=from_statuses,
+            payments__transaction_id__in=[event.transaction_id for event in events],
+            payments__status=payment_status,
+        ).update(status=order_status, updated_at=now)
+    return changed
+
+
+@retry_if_locked
+def apply_events(events, gateway_name=''):
+    with write_transaction():
+        unmatched = record_events(events, gateway_name)
+        if len(unmatched) < len(events):
+            if sync_orders(events):
+                schedule_rollups()
+    return unmatched
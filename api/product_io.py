@@ -0,0 +1,252 @@
+import csv
+import json
+import time
+import uuid
+from dataclasses import dataclass
+from itertools import islice
+
+from django import forms
+from django.db import transaction
+
+from .cache import invalidate_products
+from .forms import ProductForm, validate_price, validate_stock
+from .models import CustomUser, Product
+from .reservations import forget_counters
+from .search import get_search_backend
+
+
+#Streaming product import/export for supplier feeds (manage.py import_products / export_products).
+#Rows are read lazily and handled a batch at a time: every column of the batch goes through
+#the ProductForm field rules, sellers are resolved with one query, and the valid rows are
+#upserted with a single bulk INSERT ... ON CONFLICT (two when only some rows name a seller).
+#Bad rows are reported and skipped, they never abort the rest of the batch.
+
+FIELDS = ['id', 'name', 'description', 'price', 'stock', 'category', 'seller']
+UPDATE_FIELDS = ['name', 'description', 'price', 'stock', 'category', 'updated_at']
+
+#Form field plus the extra ProductForm.clean_<field> rule, if any
+COLUMN_RULES = {
+    'name': (ProductForm.base_fields['name'], None),
+    'description': (ProductForm.base_fields['description'], None),
+    'price': (ProductForm.base_fields['price'], validate_price),
+    'stock': (ProductForm.base_fields['stock'], validate_stock),
+}
+
+
+@dataclass
+class ImportResult:
+    read: int = 0
+    imported: int = 0
+    rejected: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rate(self):
+        return self.read / self.seconds if self.seconds else 0.0
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    return 'jsonl' if str(path).endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+#Yields (line number, row dict or None, parse error)
+def read_rows(stream, fmt):
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row, None
+        return
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield number, None, f'invalid JSON: {e}'
+            continue
+        if not isinstance(row, dict):
+            yield number, None, 'expected a JSON object'
+        else:
+            yield number, row, None
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def error_text(error):
+    return '; '.join(error.messages)
+
+
+def clean_column(rows, errors, name):
+    field, rule = COLUMN_RULES[name]
+    values = []
+    for index, row in enumerate(rows):
+        try:
+            value = field.clean(row.get(name))
+            if rule is not None:
+                value = rule(value)
+        except forms.ValidationError as e:
+            errors[index].append(f'{name}: {error_text(e)}')
+            value = None
+        values.append(value)
+    return values
+
+
+def clean_ids(rows, errors):
+    ids = []
+    for index, row in enumerate(rows):
+        value = row.get('id')
+        if not value:
+            ids.append(uuid.uuid4())
+            continue
+        try:
+            ids.append(uuid.UUID(str(value)))
+        except ValueError:
+            errors[index].append('id: not a valid UUID.')
+            ids.append(None)
+    return ids
+
+
+def clean_categories(rows, errors):
+    categories = []
+    for index, row in enumerate(rows):
+        category = Product.normalize_category(row.get('category'))
+        if category is None:
+            errors[index].append(f"category: unknown category {row.get('category')!r}.")
+        categories.append(category)
+    return categories
+
+
+#One query per batch for every seller username mentioned in it. A blank seller is None
+#(keep the stored one) unless the import has a default seller.
+def clean_sellers(rows, errors, default_seller=None):
+    names = {row.get('seller') for row in rows if row.get('seller')}
+    known = dict(CustomUser.objects.filter(username__in=names).values_list('username', 'pk')) if names else {}
+    sellers = []
+    for index, row in enumerate(rows):
+        name = row.get('seller')
+        if not name:
+            sellers.append(default_seller)
+        elif name in known:
+            sellers.append(known[name])
+        else:
+            errors[index].append(f'seller: unknown user {name!r}.')
+            sellers.append(None)
+    return sellers
+
+
+#Returns the valid products and a list of (row index, errors) for the rest
+def validate_batch(rows, default_seller=None):
+    errors = [[] for row in rows]
+    columns = {name: clean_column(rows, errors, name) for name in COLUMN_RULES}
+    ids = clean_ids(rows, errors)
+    categories = clean_categories(rows, errors)
+    sellers = clean_sellers(rows, errors, default_seller)
+
+    #A feed may repeat an id; the last row wins, as it would with row by row saves
+    products = {}
+    rejects = []
+    for index, row in enumerate(rows):
+        if errors[index]:
+            rejects.append((index, errors[index]))
+            continue
+        products[ids[index]] = Product(
+            id=ids[index],
+            name=columns['name'][index],
+            description=columns['description'][index],
+            price=columns['price'][index],
+            stock=columns['stock'][index],
+            category=categories[index],
+            seller_id=sellers[index],
+        )
+    return list(products.values()), rejects
+
+
+#Products without a seller_id keep the seller they have, so a partial feed with blank
+#seller cells never clears the sellers of existing products
+def upsert_products(products):
+    if not products:
+        return
+    with_seller = [product for product in products if product.seller_id is not None]
+    without_seller = [product for product in products if product.seller_id is None]
+    with transaction.atomic():
+        for group, update_fields in ((with_seller, UPDATE_FIELDS + ['seller']), (without_seller, UPDATE_FIELDS)):
+            if group:
+                Product.objects.bulk_create(
+                    group, update_conflicts=True, unique_fields=['id'], update_fields=update_fields
+                )
+        #bulk_create skips the Product signals, so sync search, the catalog cache and the stock counters here
+        get_search_backend().index_products(products)
+        transaction.on_commit(lambda: invalidate_products(products))
+        transaction.on_commit(lambda: forget_counters([product.pk for product in products]))
+
+
+def import_products(stream, fmt='csv', batch_size=2000, seller=None, on_reject=None, on_batch=None):
+    default_seller = CustomUser.objects.only('pk').get(username=seller).pk if seller else None
+    result = ImportResult()
+    started = time.monotonic()
+    for batch in batched(read_rows(stream, fmt), batch_size):
+        result.read += len(batch)
+        rows = []
+        numbers = []
+        for number, row, error in batch:
+            if error:
+                result.rejected += 1
+                if on_reject:
+                    on_reject(number, row, [error])
+            else:
+                rows.append(row)
+                numbers.append(number)
+
+        products, rejects = validate_batch(rows, default_seller)
+        for index, errors in rejects:
+            result.rejected += 1
+            if on_reject:
+                on_reject(numbers[index], rows[index], errors)
+        upsert_products(products)
+        result.imported += len(products)
+
+        result.seconds = time.monotonic() - started
+        if on_batch:
+            on_batch(result)
+    result.seconds = time.monotonic() - started
+    return result
+
+
+def export_rows(queryset, chunk_size=2000):
+    rows = queryset.order_by('pk').values_list(
+        'id', 'name', 'description', 'price', 'stock', 'category', 'seller__username'
+    )
+    for row in rows.iterator(chunk_size=chunk_size):
+        product_id, name, description, price, stock, category, seller = row
+        yield {
+            'id': str(product_id),
+            'name': name,
+            'description': description,
+            'price': str(price),
+            'stock': stock,
+            'category': category,
+            'seller': seller or '',
+        }
+
+
+def export_products(stream, fmt='csv', queryset=None, chunk_size=2000):
+    rows = export_rows(Product.objects.all() if queryset is None else queryset, chunk_size)
+    count = 0
+    if fmt == 'csv':
+        writer = csv.DictWriter(stream, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            stream.write(json.dumps(row) + '\n')
+            count += 1
+    return count
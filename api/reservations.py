@@ -0,0 +1,304 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Product, StockReservation
+from .sqlite import retry_if_locked, write_transaction
+
+
+#Stock holds for cart lines. Adding to a cart places (or grows) a StockReservation row for
+#that (product, cart) which expires after HOLD_TTL unless the cart is touched again.
+#
+#Admission is decided by two counters per product in the shared cache instead of by locking
+#the product row: "limit" (Product.stock) and "held" (sum of the product's holds). A claim is
+#one incr of "held" and is refused, and undone, if it passes "limit". Every add on a hot SKU
+#therefore costs a cache round trip plus a write to its own cart's hold row.
+#
+#The counters are only a best effort admission gate. incr is atomic on Redis and memcached but
+#a get and set on others (the FileBasedCache configured here), where concurrent claims can lose
+#updates. Drift in either direction is bounded: before refusing, a claim reseeds the counters
+#from the database and tries once more, so a lost release can't turn adds away until the
+#counters expire, and a lost claim only admits a hold that checkout may still refuse. The
+#counters also expire after COUNTER_TIMEOUT and are recomputed in batches by the sweeper. The
+#checkout stock UPDATE remains what actually prevents oversell.
+#
+#Admission compares an incremented "held" with "limit" rather than counting an "available"
+#number down past zero, so a cache whose decr stops at zero (memcached) still works.
+#
+#CACHE_ALIAS defaults to the session cache; it must be shared, see CACHES['sessions'] in settings.
+
+DEFAULTS = {
+    'CACHE_ALIAS': None,
+    'HOLD_TTL': 900,
+    'COUNTER_TIMEOUT': 60,
+}
+
+
+def get_setting(name):
+    return getattr(settings, 'STOCK_RESERVATIONS', {}).get(name, DEFAULTS[name])
+
+
+class InsufficientStockError(Exception):
+    def __init__(self, product_id, available):
+        self.product_id = product_id
+        self.available = max(available, 0)
+        super().__init__(f'Only {self.available} left in stock.')
+
+
+def counters():
+    return caches[get_setting('CACHE_ALIAS') or settings.SESSION_CACHE_ALIAS]
+
+
+def held_key(product_id):
+    return f'stock:held:{product_id}'
+
+
+def limit_key(product_id):
+    return f'stock:limit:{product_id}'
+
+
+def hold_expiry():
+    return timezone.now() + timedelta(seconds=get_setting('HOLD_TTL'))
+
+
+def counter_rows(product_ids):
+    return (
+        Product.objects.filter(pk__in=product_ids)
+        .annotate(held=Coalesce(Sum('reservations__quantity'), 0))
+        .values_list('pk', 'stock', 'held')
+    )
+
+
+def counter_values(rows):
+    values = {}
+    for product_id, stock, held in rows:
+        values[held_key(product_id)] = held
+        values[limit_key(product_id)] = stock
+    return values
+
+
+#Recompute both counters for a batch of products with one aggregate query
+def load_counters(product_ids):
+    values = counter_values(counter_rows(product_ids))
+    counters().set_many(values, get_setting('COUNTER_TIMEOUT'))
+    return values
+
+
+async def aload_counters(product_ids):
+    values = counter_values([row async for row in counter_rows(product_ids)])
+    await counters().aset_many(values, get_setting('COUNTER_TIMEOUT'))
+    return values
+
+
+#Stock changed outside a checkout (admin, product form, import): reseed on next use
+def forget_counters(product_ids):
+    counters().delete_many([key for product_id in product_ids for key in (held_key(product_id), limit_key(product_id))])
+
+
+def claim(product_id, quantity, reseeded=False):
+    cache = counters()
+    try:
+        held = cache.incr(held_key(product_id), quantity)
+        limit = cache.get(limit_key(product_id))
+    except ValueError:
+        limit = None
+    if limit is None:
+        if held_key(product_id) not in load_counters([product_id]):
+            raise Product.DoesNotExist(product_id)
+        reseeded = True
+        held = cache.incr(held_key(product_id), quantity)
+        limit = cache.get(limit_key(product_id), 0)
+    if held > limit:
+        cache.decr(held_key(product_id), quantity)
+        if not reseeded:
+            load_counters([product_id])
+            return claim(product_id, quantity, reseeded=True)
+        raise InsufficientStockError(product_id, limit - held + quantity)
+
+
+def unclaim(product_id, quantity):
+    if not quantity:
+        return
+    try:
+        counters().decr(held_key(product_id), quantity)
+    except ValueError:
+        pass
+
+
+async def aclaim(product_id, quantity, reseeded=False):
+    cache = counters()
+    try:
+        held = await cache.aincr(held_key(product_id), quantity)
+        limit = await cache.aget(limit_key(product_id))
+    except ValueError:
+        limit = None
+    if limit is None:
+        if held_key(product_id) not in await aload_counters([product_id]):
+            raise Product.DoesNotExist(product_id)
+        reseeded = True
+        held = await cache.aincr(held_key(product_id), quantity)
+        limit = await cache.aget(limit_key(product_id), 0)
+    if held > limit:
+        await cache.adecr(held_key(product_id), quantity)
+        if not reseeded:
+            await aload_counters([product_id])
+            return await aclaim(product_id, quantity, reseeded=True)
+        raise InsufficientStockError(product_id, limit - held + quantity)
+
+
+async def aunclaim(product_id, quantity):
+    if not quantity:
+        return
+    try:
+        await counters().adecr(held_key(product_id), quantity)
+    except ValueError:
+        pass
+
+
+#Shrink the cart's hold on a product by up to quantity and return how much it gave back:
+#only that much may leave "held", a smaller hold (or one the sweeper already removed) can't
+#return more than it had without letting later claims oversell
+@retry_if_locked
+def release_hold(cart, product_id, quantity):
+    holds = StockReservation.objects.filter(cart=cart, product_id=product_id)
+    with write_transaction():
+        held = holds.select_for_update().values_list('quantity', flat=True).first()
+        if held is None:
+            return 0
+        released = min(quantity, held)
+        if released < held:
+            holds.update(quantity=F('quantity') - released, expires_at=hold_expiry())
+        else:
+            holds.delete()
+    return released
+
+
+#Grow or shrink the cart's hold on a product by delta and push its expiry out.
+#The hold row is the cart's own, so concurrent carts never wait on each other here.
+def reserve(cart, product_id, delta):
+    if not delta:
+        return
+    if delta < 0:
+        unclaim(product_id, release_hold(cart, product_id, -delta))
+        return
+    claim(product_id, delta)
+    holds = StockReservation.objects.filter(cart=cart, product_id=product_id)
+    changes = {'quantity': F('quantity') + delta, 'expires_at': hold_expiry()}
+    try:
+        if not holds.update(**changes):
+            try:
+                with transaction.atomic():
+                    StockReservation.objects.create(
+                        cart=cart, product_id=product_id, quantity=delta, expires_at=changes['expires_at']
+                    )
+            except IntegrityError:
+                holds.update(**changes)
+    except Exception:
+        unclaim(product_id, delta)
+        raise
+
+
+#Shrinking reads the hold in a transaction, which the async ORM can't do: it runs on a thread
+async def areserve(cart, product_id, delta):
+    if not delta:
+        return
+    if delta < 0:
+        await aunclaim(product_id, await sync_to_async(release_hold)(cart, product_id, -delta))
+        return
+    await aclaim(product_id, delta)
+    holds = StockReservation.objects.filter(cart=cart, product_id=product_id)
+    changes = {'quantity': F('quantity') + delta, 'expires_at': hold_expiry()}
+    try:
+        if not await holds.aupdate(**changes):
+            try:
+                await StockReservation.objects.acreate(
+                    cart=cart, product_id=product_id, quantity=delta, expires_at=changes['expires_at']
+                )
+            except IntegrityError:
+                await holds.aupdate(**changes)
+    except Exception:
+        await aunclaim(product_id, delta)
+        raise
+
+
+#Login merges the anonymous cart into the user's: move its holds without claiming again
+def transfer_holds(source, target):
+    moved = list(StockReservation.objects.filter(cart=source).values_list('product_id', 'quantity'))
+    if not moved:
+        return
+    expires_at = hold_expiry()
+    StockReservation.objects.filter(cart=source).delete()
+    for product_id, quantity in moved:
+        holds = StockReservation.objects.filter(cart=target, product_id=product_id)
+        if not holds.update(quantity=F('quantity') + quantity, expires_at=expires_at):
+            StockReservation.objects.create(cart=target, product_id=product_id, quantity=quantity, expires_at=expires_at)
+
+
+#Holds that count against this cart's checkout: every unexpired hold of other carts,
+#plus all of this cart's own (their quantities are still in the "held" counters)
+def checkout_holds(cart, product_ids):
+    now = timezone.now()
+    own = defaultdict(int)
+    others = defaultdict(int)
+    rows = StockReservation.objects.filter(product_id__in=product_ids).values_list('product_id', 'cart_id', 'quantity', 'expires_at')
+    for product_id, cart_id, quantity, expires_at in rows:
+        if cart_id == cart.pk:
+            own[product_id] += quantity
+        elif expires_at > now:
+            others[product_id] += quantity
+    return own, others
+
+
+#After a committed checkout: its holds are gone and the stock went down by what was bought
+def settle_checkout(quantities, own_holds):
+    cache = counters()
+    for product_id, quantity in quantities.items():
+        if own_holds.get(product_id):
+            unclaim(product_id, own_holds[product_id])
+        try:
+            cache.decr(limit_key(product_id), quantity)
+        except ValueError:
+            pass
+
+
+#Delete expired holds in batches and recompute the counters of the products they touched
+def sweep_expired_holds(batch_size=1000):
+    released = 0
+    while True:
+        now = timezone.now()
+        expired = list(
+            StockReservation.objects.filter(expires_at__lte=now)
+            .order_by('expires_at')
+            .values_list('pk', 'product_id')[:batch_size]
+        )
+        if not expired:
+            break
+        deleted, _ = StockReservation.objects.filter(pk__in=[pk for pk, product_id in expired], expires_at__lte=now).delete()
+        load_counters({product_id for pk, product_id in expired})
+        released += deleted
+        if len(expired) < batch_size:
+            break
+    return released
+
+
+#Recompute the counters of every product that has holds, batch_size products per query
+def reconcile_counters(batch_size=1000):
+    product_ids = StockReservation.objects.order_by('product_id').values_list('product_id', flat=True).distinct()
+    last = None
+    reconciled = 0
+    while True:
+        batch = product_ids.filter(product_id__gt=last) if last is not None else product_ids
+        ids = list(batch[:batch_size])
+        if not ids:
+            break
+        load_counters(ids)
+        reconciled += len(ids)
+        last = ids[-1]
+    return reconciled
@@ -0,0 +1,260 @@
+import hashlib
+import uuid
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.core.cache import caches
+from django.core.exceptions import PermissionDenied
+from django.utils.functional import SimpleLazyObject
+from rest_framework.permissions import SAFE_METHODS, BasePermission
+
+
+#Role based authorization for views, templates and the REST API.
+#A user's roles come from CustomUser.role plus the is_seller/is_staff/is_superuser flags (admin
+#from is_staff/is_superuser alone), and each role grants the app permissions in ROLE_PERMISSIONS.
+#Both are kept in the session (with the user's Django model permissions once something asks for
+#one), so the nav bar and API checks read them without a query. Every user has a generation
+#token in the cache; the signals in signals.py drop it when a role, group or permission changes,
+#which makes every session of that user resolve again on its next request.
+#CACHE_ALIAS defaults to the session cache; it must be shared, see CACHES['sessions'] in settings.
+
+DEFAULTS = {
+    'CACHE_ALIAS': None,
+}
+
+ROLE_PERMISSIONS = {
+    'customer': {'shop', 'review'},
+    'seller': {'shop', 'review', 'manage_products', 'view_sales_reports'},
+    'admin': {
+        'shop', 'review', 'manage_products', 'manage_all_products', 'view_all_orders', 'view_metrics',
+        'view_sales_reports', 'view_all_sales',
+    },
+}
+
+#Bump when user_roles() changes how roles are derived
+ROLES_REVISION = 2
+
+#Part of every generation, so sessions resolve again when a deploy changes ROLE_PERMISSIONS or ROLES_REVISION
+ROLES_VERSION = hashlib.md5(repr((ROLES_REVISION, sorted((role, sorted(perms)) for role, perms in ROLE_PERMISSIONS.items()))).encode(), usedforsecurity=False).hexdigest()[:8]
+
+#Saving only these fields can change what a user is allowed to do
+ROLE_FIELDS = {'role', 'is_seller', 'is_staff', 'is_superuser', 'is_active'}
+
+SESSION_KEY = '_authorization'
+GLOBAL_KEY = 'authz:global'
+
+
+def get_setting(name):
+    return getattr(settings, 'ROLE_AUTHORIZATION', {}).get(name, DEFAULTS[name])
+
+
+def get_cache():
+    return caches[get_setting('CACHE_ALIAS') or settings.SESSION_CACHE_ALIAS]
+
+
+def generation_key(user_pk):
+    return f'authz:user:{user_pk}'
+
+
+class Authorization:
+    def __init__(self, roles=(), permissions=(), model_permissions=None, load_model_permissions=None):
+        self.roles = frozenset(roles)
+        self.permissions = frozenset(permissions)
+        self.model_permissions = frozenset(model_permissions) if model_permissions is not None else None
+        self.load_model_permissions = load_model_permissions
+
+    def has_role(self, *roles):
+        return not self.roles.isdisjoint(roles)
+
+    #App permissions are plain names, Django model permissions are "app_label.codename".
+    #The model permissions cost two queries, so they are only loaded when first asked for.
+    def has_perm(self, permission):
+        if '.' not in permission:
+            return permission in self.permissions
+        if self.model_permissions is None:
+            self.model_permissions = frozenset(self.load_model_permissions() if self.load_model_permissions else ())
+        return permission in self.model_permissions
+
+    @property
+    def is_seller(self):
+        return self.has_role('seller', 'admin')
+
+
+ANONYMOUS = Authorization()
+
+
+#'admin' comes from the staff flags only: users pick their own role when they register
+def user_roles(user):
+    roles = {user.role} - {'admin'}
+    if user.is_seller:
+        roles.add('seller')
+    if user.is_staff or user.is_superuser:
+        roles.add('admin')
+    return roles
+
+
+def role_permissions(roles):
+    return set().union(*(ROLE_PERMISSIONS.get(role, ()) for role in roles))
+
+
+#Tokens are created on first use and never expire on purpose: a missing token (evicted
+#or dropped by forget_authorization) just gets a new value, which no session has stored
+def make_generation(tokens, user_pk):
+    keys = (GLOBAL_KEY, generation_key(user_pk))
+    missing = {key: uuid.uuid4().hex for key in keys if not tokens.get(key)}
+    return keys, missing
+
+
+def current_generation(user_pk):
+    cache = get_cache()
+    tokens = cache.get_many([GLOBAL_KEY, generation_key(user_pk)])
+    keys, missing = make_generation(tokens, user_pk)
+    for key, token in missing.items():
+        if not cache.add(key, token, None):
+            token = cache.get(key) or token
+        tokens[key] = token
+    return ':'.join([ROLES_VERSION] + [tokens[key] for key in keys])
+
+
+async def acurrent_generation(user_pk):
+    cache = get_cache()
+    tokens = await cache.aget_many([GLOBAL_KEY, generation_key(user_pk)])
+    keys, missing = make_generation(tokens, user_pk)
+    for key, token in missing.items():
+        if not await cache.aadd(key, token, None):
+            token = await cache.aget(key) or token
+        tokens[key] = token
+    return ':'.join([ROLES_VERSION] + [tokens[key] for key in keys])
+
+
+#Drops the generation of the given users, or of everyone when called without any
+def forget_authorization(user_pks=None):
+    if user_pks is None:
+        get_cache().delete(GLOBAL_KEY)
+    else:
+        get_cache().delete_many([generation_key(pk) for pk in user_pks])
+
+
+def session_entry(user, generation):
+    roles = user_roles(user)
+    return {
+        'user': user.pk,
+        'generation': generation,
+        'roles': sorted(roles),
+        'permissions': sorted(role_permissions(roles)),
+        'model_permissions': None,
+    }
+
+
+def is_current(entry, user_pk, generation):
+    return bool(entry) and entry.get('user') == user_pk and entry.get('generation') == generation
+
+
+def session_authorization(user, session, entry):
+    def load_model_permissions():
+        permissions = sorted(user.get_all_permissions())
+        if session is not None:
+            session[SESSION_KEY] = dict(entry, model_permissions=permissions)
+        return permissions
+
+    return Authorization(entry['roles'], entry['permissions'], entry['model_permissions'], load_model_permissions)
+
+
+#Resolved once per request, from the session while its generation is current
+def get_authorization(request):
+    request = getattr(request, '_request', request)
+    if hasattr(request, '_authorization'):
+        return request._authorization
+    user = request.user
+    if not user.is_authenticated or not user.is_active:
+        request._authorization = ANONYMOUS
+        return ANONYMOUS
+    generation = current_generation(user.pk)
+    session = getattr(request, 'session', None)
+    entry = session.get(SESSION_KEY) if session is not None else None
+    if not is_current(entry, user.pk, generation):
+        entry = session_entry(user, generation)
+        if session is not None:
+            session[SESSION_KEY] = entry
+    request._authorization = session_authorization(user, session, entry)
+    return request._authorization
+
+
+async def aget_authorization(request):
+    if hasattr(request, '_authorization'):
+        return request._authorization
+    user = await request.auser()
+    if not user.is_authenticated or not user.is_active:
+        request._authorization = ANONYMOUS
+        return ANONYMOUS
+    generation = await acurrent_generation(user.pk)
+    session = getattr(request, 'session', None)
+    entry = await session.aget(SESSION_KEY) if session is not None else None
+    if not is_current(entry, user.pk, generation):
+        entry = session_entry(user, generation)
+        if session is not None:
+            await session.aset(SESSION_KEY, entry)
+    request._authorization = session_authorization(user, session, entry)
+    return request._authorization
+
+
+#Template context processor: {% if authz.is_seller %}, {% if 'view_metrics' in authz.permissions %}.
+#Resolved lazily, pages that never look at it don't pay for it.
+def authorization(request):
+    return {'authz': SimpleLazyObject(lambda: get_authorization(request))}
+
+
+#View decorators: anonymous users go to the login page, everyone else without the role gets a 403
+def authorization_required(test):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not request.user.is_authenticated:
+                return redirect_to_login(request.get_full_path())
+            if not test(get_authorization(request)):
+                raise PermissionDenied
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def role_required(*roles):
+    return authorization_required(lambda authorization: authorization.has_role(*roles))
+
+
+def app_permission_required(permission):
+    return authorization_required(lambda authorization: authorization.has_perm(permission))
+
+
+seller_required = role_required('seller', 'admin')
+
+
+#DRF permission classes
+#Set roles on a subclass or required_roles on the view
+class HasRole(BasePermission):
+    roles = ()
+
+    def has_permission(self, request, view):
+        roles = self.roles or getattr(view, 'required_roles', ())
+        return bool(request.user and request.user.is_authenticated) and get_authorization(request).has_role(*roles)
+
+
+class IsSeller(HasRole):
+    roles = ('seller', 'admin')
+
+
+class IsSellerOrReadOnly(IsSeller):
+    def has_permission(self, request, view):
+        return request.method in SAFE_METHODS or super().has_permission(request, view)
+
+
+#Object level: sellers may change their own products, admins any product
+class IsProductSellerOrAdmin(BasePermission):
+    def has_object_permission(self, request, view, obj):
+        if request.method in SAFE_METHODS:
+            return True
+        authorization = get_authorization(request)
+        return authorization.has_perm('manage_all_products') or (
+            authorization.has_perm('manage_products') and obj.seller_id == request.user.pk
+        )
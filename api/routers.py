@@ -0,0 +1,130 @@
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+
+#Primary/replica routing. Catalog and review reads go to one of REPLICA_DATABASES, every
+#write (and every read that must see it) goes to "default". With no replicas configured the
+#router stays out of the way and everything uses "default" as before.
+#
+#Replicas lag behind the primary, so a client that just wrote something is pinned to the
+#primary for REPLICA_STICKY_SECONDS: ReplicaPinMiddleware sets a short lived cookie on every
+#POST/PUT/PATCH/DELETE and pins any request that carries it.
+#
+#The catalog cache is filled from the primary (see cache.py): a miss right after a write bumped
+#a version would otherwise store the lagging replica's row under the new version for the whole
+#cache TIMEOUT, not just for the replica lag.
+
+DEFAULT_READ_MODELS = ('api.product', 'api.review')
+PIN_COOKIE = 'db_primary'
+
+_pinned = ContextVar('db_pinned_to_primary', default=False)
+
+
+def replicas():
+    return getattr(settings, 'REPLICA_DATABASES', [])
+
+
+def read_models():
+    return {label.lower() for label in getattr(settings, 'REPLICA_READ_MODELS', DEFAULT_READ_MODELS)}
+
+
+def sticky_seconds():
+    return getattr(settings, 'REPLICA_STICKY_SECONDS', 10)
+
+
+def pin_to_primary():
+    return _pinned.set(True)
+
+
+def unpin(token):
+    _pinned.reset(token)
+
+
+@contextmanager
+def reading_from_primary():
+    token = pin_to_primary()
+    try:
+        yield
+    finally:
+        unpin(token)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        aliases = replicas()
+        if not aliases or model._meta.label_lower not in read_models():
+            return None
+        #Reads inside a transaction on the primary must see that transaction's writes
+        if _pinned.get() or connections['default'].in_atomic_block:
+            return 'default'
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        #Replicas hold the same data as the primary, so objects from any of them can be related
+        pool = {'default', *replicas()}
+        if obj1._state.db in pool and obj2._state.db in pool:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        #Replicas get their schema from replication (or sync_sqlite_replica), never from migrate
+        if db in replicas():
+            return False
+        return None
+
+
+def request_is_pinned(request):
+    if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+        return True
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def mark_pinned(request, response):
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and replicas():
+        seconds = sticky_seconds()
+        response.set_cookie(PIN_COOKIE, str(int(time.time() + seconds)), max_age=seconds, httponly=True, samesite='Lax')
+    return response
+
+
+#Read-your-writes: requests that write, and the same client's requests for a few seconds
+#afterwards, read from the primary
+class ReplicaPinMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = pin_to_primary() if request_is_pinned(request) else None
+        try:
+            response = self.get_response(request)
+        finally:
+            if token is not None:
+                unpin(token)
+        return mark_pinned(request, response)
+
+    async def __acall__(self, request):
+        token = pin_to_primary() if request_is_pinned(request) else None
+        try:
+            response = await self.get_response(request)
+        finally:
+            if token is not None:
+                unpin(token)
+        return mark_pinned(request, response)
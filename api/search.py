@@ -0,0 +1,240 @@
+import re
+
+from django.db import connection
+from django.db.models import Case, CharField, Count, Value, When
+from django.db.models.expressions import RawSQL
+
+from .models import Product
+
+
+#Product search with a backend picked from the database in use:
+#SQLite FTS5 on the default db.sqlite3, tsvector + GIN on Postgres.
+#Both expose the same calls so views never care which one is active.
+
+FTS_TABLE = 'api_product_fts'
+
+PRICE_BUCKETS = (
+    ('0-25', 0, 25),
+    ('25-50', 25, 50),
+    ('50-100', 50, 100),
+    ('100-250', 100, 250),
+    ('250+', 250, None),
+)
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return WORD_RE.findall(text or '')
+
+
+#FTS5 rowid of a product: the low 64 bits of its UUID, so updates find the row by rowid instead
+#of scanning the product_id column. Those bits are random in a UUID4 (62 of them), two products
+#sharing one is vanishingly unlikely.
+def search_rowid(product_id):
+    return int.from_bytes(product_id.bytes[8:], 'big', signed=True)
+
+
+class BaseSearchBackend:
+    def index_product(self, product):
+        pass
+
+    def remove_product(self, product_id):
+        pass
+
+    def index_products(self, products):
+        for product in products:
+            self.index_product(product)
+
+    def rebuild(self):
+        pass
+
+    def matching(self, query):
+        raise NotImplementedError
+
+    def ranked_ids(self, query, category=None, limit=20, offset=0, prefix=False):
+        raise NotImplementedError
+
+    def autocomplete(self, prefix, limit=10):
+        raise NotImplementedError
+
+    def search(self, query, category=None, limit=20, offset=0):
+        ids = self.ranked_ids(query, category=category, limit=limit, offset=offset)
+        products = Product.objects.select_related('seller').in_bulk(ids)
+        return [products[pk] for pk in ids if pk in products]
+
+    #Counts per category and per price bucket over everything that matches the query
+    def facets(self, query):
+        matching = self.matching(query)
+        categories = dict(
+            matching.order_by().values_list('category').annotate(count=Count('pk'))
+        )
+        buckets = dict(
+            matching.order_by()
+            .annotate(bucket=price_bucket_expression())
+            .values_list('bucket')
+            .annotate(count=Count('pk'))
+        )
+        return {
+            'category': {value: categories.get(value, 0) for value, label in Product.Categories.choices},
+            'price': {label: buckets.get(label, 0) for label, low, high in PRICE_BUCKETS},
+        }
+
+
+def price_bucket_expression():
+    whens = []
+    for label, low, high in PRICE_BUCKETS:
+        if high is None:
+            whens.append(When(price__gte=low, then=Value(label)))
+        else:
+            whens.append(When(price__gte=low, price__lt=high, then=Value(label)))
+    return Case(*whens, output_field=CharField())
+
+
+class SqliteSearchBackend(BaseSearchBackend):
+    #The FTS5 table is created by migration 0007 and keyed by search_rowid() since 0017;
+    #product_id holds the same 32 char hex string Django stores in api_product.id so the
+    #two can be joined
+    def match_expression(self, query, prefix=False):
+        tokens = tokenize(query)
+        if not tokens:
+            return None
+        terms = [f'"{token}"' for token in tokens]
+        if prefix:
+            terms[-1] += '*'
+        return ' '.join(terms)
+
+    def index_product(self, product):
+        rowid = search_rowid(product.pk)
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [rowid])
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, product_id, name, description) VALUES (%s, %s, %s, %s)',
+                [rowid, product.pk.hex, product.name, product.description],
+            )
+
+    #Bulk version for imports: a few rowid DELETEs and one executemany INSERT per batch
+    def index_products(self, products):
+        self.insert_rows([(product.pk, product.name, product.description) for product in products], replace=True)
+
+    def insert_rows(self, rows, replace=False):
+        rows = [(search_rowid(pk), pk.hex, name, description) for pk, name, description in rows]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            if replace:
+                #Stay under SQLite's limit on query parameters
+                for start in range(0, len(rows), 500):
+                    rowids = [row[0] for row in rows[start:start + 500]]
+                    cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({", ".join(["%s"] * len(rowids))})', rowids)
+            cursor.executemany(f'INSERT INTO {FTS_TABLE} (rowid, product_id, name, description) VALUES (%s, %s, %s, %s)', rows)
+
+    def remove_product(self, product_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [search_rowid(product_id)])
+
+    #The rowids are computed here, not in SQL, so the table is refilled a batch at a time
+    def rebuild(self, batch_size=2000):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+        rows = Product.objects.order_by().values_list('pk', 'name', 'description')
+        batch = []
+        for row in rows.iterator(chunk_size=batch_size):
+            batch.append(row)
+            if len(batch) == batch_size:
+                self.insert_rows(batch)
+                batch = []
+        self.insert_rows(batch)
+
+    def matching(self, query):
+        match = self.match_expression(query)
+        if match is None:
+            return Product.objects.none()
+        return Product.objects.filter(
+            pk__in=RawSQL(f'SELECT product_id FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [match])
+        )
+
+    def ranked_ids(self, query, category=None, limit=20, offset=0, prefix=False):
+        match = self.match_expression(query, prefix=prefix)
+        if match is None:
+            return []
+        sql = (
+            f'SELECT p.id FROM {FTS_TABLE} f JOIN {Product._meta.db_table} p ON p.id = f.product_id '
+            f'WHERE {FTS_TABLE} MATCH %s'
+        )
+        params = [match]
+        if category:
+            sql += ' AND p.category = %s'
+            params.append(category)
+        #bm25 weights: name matches count more than description matches
+        sql += f' ORDER BY bm25({FTS_TABLE}, 0, 10.0, 1.0) LIMIT %s OFFSET %s'
+        params += [limit, offset]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [Product._meta.pk.to_python(row[0]) for row in cursor.fetchall()]
+
+    def autocomplete(self, prefix, limit=10):
+        match = self.match_expression(prefix, prefix=True)
+        if match is None:
+            return []
+        #bm25() can't be combined with DISTINCT, so over-fetch and drop duplicate names here
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT name FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s '
+                f'ORDER BY bm25({FTS_TABLE}, 0, 10.0, 1.0) LIMIT %s',
+                [f'name : ({match})', limit * 5],
+            )
+            names = dict.fromkeys(row[0] for row in cursor.fetchall())
+        return list(names)[:limit]
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    #Postgres keeps the GIN expression index (migration 0007) up to date itself,
+    #so there is nothing to sync from the signals
+    config = 'english'
+
+    def vector(self):
+        from django.contrib.postgres.search import SearchVector
+        return SearchVector('name', weight='A', config=self.config) + SearchVector('description', weight='B', config=self.config)
+
+    def search_query(self, query, prefix=False):
+        from django.contrib.postgres.search import SearchQuery
+        tokens = tokenize(query)
+        if not tokens:
+            return None
+        if prefix:
+            terms = [f"'{token}'" for token in tokens]
+            terms[-1] += ':*'
+            return SearchQuery(' & '.join(terms), search_type='raw', config=self.config)
+        return SearchQuery(' '.join(tokens), search_type='plain', config=self.config)
+
+    def matching(self, query):
+        search_query = self.search_query(query)
+        if search_query is None:
+            return Product.objects.none()
+        return Product.objects.annotate(document=self.vector()).filter(document=search_query)
+
+    def ranked_ids(self, query, category=None, limit=20, offset=0, prefix=False):
+        from django.contrib.postgres.search import SearchRank
+        search_query = self.search_query(query, prefix=prefix)
+        if search_query is None:
+            return []
+        queryset = (
+            Product.objects.annotate(document=self.vector())
+            .filter(document=search_query)
+            .annotate(rank=SearchRank(self.vector(), search_query))
+        )
+        if category:
+            queryset = queryset.filter(category=category)
+        return list(queryset.order_by('-rank').values_list('pk', flat=True)[offset:offset + limit])
+
+    def autocomplete(self, prefix, limit=10):
+        ids = self.ranked_ids(prefix, limit=limit, prefix=True)
+        names = dict(Product.objects.filter(pk__in=ids).values_list('pk', 'name'))
+        return list(dict.fromkeys(names[pk] for pk in ids if pk in names))
+
+
+def get_search_backend():
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    return SqliteSearchBackend()
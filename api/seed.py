@@ -0,0 +1,141 @@
+import random
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+
+from .cache import CATALOG_SCOPE, catalog_cache, category_scope
+from .models import CustomUser, Order, OrderItem, Product, Review
+from .search import get_search_backend
+
+
+#Synthetic catalog, users and order history for benchmarks and load tests (manage.py seed_data).
+#Everything is written with bulk_create in batches, so 1M order items take minutes, not hours;
+#the signals those inserts skip (search index, catalog cache, order totals) are handled here.
+
+WORDS = (
+    'classic', 'wireless', 'organic', 'compact', 'deluxe', 'portable', 'vintage', 'smart',
+    'lamp', 'chair', 'headphones', 'kettle', 'notebook', 'jacket', 'sneakers', 'blender',
+    'backpack', 'watch', 'serum', 'yoga', 'mat', 'puzzle', 'speaker', 'mug', 'scarf', 'tent',
+)
+
+
+def batched_range(count, batch_size):
+    for start in range(0, count, batch_size):
+        yield start, min(start + batch_size, count)
+
+
+def product_name(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(3)).title()
+
+
+#One password hash shared by every seeded user: hashing 10k passwords would dominate the run
+def seed_users(count, rng, prefix='seed', batch_size=5000, password='pass12345'):
+    password_hash = make_password(password)
+    pks = []
+    for start, end in batched_range(count, batch_size):
+        users = [
+            CustomUser(
+                username=f'{prefix}{i}',
+                email=f'{prefix}{i}@example.com',
+                password=password_hash,
+                role='seller' if i % 10 == 0 else 'customer',
+                is_seller=i % 10 == 0,
+            )
+            for i in range(start, end)
+        ]
+        CustomUser.objects.bulk_create(users, batch_size=batch_size)
+        #Not every backend returns ids from bulk_create; keep them in generation order
+        ids = dict(CustomUser.objects.filter(username__in=[user.username for user in users]).values_list('username', 'pk'))
+        pks.extend(ids[user.username] for user in users)
+    return pks
+
+
+def seed_products(count, sellers, rng, batch_size=5000):
+    categories = [value for value, label in Product.Categories.choices]
+    products = []
+    for start, end in batched_range(count, batch_size):
+        batch = [
+            Product(
+                name=product_name(rng),
+                description=' '.join(rng.choice(WORDS) for _ in range(20)),
+                price=Decimal(rng.randrange(199, 50000)) / 100,
+                stock=rng.randrange(0, 500),
+                category=rng.choice(categories),
+                seller_id=rng.choice(sellers) if sellers else None,
+            )
+            for _ in range(start, end)
+        ]
+        Product.objects.bulk_create(batch, batch_size=batch_size)
+        products.extend((product.pk, product.price) for product in batch)
+    return products
+
+
+#Orders of 1-7 items each until item_count items exist; totals are written up front
+#because bulk_create skips the OrderItem signals that normally maintain them
+def seed_orders(item_count, users, products, rng, batch_size=5000):
+    created = 0
+    orders = 0
+    while created < item_count:
+        order_rows = []
+        item_rows = []
+        while created < item_count and len(item_rows) < batch_size:
+            size = min(rng.randint(1, 7), item_count - created)
+            lines = [(rng.choice(products), rng.randint(1, 3)) for _ in range(size)]
+            order = Order(
+                user_id=rng.choice(users),
+                status=rng.choice(Order.Status.values),
+                total=sum((price * quantity for (pk, price), quantity in lines), Decimal('0')),
+            )
+            order_rows.append(order)
+            item_rows.extend(
+                OrderItem(order=order, product_id=pk, price=price, quantity=quantity)
+                for (pk, price), quantity in lines
+            )
+            created += size
+        with transaction.atomic():
+            Order.objects.bulk_create(order_rows, batch_size=batch_size)
+            OrderItem.objects.bulk_create(item_rows, batch_size=batch_size)
+        orders += len(order_rows)
+    return orders
+
+
+#bulk_create skips the Review signals, so the stored review stats are recomputed per batch
+def seed_reviews(count, users, products, rng, batch_size=5000):
+    for start, end in batched_range(count, batch_size):
+        reviews = [
+            Review(
+                user_id=rng.choice(users),
+                product_id=rng.choice(products)[0],
+                comment=' '.join(rng.choice(WORDS) for _ in range(12)),
+            )
+            for _ in range(start, end)
+        ]
+        with transaction.atomic():
+            Review.objects.bulk_create(reviews, batch_size=batch_size)
+            Product.objects.filter(pk__in={review.product_id for review in reviews}).refresh_review_stats()
+    return count
+
+
+def seed_database(users=10000, products=100000, order_items=1000000, reviews=50000, seed=0, prefix='seed', batch_size=5000, progress=None):
+    rng = random.Random(seed)
+    report = progress or (lambda message: None)
+
+    user_pks = seed_users(users, rng, prefix, batch_size)
+    report(f'{len(user_pks)} users')
+    #Every tenth user is a seller, see seed_users
+    sellers = user_pks[::10]
+    product_rows = seed_products(products, sellers, rng, batch_size)
+    report(f'{len(product_rows)} products')
+    orders = seed_orders(order_items, user_pks, product_rows, rng, batch_size) if product_rows and user_pks else 0
+    order_items = order_items if orders else 0
+    report(f'{order_items} order items in {orders} orders')
+    review_count = seed_reviews(reviews, user_pks, product_rows, rng, batch_size) if product_rows and user_pks else 0
+    report(f'{review_count} reviews')
+
+    #Bulk inserts skip the Product signals: rebuild search once and drop every cached catalog page
+    get_search_backend().rebuild()
+    catalog_cache.bump(CATALOG_SCOPE)
+    for value, label in Product.Categories.choices:
+        catalog_cache.bump(category_scope(value))
+    return {'users': len(user_pks), 'products': len(product_rows), 'orders': orders, 'order_items': order_items, 'reviews': review_count}
@@ -1,11 +1,51 @@
+from django.db.models import Prefetch
 from .models import Product, Order, OrderItem, CustomUser, CartItem, Cart, Payment, Review
 from rest_framework import serializers
 
+
+#Serializers declare the queryset shape they need and views apply it through
+#setup_eager_loading(), so nested data is fetched with joins/prefetches instead of per row.
+class EagerLoadingMixin:
+    select_related_fields = ()
+    prefetch_related_fields = ()
+    only_fields = ()
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        if cls.select_related_fields:
+            queryset = queryset.select_related(*cls.select_related_fields)
+        if cls.prefetch_related_fields:
+            queryset = queryset.prefetch_related(*cls.get_prefetch_related_fields())
+        if cls.only_fields:
+            queryset = queryset.only(*cls.only_fields)
+        return queryset
+
+    @classmethod
+    def get_prefetch_related_fields(cls):
+        return cls.prefetch_related_fields
+
+
+#Lets a view pass fields=[...] (from ?fields=) to return a sparse fieldset
+class SparseFieldsetMixin:
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
 #User serializers
+#Compact user reference embedded in other payloads, reads only id and username
+class UserStubSerializer(serializers.Serializer):
+    id = serializers.IntegerField(read_only=True)
+    username = serializers.CharField(read_only=True)
+
+
 class PublicUserSerializer(serializers.ModelSerializer):
     class Meta:
         model = CustomUser
-        fields = '__all__'
+        fields = ['id', 'username', 'role', 'date_joined']
 
 
 class PrivateUserSerializer(serializers.ModelSerializer):
@@ -14,17 +54,27 @@ class PrivateUserSerializer(serializers.ModelSerializer):
         fields = ['id', 'username', 'is_seller']
 
 #Product model serializer converts user instances to JSON
-class ProductSerializer(serializers.ModelSerializer):
-    seller = PublicUserSerializer(read_only=True)
-    
+class ProductSerializer(SparseFieldsetMixin, EagerLoadingMixin, serializers.ModelSerializer):
+    seller = UserStubSerializer(read_only=True)
+
+    select_related_fields = ('seller',)
+    only_fields = (
+        'id', 'name', 'price', 'stock', 'category', 'updated_at', 'review_count', 'last_reviewed_at',
+        'seller__id', 'seller__username',
+    )
 
     class Meta:
         model = Product
         fields = [
+            'id',
+            'seller',
             'name',
             'price',
             'stock',
             'category',
+            'updated_at',
+            'review_count',
+            'last_reviewed_at',
         ]
 
     def validate_price(self, value):
@@ -37,22 +87,38 @@ class ProductSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Stock cannot be zero or less input proper price.")
         return value
 
+#Writable product payload for the seller's own catalog, see SellerProductViewSet
+class SellerProductSerializer(ProductSerializer):
+    only_fields = ProductSerializer.only_fields + ('description',)
+
+    class Meta(ProductSerializer.Meta):
+        fields = ProductSerializer.Meta.fields + ['description']
+
 class OrderItemSerializers(serializers.ModelSerializer):
     class Meta:
         model = OrderItem
         fields = [
             'product',
+            'price',
             'quantity',
         ]
 
-class OrderSerializer(serializers.ModelSerializer):
-    items = OrderItemSerializers(many=True, read_only=True)
+class OrderSerializer(SparseFieldsetMixin, EagerLoadingMixin, serializers.ModelSerializer):
+    items = OrderItemSerializers(many=True, read_only=True, source='orderitem_set')
     total_price = serializers.SerializerMethodField()
-    user = PublicUserSerializer(read_only=True)
+    user = UserStubSerializer(read_only=True)
 
+    select_related_fields = ('user',)
+    prefetch_related_fields = ('orderitem_set',)
+    only_fields = ('order_id', 'created_at', 'updated_at', 'status', 'total', 'user__id', 'user__username')
+
+    @classmethod
+    def get_prefetch_related_fields(cls):
+        return [Prefetch('orderitem_set', queryset=OrderItem.objects.only('id', 'order_id', 'product_id', 'price', 'quantity'))]
+
+    #Stored on the order and maintained as its items change
     def get_total_price(self, obj):
-        order_items = obj.items.all()
-        return sum(order_item.subtotal for order_item in order_items)
+        return obj.total
 
     class Meta:
         model = Order
@@ -66,39 +132,69 @@ class OrderSerializer(serializers.ModelSerializer):
             'total_price',
         ]
 
+#Order history rows, see OrderQuerySet.summaries(): no items, just how many there are
+class OrderSummarySerializer(serializers.ModelSerializer):
+    item_count = serializers.IntegerField(read_only=True)
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        return queryset.summaries()
+
+    class Meta:
+        model = Order
+        fields = ['order_id', 'user', 'created_at', 'status', 'item_count', 'total']
+
 class CartItemSerializer(serializers.ModelSerializer):
     subtotal = serializers.SerializerMethodField()
 
     class Meta:
         model = CartItem
-        field = ['product','quantity', 'subtotal']
+        fields = ['product','quantity', 'subtotal']
 
+    #Uses the subtotal annotated by CartItem.objects.with_subtotals() when available
     def get_subtotal(self, obj):
-        return obj.quantity * obj.product.price
+        return obj.subtotal
     
 
-class CartSerializer(serializers.ModelSerializer):
-    items = CartItemSerializer(many=True, read_only=True)
+class CartSerializer(SparseFieldsetMixin, EagerLoadingMixin, serializers.ModelSerializer):
+    items = CartItemSerializer(many=True, read_only=True, source='line_items')
     total_price = serializers.SerializerMethodField()
 
+    prefetch_related_fields = ('cartitem_set',)
+
+    #Fills Cart.line_items for the whole page in one query instead of one per cart
+    @classmethod
+    def get_prefetch_related_fields(cls):
+        return [Prefetch('cartitem_set', queryset=CartItem.objects.with_subtotals(), to_attr='line_items')]
+
     class Meta:
         model = Cart
-        field = ['id', 'user', 'items', 'total_price']
+        fields = ['id', 'user', 'items', 'total_price', 'updated_at']
 
+    #Summed from the already loaded line items, no extra query
     def get_total_price(self, obj):
-        return sum([item.quantity * item.product.price for item in obj.items.all()])
+        return obj.get_total
     
-class PaymentSerializer(serializers.ModelSerializer):
+class PaymentSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Payment
-        field = ['id', 'order', 'amount', 'status', 'transaction_id', 'payment_method', 'created_at']
+        fields = ['id', 'order', 'amount', 'status', 'transaction_id', 'created_at', 'updated_at']
+
+
 
 
+class ReviewSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Product
+        fields = ['id', 'review_count', 'last_reviewed_at']
+
 
+class ReviewSerializer(SparseFieldsetMixin, EagerLoadingMixin, serializers.ModelSerializer):
+    user = UserStubSerializer(read_only=True)
 
-class ReviewSerializer(serializers.ModelSerializer):
-    user = PublicUserSerializer(read_only=True)
+    select_related_fields = ('user',)
+    only_fields = ('id', 'product_id', 'comment', 'created', 'user__id', 'user__username')
 
     class Meta:
         model = Review
-        field = ['product', 'user', 'comment', 'created']
\ No newline at end of file
+        fields = ['id', 'product', 'user', 'comment', 'created']
\ No newline at end of file
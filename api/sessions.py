@@ -0,0 +1,101 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.sessions.backends.base import UpdateError
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.utils import timezone
+
+from .jobs import arequeue, job, requeue
+
+
+#Cache-first session engine with write-behind to the database.
+#Every change goes to the session cache straight away, but the database row is only
+#rewritten when the session is created or SESSION_DB_WRITE_INTERVAL seconds have passed
+#since the last DB write. The first change that only reached the cache queues a
+#flush_session job for the end of the interval, which copies the cached session to its
+#row, so a cache loss costs at most one interval of changes. Reads come from the cache
+#and fall back to the DB row.
+#Point SESSION_CACHE_ALIAS at a cache shared by all worker processes.
+class SessionStore(CachedDBStore):
+    cache_key_prefix = 'api.sessions'
+
+    def get_db_write_interval(self):
+        return getattr(settings, 'SESSION_DB_WRITE_INTERVAL', 60)
+
+    @property
+    def flush_marker_key(self):
+        return self.cache_key + ':db-written'
+
+    @property
+    def dirty_marker_key(self):
+        return self.cache_key + ':dirty'
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        interval = self.get_db_write_interval()
+        #add() only succeeds when no DB write happened within the interval
+        if must_create or not interval or self._cache.add(self.flush_marker_key, 1, interval):
+            super().save(must_create=must_create)
+            if must_create and interval:
+                self._cache.set(self.flush_marker_key, 1, interval)
+            return
+        self._cache.set(self.cache_key, self._session, self.get_expiry_age())
+        #One flush per interval however many changes it holds, and one job row per session
+        if self._cache.add(self.dirty_marker_key, 1, interval * 2):
+            requeue(*self.flush_job(interval))
+
+    #Same as save() for async views
+    async def asave(self, must_create=False):
+        if self.session_key is None:
+            return await self.acreate()
+        interval = self.get_db_write_interval()
+        if must_create or not interval or await self._cache.aadd(self.flush_marker_key, 1, interval):
+            await super().asave(must_create=must_create)
+            if must_create and interval:
+                await self._cache.aset(self.flush_marker_key, 1, interval)
+            return
+        await self._cache.aset(self.cache_key, self._session, await self.aget_expiry_age())
+        if await self._cache.aadd(self.dirty_marker_key, 1, interval * 2):
+            await arequeue(*self.flush_job(interval))
+
+    def flush_job(self, interval):
+        return (
+            'flush_session', {'session_key': self.session_key}, f'flush-session:{self.session_key}',
+            timezone.now() + timedelta(seconds=interval),
+        )
+
+    #Copy the cached session to its database row
+    def write_behind(self):
+        self._cache.delete(self.dirty_marker_key)
+        data = self._cache.get(self.cache_key)
+        if data is None:
+            return False
+        self._session_cache = data
+        try:
+            super().save()
+        except UpdateError:
+            #Deleted (logged out) since it was cached
+            return False
+        self._cache.set(self.flush_marker_key, 1, self.get_db_write_interval())
+        return True
+
+    def marker_keys(self, session_key):
+        return [self.cache_key_prefix + session_key + ':db-written', self.cache_key_prefix + session_key + ':dirty']
+
+    def delete(self, session_key=None):
+        key = session_key or self.session_key
+        if key is not None:
+            self._cache.delete_many(self.marker_keys(key))
+        super().delete(session_key)
+
+    async def adelete(self, session_key=None):
+        key = session_key or self.session_key
+        if key is not None:
+            await self._cache.adelete_many(self.marker_keys(key))
+        await super().adelete(session_key)
+
+
+@job('flush_session')
+def flush_session(session_key):
+    SessionStore(session_key).write_behind()
@@ -0,0 +1,200 @@
+from decimal import Decimal
+
+from django.db.models import F, QuerySet, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.contrib.auth.signals import user_logged_in
+from django.db.backends.signals import connection_created
+from django.contrib.auth.models import Group
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import CustomUser, Order, OrderItem, Product, Review, latest_review_expression
+from .analytics import enqueue_rollup_update, recount_orders, uncount_orders
+from .images import schedule_variants
+from .search import get_search_backend
+from .cache import invalidate_product, invalidate_product_id
+from .cart import merge_session_cart
+from .reservations import forget_counters
+from .roles import ROLE_FIELDS, forget_authorization
+from .sqlite import configure_connection
+
+
+#updated_at moves even when the total doesn't: a line can change product or quantity at the same subtotal
+def _adjust_order_total(order_id, delta):
+    if order_id is not None:
+        Order.objects.filter(pk=order_id).update(total=F('total') + delta, updated_at=timezone.now())
+
+
+#Keep Order.total in step with its items by applying only the change in subtotal.
+#bulk_create/update bypass these signals, callers using them set the total themselves
+#or call Order.objects.filter(...).refresh_totals().
+@receiver(post_save, sender=OrderItem)
+def order_item_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    new_subtotal = Decimal(instance.quantity) * Decimal(instance.price)
+    old_order_id, old_quantity, old_price = getattr(instance, '_loaded_state', (None, None, None))
+
+    if not created and None in (old_order_id, old_quantity, old_price):
+        #Loaded with deferred fields, we can't know the previous value so recompute
+        Order.objects.filter(pk=instance.order_id).refresh_totals()
+    elif created or old_order_id != instance.order_id:
+        if not created:
+            _adjust_order_total(old_order_id, -(Decimal(old_quantity) * Decimal(old_price)))
+        _adjust_order_total(instance.order_id, new_subtotal)
+    else:
+        _adjust_order_total(instance.order_id, new_subtotal - Decimal(old_quantity) * Decimal(old_price))
+
+    instance._loaded_state = (instance.order_id, instance.quantity, instance.price)
+
+
+@receiver(post_delete, sender=OrderItem)
+def order_item_deleted(sender, instance, **kwargs):
+    _adjust_order_total(instance.order_id, -(Decimal(instance.quantity) * Decimal(instance.price)))
+
+
+#Sales rollups of orders whose lines change: the order (both, when a line moves) is taken out
+#of its buckets before the change and queued to be counted again after it
+@receiver(pre_save, sender=OrderItem)
+def order_item_changing(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    previous_order_id = getattr(instance, '_loaded_state', (None, None, None))[0]
+    recount_orders({instance.order_id, previous_order_id} - {None})
+
+
+@receiver(pre_delete, sender=OrderItem)
+def order_item_deleting(sender, instance, origin=None, **kwargs):
+    #Lines deleted with their order: order_deleted takes the whole order out
+    if getattr(origin, 'model', type(origin)) is Order:
+        return
+    recount_orders([instance.order_id])
+
+
+#Sales rollups follow status changes saved through the model. New orders are queued by
+#checkout, and queryset updates of the status call schedule_rollups() themselves.
+@receiver(post_save, sender=Order)
+def order_saved(sender, instance, created, raw=False, **kwargs):
+    if raw or created:
+        return
+    if instance.__dict__.get('rolled_up_status', '') != instance.status:
+        enqueue_rollup_update([instance.pk])
+
+
+#Queryset deletes uncount all their orders beforehand (OrderQuerySet.delete). Anything else is
+#checked against the stored status, an instance loaded before the rollup job ran may be stale.
+@receiver(pre_delete, sender=Order)
+def order_deleted(sender, instance, origin=None, **kwargs):
+    if isinstance(origin, QuerySet) and origin.model is Order:
+        return
+    uncount_orders([instance.pk])
+
+
+#Keep the product search index and catalog cache in sync with the catalog
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    #Stock and price saves leave the search index alone
+    search_text = (instance.name, instance.description)
+    loaded = getattr(instance, '_loaded_search_text', (None, None))
+    if loaded != search_text or None in loaded:
+        get_search_backend().index_product(instance)
+    instance._loaded_search_text = search_text
+    invalidate_product(instance, previous_category=getattr(instance, '_loaded_category', None))
+    instance._loaded_category = instance.category
+    schedule_variants(instance, 'image', 'image_variants')
+    #Stock may have changed, so the reservation counters reseed from the committed row
+    product_id = instance.pk
+    transaction.on_commit(lambda: forget_counters([product_id]))
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    get_search_backend().remove_product(instance.pk)
+    invalidate_product(instance)
+
+
+#Keep Product.review_count and last_reviewed_at current with one UPDATE per review written.
+#Cards and API payloads show them, so the product's cached pages are invalidated on commit.
+@receiver(post_save, sender=Review)
+def review_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if not created:
+        #Moved to another product (admin): recount both
+        previous_id = getattr(instance, '_loaded_product_id', None)
+        if previous_id is not None and previous_id != instance.product_id:
+            Product.objects.filter(pk__in=[previous_id, instance.product_id]).refresh_review_stats()
+            transaction.on_commit(lambda: invalidate_product_id(previous_id))
+            _invalidate_reviewed_product(instance)
+        instance._loaded_product_id = instance.product_id
+        return
+    instance._loaded_product_id = instance.product_id
+    created_at = Value(instance.created)
+    Product.objects.filter(pk=instance.product_id).update(
+        review_count=F('review_count') + 1,
+        last_reviewed_at=Greatest(Coalesce('last_reviewed_at', created_at), created_at),
+        updated_at=timezone.now(),
+    )
+    _invalidate_reviewed_product(instance)
+
+
+@receiver(post_delete, sender=Review)
+def review_deleted(sender, instance, **kwargs):
+    Product.objects.filter(pk=instance.product_id).update(
+        review_count=Greatest(F('review_count') - 1, 0),
+        last_reviewed_at=latest_review_expression(),
+        updated_at=timezone.now(),
+    )
+    _invalidate_reviewed_product(instance)
+
+
+def _invalidate_reviewed_product(review):
+    product_id = review.product_id
+    transaction.on_commit(lambda: invalidate_product_id(product_id))
+
+
+#Move whatever the visitor put in their session cart into their own cart
+@receiver(user_logged_in)
+def merge_anonymous_cart(sender, request, user, **kwargs):
+    if request is not None and hasattr(request, 'session'):
+        merge_session_cart(request.session, user)
+
+
+@receiver(post_save, sender=CustomUser)
+def user_saved(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    schedule_variants(instance, 'profile_image', 'profile_image_variants')
+    #Sessions keep the resolved roles until the user's generation changes, see roles.py.
+    #Saves that only touch other fields (last_login on every login) leave it alone.
+    if not created and (update_fields is None or ROLE_FIELDS & set(update_fields)):
+        user_pks = [instance.pk]
+        transaction.on_commit(lambda: forget_authorization(user_pks))
+
+
+#Group membership or direct permissions of some users changed
+@receiver(m2m_changed, sender=CustomUser.groups.through)
+@receiver(m2m_changed, sender=CustomUser.user_permissions.through)
+def user_permissions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        user_pks = [instance.pk]
+    else:
+        #None when a group or permission was cleared from everyone who had it: forget all
+        user_pks = list(pk_set) if pk_set is not None else None
+    transaction.on_commit(lambda: forget_authorization(user_pks))
+
+
+#A group's permissions changed: every session resolves again
+@receiver(m2m_changed, sender=Group.permissions.through)
+def group_permissions_changed(sender, action, **kwargs):
+    if action.startswith('post_'):
+        transaction.on_commit(forget_authorization)
+
+
+connection_created.connect(configure_connection, dispatch_uid='api.sqlite.configure_connection')
@@ -0,0 +1,95 @@
+import random
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+
+
+#Opt-in SQLite profile for storefronts that run straight on db.sqlite3.
+#With SQLITE_TUNING['ENABLED'] every new connection switches to WAL (readers no longer wait
+#for the writer), relaxes fsyncs to synchronous=NORMAL (safe in WAL, an OS crash can only lose
+#the last commits), maps the file into memory, grows the page cache and waits BUSY_TIMEOUT ms
+#for a lock instead of failing straight away.
+#
+#Transactions that read before they write use write_transaction(): BEGIN IMMEDIATE takes the
+#write lock up front. A deferred transaction that has to upgrade its lock later fails with
+#"database is locked" without waiting, and retry_if_locked replays those.
+
+DEFAULTS = {
+    'ENABLED': False,
+    'JOURNAL_MODE': 'wal',
+    'SYNCHRONOUS': 'normal',
+    'BUSY_TIMEOUT': 5000,
+    'CACHE_SIZE': -64000,
+    'MMAP_SIZE': 256 * 1024 * 1024,
+    'TEMP_STORE': 'memory',
+    'LOCK_RETRIES': 5,
+    'RETRY_DELAY': 0.05,
+}
+
+
+def get_setting(name):
+    return getattr(settings, 'SQLITE_TUNING', {}).get(name, DEFAULTS[name])
+
+
+def pragmas():
+    return [
+        f"PRAGMA journal_mode={get_setting('JOURNAL_MODE')}",
+        f"PRAGMA synchronous={get_setting('SYNCHRONOUS')}",
+        f"PRAGMA busy_timeout={int(get_setting('BUSY_TIMEOUT'))}",
+        f"PRAGMA cache_size={int(get_setting('CACHE_SIZE'))}",
+        f"PRAGMA mmap_size={int(get_setting('MMAP_SIZE'))}",
+        f"PRAGMA temp_store={get_setting('TEMP_STORE')}",
+    ]
+
+
+#connection_created receiver, see signals.py
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite' or not get_setting('ENABLED'):
+        return
+    with connection.cursor() as cursor:
+        for statement in pragmas():
+            cursor.execute(statement)
+
+
+def is_locked_error(error):
+    return 'locked' in str(error) or 'busy' in str(error)
+
+
+#Replay the whole transaction when SQLite reports a lock conflict. Only the outermost
+#caller can do that, inside someone else's transaction the error is passed on.
+def retry_if_locked(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        retries = get_setting('LOCK_RETRIES')
+        for attempt in range(retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                connection = connections[DEFAULT_DB_ALIAS]
+                if connection.vendor != 'sqlite' or not is_locked_error(e) or attempt == retries or connection.in_atomic_block:
+                    raise
+                time.sleep(get_setting('RETRY_DELAY') * 2 ** attempt * random.uniform(0.5, 1.5))
+    return wrapper
+
+
+#transaction.atomic() that starts with BEGIN IMMEDIATE on SQLite when it is the outermost block
+@contextmanager
+def write_transaction(using=None):
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    if connection.vendor != 'sqlite' or connection.in_atomic_block:
+        with transaction.atomic(using=using):
+            yield
+        return
+    #transaction_mode is only set once the connection is open (a fresh worker thread isn't yet)
+    connection.ensure_connection()
+    previous = connection.transaction_mode
+    connection.transaction_mode = 'IMMEDIATE'
+    try:
+        with transaction.atomic(using=using):
+            connection.transaction_mode = previous
+            yield
+    finally:
+        connection.transaction_mode = previous
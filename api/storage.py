@@ -0,0 +1,23 @@
+import re
+
+from django.core.files.storage import FileSystemStorage
+
+HASHED_NAME_RE = re.compile(r'(^|/)[0-9a-f]{32}(-\w+)?\.\w+$')
+
+
+#Uploads and image variants are named after their content (see models.content_hash),
+#so a file that already exists under that name is the same file: keep it instead of
+#writing a second copy with a random suffix.
+class ContentAddressedStorage(FileSystemStorage):
+    def is_content_addressed(self, name):
+        return bool(HASHED_NAME_RE.search(name))
+
+    def get_available_name(self, name, max_length=None):
+        if self.is_content_addressed(name) and self.exists(name):
+            return name
+        return super().get_available_name(name, max_length=max_length)
+
+    def _save(self, name, content):
+        if self.is_content_addressed(name) and self.exists(name):
+            return name
+        return super()._save(name, content)
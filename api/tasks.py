@@ -0,0 +1,70 @@
+from django.conf import settings
+from django.core.mail import send_mail
+
+from .jobs import build_job, enqueue_many, job
+from .models import Order, Product
+from .payments import apply_events, get_gateway
+
+
+#Side effects of a checkout. They run in the run_jobs worker, never in the request,
+#and may run more than once, so each one checks whether its work is already done.
+
+def low_stock_threshold():
+    return getattr(settings, 'LOW_STOCK_THRESHOLD', 5)
+
+
+@job('send_order_confirmation')
+def send_order_confirmation(order_id):
+    order = Order.objects.select_related('user').get(pk=order_id)
+    if order.user is None or not order.user.email:
+        return
+    lines = [
+        f'{item.quantity} x {item.product.name} @ {item.price}'
+        for item in order.orderitem_set.select_related('product')
+    ]
+    send_mail(
+        f'Order {order.pk} confirmed',
+        '\n'.join(lines + [f'Total: {order.total}']),
+        None,
+        [order.user.email],
+    )
+
+
+#The gateway dedupes on the idempotency key, so a retried job never charges twice,
+#and recording the same result again is a no-op
+@job('create_order_payment')
+def create_order_payment(order_id):
+    order = Order.objects.only('pk', 'user_id', 'total').get(pk=order_id)
+    if order.user_id is None:
+        return
+    gateway = get_gateway()
+    event = gateway.charge(order, idempotency_key=f'order-{order.pk}')
+    apply_events([event], gateway.name)
+
+
+@job('check_low_stock')
+def check_low_stock(product_ids):
+    products = (
+        Product.objects.filter(pk__in=product_ids, stock__lte=low_stock_threshold(), seller__isnull=False)
+        .select_related('seller')
+        .only('name', 'stock', 'seller__email')
+    )
+    for product in products:
+        if product.seller.email:
+            send_mail(
+                f'Low stock: {product.name}',
+                f'{product.name} has {product.stock} left in stock.',
+                None,
+                [product.seller.email],
+            )
+
+
+#Called inside the checkout transaction so the jobs exist if and only if the order does
+def enqueue_checkout_jobs(order, product_ids):
+    key = f'order-{order.pk}'
+    enqueue_many([
+        build_job('send_order_confirmation', {'order_id': str(order.pk)}, f'{key}:confirmation'),
+        build_job('create_order_payment', {'order_id': str(order.pk)}, f'{key}:payment'),
+        build_job('check_low_stock', {'product_ids': [str(pk) for pk in product_ids]}, f'{key}:low-stock'),
+        build_job('update_sales_rollups', {'order_ids': [str(order.pk)]}, f'{key}:sales'),
+    ])
@@ -1,3 +1,1891 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import OperationalError, connection, transaction
+from django.db.models import F, Sum
+from django.test import TestCase as BaseTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .cache import catalog_cache
+from .cart import add_to_cart, remove_item, set_item_quantity, update_cart_items
+from .checkout import checkout_cart, OutOfStockError
+from .jobs import claim_jobs, enqueue, job, registry, run_pending
+from .models import ROLLUP_PENDING, Cart, CartItem, CustomUser, Job, Order, OrderItem, Payment, Product, Review, SalesRollup, StockReservation
+from . import metrics, roles
+from .analytics import sales_report, update_rollups
+from .payments import LocalGateway, PaymentEvent, apply_events
+from .reservations import InsufficientStockError
+from .routers import PIN_COOKIE, PrimaryReplicaRouter, pin_to_primary, request_is_pinned, unpin
+from .search import get_search_backend
+from .seed import seed_database
+from .sqlite import configure_connection, retry_if_locked
+from .tasks import create_order_payment
+from .serializers import (
+    CartItemSerializer, CartSerializer, OrderSerializer, PaymentSerializer, PrivateUserSerializer,
+    ProductSerializer, PublicUserSerializer, ReviewSerializer,
+)
+
+
+#The configured caches, with every location moved somewhere of the tests' own: clearing them
+#must never touch the sessions, counters or catalog pages of a running site
+def isolated_cache_settings():
+    test_caches = {}
+    for alias, config in settings.CACHES.items():
+        if config['BACKEND'].endswith('FileBasedCache'):
+            location = os.path.join(tempfile.gettempdir(), 'api-test-caches', alias)
+        else:
+            location = f'api-tests-{alias}'
+        test_caches[alias] = dict(config, LOCATION=location)
+    return test_caches
+
+
+isolated_caches = override_settings(CACHES=isolated_cache_settings())
+
+
+#Catalog pages, sessions and stock counters are cached across requests, start every test from cold caches
+@isolated_caches
+class TestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        for alias in settings.CACHES:
+            caches[alias].clear()
+        catalog_cache.clear_local()
+
+
+def make_product(**kwargs):
+    defaults = {
+        'name': 'Product',
+        'description': 'A product',
+        'price': Decimal('10.00'),
+        'stock': 10,
+        'category': Product.Categories.BOOKS,
+    }
+    defaults.update(kwargs)
+    return Product.objects.create(**defaults)
+
+
+class ProductCatalogTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.books = [make_product(name=f'Book {i}') for i in range(5)]
+        cls.toys = [make_product(name=f'Toy {i}', category=Product.Categories.TOYS) for i in range(3)]
+
+    def test_list_walks_every_product_with_cursors(self):
+        seen = []
+        url = reverse('product-list') + '?page_size=3'
+        while url:
+            response = self.client.get(url)
+            page = response.context['page']
+            seen.extend(p.pk for p in page)
+            url = reverse('product-list') + f'?page_size=3&after={page.next_cursor}' if page.has_next else None
+        self.assertEqual(sorted(seen), sorted(p.pk for p in self.books + self.toys))
+        self.assertEqual(len(seen), len(set(seen)))
+
+    def test_previous_cursor_returns_prior_page(self):
+        first = self.client.get(reverse('product-list') + '?page_size=2').context['page']
+        second = self.client.get(reverse('product-list') + f'?page_size=2&after={first.next_cursor}').context['page']
+        back = self.client.get(reverse('product-list') + f'?page_size=2&before={second.previous_cursor}').context['page']
+        self.assertEqual([p.pk for p in back], [p.pk for p in first])
+        self.assertFalse(back.has_previous)
+
+    def test_page_query_count_is_constant(self):
+        with self.assertNumQueries(1):
+            self.client.get(reverse('product-list') + '?page_size=2')
+
+    def test_category_lookup_is_normalized(self):
+        url = reverse('product-list-by-category', args=['toys & baby products'])
+        response = self.client.get(url)
+        self.assertEqual(response.context['current_category'], Product.Categories.TOYS)
+        self.assertEqual({p.pk for p in response.context['page']}, {p.pk for p in self.toys})
+
+    def test_unknown_category_is_404(self):
+        response = self.client.get(reverse('product-list-by-category', args=['nope']))
+        self.assertEqual(response.status_code, 404)
+
+
+def make_user(username='shopper', **kwargs):
+    return CustomUser.objects.create_user(
+        email=f'{username}@example.com', password='pass12345', username=username, **kwargs
+    )
+
+
+class CartTotalsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_user()
+        cls.cart = Cart.objects.create(user=cls.user)
+        products = Product.objects.bulk_create([
+            Product(name=f'Item {i}', description='x', price=Decimal('1.25'), stock=5, category=Product.Categories.HOME)
+            for i in range(100)
+        ])
+        CartItem.objects.bulk_create([CartItem(cart=cls.cart, product=p, quantity=2) for p in products])
+
+    def test_total_is_a_single_aggregate_query(self):
+        cart = Cart.objects.get(pk=self.cart.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(cart.get_total, Decimal('250.00'))
+
+    def test_line_items_and_total_share_one_query(self):
+        cart = Cart.objects.get(pk=self.cart.pk)
+        with self.assertNumQueries(1):
+            subtotals = [item.subtotal for item in cart.line_items]
+            total = cart.get_total
+        self.assertEqual(len(subtotals), 100)
+        self.assertTrue(all(subtotal == Decimal('2.50') for subtotal in subtotals))
+        self.assertEqual(total, Decimal('250.00'))
+
+    def test_with_totals_annotates_carts(self):
+        with self.assertNumQueries(1):
+            cart = Cart.objects.with_totals().get(pk=self.cart.pk)
+            self.assertEqual(cart.get_total, Decimal('250.00'))
+
+    def test_serializer_query_count_is_fixed(self):
+        cart = Cart.objects.get(pk=self.cart.pk)
+        with self.assertNumQueries(1):
+            data = CartSerializer(cart).data
+        self.assertEqual(len(data['items']), 100)
+        self.assertEqual(Decimal(str(data['total_price'])), Decimal('250.00'))
+
+    def test_cart_view_query_count_is_fixed(self):
+        self.client.force_login(self.user)
+        #user, cart, items (the session comes from the session cache)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('cart'))
+        self.assertEqual(response.context['total'], Decimal('250.00'))
+
+
+class CheckoutTests(TestCase):
+    def setUp(self):
+        self.user = make_user()
+        self.cart = Cart.objects.create(user=self.user)
+
+    def fill_cart(self, count, quantity=2, stock=5):
+        products = Product.objects.bulk_create([
+            Product(name=f'Item {i}', description='x', price=Decimal('3.00'), stock=stock, category=Product.Categories.HOME)
+            for i in range(count)
+        ])
+        CartItem.objects.bulk_create([CartItem(cart=self.cart, product=p, quantity=quantity) for p in products])
+        return products
+
+    def test_checkout_snapshots_prices_and_decrements_stock(self):
+        products = self.fill_cart(3)
+        order = checkout_cart(self.cart, self.user)
+        items = OrderItem.objects.filter(order=order)
+        self.assertEqual(items.count(), 3)
+        self.assertEqual(Order.objects.get(pk=order.pk).total, Decimal('18.00'))
+        self.assertTrue(all(item.price == Decimal('3.00') for item in items))
+        self.assertEqual(set(Product.objects.filter(pk__in=[p.pk for p in products]).values_list('stock', flat=True)), {3})
+        self.assertFalse(CartItem.objects.filter(cart=self.cart).exists())
+
+    def test_checkout_query_count_does_not_grow_with_cart(self):
+        self.fill_cart(50)
+        #savepoint, items, lock, holds, stock update, order insert, item insert,
+        #cart delete, hold delete, cart touch, job insert, release
+        with self.assertNumQueries(12):
+            checkout_cart(self.cart, self.user)
+
+    def test_oversell_rolls_back_everything(self):
+        products = self.fill_cart(2)
+        Product.objects.filter(pk=products[0].pk).update(stock=1)
+        with self.assertRaises(OutOfStockError):
+            checkout_cart(self.cart, self.user)
+        self.assertFalse(self.user.order_set.exists())
+        self.assertEqual(Product.objects.get(pk=products[1].pk).stock, 5)
+        self.assertEqual(CartItem.objects.filter(cart=self.cart).count(), 2)
+
+    def test_checkout_view(self):
+        self.fill_cart(2)
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('checkout'))
+        self.assertTemplateUsed(response, 'api/checkout_success.html')
+        self.assertEqual(response.context['order'].user, self.user)
+
+
+class CartMutationTests(TestCase):
+    def setUp(self):
+        self.user = make_user()
+        self.cart = Cart.objects.create(user=self.user)
+        self.product = make_product()
+
+    def test_add_inserts_then_increments_in_place(self):
+        add_to_cart(self.cart, self.product.pk)
+        #hold increment, line increment, cart updated_at
+        with self.assertNumQueries(3):
+            add_to_cart(self.cart, self.product.pk, 2)
+        self.assertEqual(CartItem.objects.get(cart=self.cart).quantity, 3)
+
+    def test_add_unknown_product_raises(self):
+        with self.assertRaises(Product.DoesNotExist):
+            add_to_cart(self.cart, uuid.uuid4())
+
+    def test_batch_update_upserts_and_removes(self):
+        other = make_product(name='Other')
+        add_to_cart(self.cart, self.product.pk)
+        unknown = update_cart_items(self.cart, {str(self.product.pk): 5, str(other.pk): 2})
+        self.assertEqual(unknown, [])
+        self.assertEqual(
+            dict(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity')),
+            {self.product.pk: 5, other.pk: 2},
+        )
+        update_cart_items(self.cart, {str(other.pk): 0})
+        self.assertFalse(CartItem.objects.filter(cart=self.cart, product=other).exists())
+
+    def test_batch_view(self):
+        self.client.force_login(self.user)
+        response = self.client.post(
+            reverse('cart-batch'),
+            data=json.dumps({'items': [{'product': str(self.product.pk), 'quantity': 4}]}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.json()['updated'], 1)
+        self.assertEqual(CartItem.objects.get(cart=self.cart).quantity, 4)
+
+    def test_batch_view_rejects_bad_payload(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('cart-batch'), data='{"items": [{}]}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_add_view(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('cart-add', args=[self.product.pk]))
+        self.client.post(reverse('cart-add', args=[self.product.pk]))
+        self.assertEqual(CartItem.objects.get(cart__user=self.user).quantity, 2)
+
+
+class StockReservationTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product(stock=3)
+        self.first = Cart.objects.create(user=make_user('first'))
+        self.second = Cart.objects.create(user=make_user('second'))
+
+    def test_holds_stop_other_carts_from_overselling(self):
+        add_to_cart(self.first, self.product.pk, 2)
+        with self.assertRaises(InsufficientStockError) as raised:
+            add_to_cart(self.second, self.product.pk, 2)
+        self.assertEqual(raised.exception.available, 1)
+        self.assertFalse(CartItem.objects.filter(cart=self.second).exists())
+        add_to_cart(self.second, self.product.pk, 1)
+        self.assertEqual(StockReservation.objects.get(cart=self.first).quantity, 2)
+
+    def test_hot_add_does_not_touch_the_product_row(self):
+        add_to_cart(self.first, self.product.pk)
+        with CaptureQueriesContext(connection) as queries:
+            add_to_cart(self.first, self.product.pk)
+        self.assertFalse(any('"api_product"' in query['sql'] for query in queries.captured_queries))
+
+    def test_removing_a_line_releases_its_hold(self):
+        add_to_cart(self.first, self.product.pk, 3)
+        item = CartItem.objects.get(cart=self.first)
+        set_item_quantity(self.first, item.pk, 1)
+        self.assertEqual(StockReservation.objects.get(cart=self.first).quantity, 1)
+        remove_item(self.first, item.pk)
+        self.assertFalse(StockReservation.objects.exists())
+        add_to_cart(self.second, self.product.pk, 3)
+
+    def test_checkout_ignores_expired_holds_of_other_carts(self):
+        add_to_cart(self.first, self.product.pk, 3)
+        CartItem.objects.create(cart=self.second, product=self.product, quantity=1)
+        with self.assertRaises(OutOfStockError):
+            checkout_cart(self.second)
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(minutes=1))
+        checkout_cart(self.second)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).stock, 2)
+
+    def test_sweeper_releases_expired_holds(self):
+        add_to_cart(self.first, self.product.pk, 3)
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(minutes=1))
+        out = StringIO()
+        call_command('sweep_reservations', stdout=out)
+        self.assertIn('Released 1', out.getvalue())
+        self.assertFalse(StockReservation.objects.exists())
+        add_to_cart(self.second, self.product.pk, 3)
+
+    def test_a_drifted_counter_is_reseeded_before_refusing(self):
+        from .reservations import counters, held_key
+
+        add_to_cart(self.first, self.product.pk, 1)
+        #A release lost by a non-atomic incr leaves "held" too high
+        counters().incr(held_key(self.product.pk), 2)
+        add_to_cart(self.second, self.product.pk, 2)
+        self.assertEqual(counters().get(held_key(self.product.pk)), 3)
+        with self.assertRaises(InsufficientStockError):
+            add_to_cart(self.second, self.product.pk, 1)
+
+    def test_releasing_more_than_the_hold_only_gives_back_the_hold(self):
+        from .reservations import counters, held_key, reserve
+
+        add_to_cart(self.first, self.product.pk, 1)
+        add_to_cart(self.second, self.product.pk, 2)
+        reserve(self.first, self.product.pk, -5)
+        self.assertEqual(counters().get(held_key(self.product.pk)), 2)
+        with self.assertRaises(InsufficientStockError):
+            add_to_cart(self.first, self.product.pk, 2)
+
+
+class OrderTotalTests(TestCase):
+    def setUp(self):
+        self.order = Order.objects.create(user=make_user())
+        self.product = make_product()
+
+    def test_total_follows_item_changes(self):
+        item = OrderItem.objects.create(order=self.order, product=self.product, price=Decimal('2.50'), quantity=2)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.total, Decimal('5.00'))
+
+        item = OrderItem.objects.get(pk=item.pk)
+        item.quantity = 4
+        item.save()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.total_price, Decimal('10.00'))
+
+        item.delete()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.total, Decimal('0.00'))
+
+    def test_backfill_command_fixes_and_verifies(self):
+        OrderItem.objects.bulk_create([
+            OrderItem(order=self.order, product=self.product, price=Decimal('1.00'), quantity=3),
+        ])
+        out = StringIO()
+        call_command('backfill_order_totals', '--verify', stdout=out)
+        self.assertIn('1 with a wrong total', out.getvalue())
+
+        call_command('backfill_order_totals', '--batch-size', '1', stdout=StringIO())
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.total, Decimal('3.00'))
+
+
+class LeanSerializerTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        users = [make_user(f'buyer{i}') for i in range(10)]
+        product = make_product(seller=users[0])
+        for i in range(100):
+            order = Order.objects.create(user=users[i % 10])
+            OrderItem.objects.create(order=order, product=product, price=Decimal('4.00'), quantity=2)
+
+    def test_order_list_is_two_queries(self):
+        queryset = OrderSerializer.setup_eager_loading(Order.objects.all())
+        with self.assertNumQueries(2):
+            data = OrderSerializer(queryset, many=True).data
+        self.assertEqual(len(data), 100)
+        self.assertEqual(set(data[0]['user']), {'id', 'username'})
+        self.assertEqual(data[0]['total_price'], Decimal('8.00'))
+        self.assertEqual(len(data[0]['items']), 1)
+
+    def test_product_payload_has_no_private_user_fields(self):
+        queryset = ProductSerializer.setup_eager_loading(Product.objects.all())
+        with self.assertNumQueries(1):
+            data = ProductSerializer(queryset, many=True).data
+        self.assertNotIn('password', data[0]['seller'])
+
+
+class RestApiTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_user()
+        cls.other = make_user('other')
+        cls.products = [make_product(name=f'Api {i}') for i in range(5)]
+        cls.order = Order.objects.create(user=cls.user)
+        Order.objects.create(user=cls.other)
+
+    def test_product_list_is_cursor_paginated(self):
+        response = self.client.get('/api/v1/products/?page_size=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 2)
+        self.assertIsNotNone(response.json()['next'])
+
+    def test_sparse_fieldsets(self):
+        response = self.client.get('/api/v1/products/?fields=id,name')
+        self.assertEqual(set(response.json()['results'][0]), {'id', 'name'})
+
+    def test_etag_round_trip_returns_304(self):
+        url = f'/api/v1/products/{self.products[0].pk}/'
+        first = self.client.get(url)
+        self.assertIn('Last-Modified', first)
+        second = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 304)
+
+        product = Product.objects.get(pk=self.products[0].pk)
+        product.price = Decimal('99.00')
+        product.save()
+        third = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(third.status_code, 200)
+
+    def test_cart_etag_follows_product_prices(self):
+        self.client.force_login(self.user)
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.products[0], quantity=2)
+        url = f'/api/v1/carts/{cart.pk}/'
+        first = self.client.get(url)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+
+        product = Product.objects.get(pk=self.products[0].pk)
+        product.price += 1
+        product.save()
+        second = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(Decimal(second.json()['total_price']), product.price * 2)
+
+    def test_order_etag_changes_when_a_line_changes_at_the_same_subtotal(self):
+        self.client.force_login(self.user)
+        item = OrderItem.objects.create(order=self.order, product=self.products[0], price=Decimal('5.00'), quantity=2)
+        url = f'/api/v1/orders/{self.order.pk}/'
+        first = self.client.get(url)
+        item.product = self.products[1]
+        item.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 200)
+
+    def test_list_etag(self):
+        first = self.client.get('/api/v1/products/')
+        self.assertEqual(self.client.get('/api/v1/products/', HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+
+    def test_orders_are_scoped_to_owner(self):
+        self.assertEqual(self.client.get('/api/v1/orders/').status_code, 403)
+        self.client.force_login(self.user)
+        results = self.client.get('/api/v1/orders/').json()['results']
+        self.assertEqual([row['order_id'] for row in results], [str(self.order.pk)])
+
+    def test_create_review(self):
+        self.client.force_login(self.user)
+        response = self.client.post('/api/v1/reviews/', {'product': str(self.products[0].pk), 'comment': 'Great'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['user']['username'], self.user.username)
+
+    def test_review_filter_takes_any_uuid_spelling(self):
+        Review.objects.create(user=self.user, product=self.products[0], comment='Fine')
+        Review.objects.create(user=self.user, product=self.products[1], comment='Fine')
+        for spelling in (str(self.products[0].pk).upper(), self.products[0].pk.hex):
+            results = self.client.get(f'/api/v1/reviews/?product={spelling}').json()['results']
+            self.assertEqual([row['product'] for row in results], [str(self.products[0].pk)])
+        self.assertEqual(len(self.client.get('/api/v1/reviews/?product=nope').json()['results']), 2)
+
+    def test_cart_list_query_count_does_not_grow_with_carts(self):
+        staff = make_user('staff', is_staff=True)
+        self.client.force_login(staff)
+        counts = []
+        for user in (self.user, self.other):
+            cart = Cart.objects.create(user=user)
+            for product in self.products[:3]:
+                CartItem.objects.create(cart=cart, product=product, quantity=1)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/api/v1/carts/')
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(queries))
+        self.assertEqual(len(response.json()['results']), 2)
+        self.assertEqual(counts[0], counts[1])
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        self.shoes = make_product(name='Trail running shoes', price=Decimal('80.00'), category=Product.Categories.SPORTS)
+        self.shirt = make_product(name='Cotton shirt', description='Good for running', price=Decimal('20.00'), category=Product.Categories.FASHION)
+        make_product(name='Cookbook', description='Recipes')
+
+    def test_ranked_results_prefer_name_matches(self):
+        results = get_search_backend().search('running')
+        self.assertEqual(results, [self.shoes, self.shirt])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.shoes.name = 'Hiking boots'
+        self.shoes.description = ''
+        self.shoes.save()
+        self.assertEqual(get_search_backend().search('running'), [self.shirt])
+        self.shirt.delete()
+        self.assertEqual(get_search_backend().search('running'), [])
+
+    def test_index_updates_go_by_rowid_and_skip_unchanged_text(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('FTS5 is SQLite specific')
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN DELETE FROM api_product_fts WHERE rowid = 1')
+            plan = ' '.join(str(row) for row in cursor.fetchall())
+        self.assertIn('INDEX 0:=', plan)
+
+        product = Product.objects.get(pk=self.shoes.pk)
+        product.stock = 3
+        with CaptureQueriesContext(connection) as captured:
+            product.save()
+        self.assertFalse([query for query in captured if 'api_product_fts' in query['sql']])
+
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(get_search_backend().search('running'), [self.shoes, self.shirt])
+        get_search_backend().remove_product(self.shirt.pk)
+        self.assertEqual(get_search_backend().search('running'), [self.shoes])
+
+    def test_autocomplete_prefix(self):
+        self.assertEqual(get_search_backend().autocomplete('tra'), ['Trail running shoes'])
+
+    def test_facets(self):
+        facets = get_search_backend().facets('running')
+        self.assertEqual(facets['category'][Product.Categories.SPORTS], 1)
+        self.assertEqual(facets['category'][Product.Categories.BOOKS], 0)
+        self.assertEqual(facets['price'], {'0-25': 1, '25-50': 0, '50-100': 1, '100-250': 0, '250+': 0})
+
+    def test_search_endpoint_filters_by_category(self):
+        response = self.client.get('/api/v1/search/', {'q': 'running', 'category': 'fashion & apparel'})
+        self.assertEqual([row['id'] for row in response.json()['results']], [str(self.shirt.pk)])
+        self.assertIn('facets', response.json())
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product(name='Lamp', category=Product.Categories.HOME)
+
+    def test_detail_is_served_from_cache_until_product_changes(self):
+        url = reverse('product-detail', args=[self.product.pk])
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertContains(response, 'Lamp')
+
+        self.product.name = 'Desk lamp'
+        self.product.save()
+        self.assertContains(self.client.get(url), 'Desk lamp')
+
+    def test_category_move_invalidates_both_lists(self):
+        home = reverse('product-list-by-category', args=[Product.Categories.HOME])
+        toys = reverse('product-list-by-category', args=[Product.Categories.TOYS])
+        self.assertEqual(len(self.client.get(home).context['page']), 1)
+        self.assertEqual(len(self.client.get(toys).context['page']), 0)
+
+        product = Product.objects.get(pk=self.product.pk)
+        product.category = Product.Categories.TOYS
+        product.save()
+        self.assertEqual(len(self.client.get(home).context['page']), 0)
+        self.assertEqual(len(self.client.get(toys).context['page']), 1)
+
+    def test_checkout_invalidates_cached_stock(self):
+        url = f'/api/v1/products/{self.product.pk}/'
+        self.assertEqual(self.client.get(url).json()['stock'], 10)
+        user = make_user()
+        cart = Cart.objects.create(user=user)
+        add_to_cart(cart, self.product.pk, 3)
+        toys = reverse('product-list-by-category', args=[Product.Categories.TOYS])
+        self.client.get(toys)
+        with self.captureOnCommitCallbacks(execute=True):
+            checkout_cart(cart, user)
+        self.assertEqual(self.client.get(url).json()['stock'], 7)
+        self.assertEqual(self.client.get('/api/v1/products/').json()['results'][0]['stock'], 7)
+        #Lists of the categories the order didn't touch stay cached
+        with self.assertNumQueries(0):
+            self.client.get(toys)
+
+    def test_detail_is_invalidated_for_any_spelling_of_the_id(self):
+        urls = [f'/api/v1/products/{spelling}/' for spelling in (str(self.product.pk).upper(), self.product.pk.hex)]
+        for url in urls:
+            self.assertEqual(self.client.get(url).json()['name'], 'Lamp')
+        self.product.name = 'Desk lamp'
+        self.product.save()
+        for url in urls:
+            self.assertEqual(self.client.get(url).json()['name'], 'Desk lamp')
+        self.assertEqual(self.client.get('/api/v1/products/not-a-uuid/').status_code, 404)
+
+    def test_get_or_set_builds_once(self):
+        calls = []
+        for _ in range(3):
+            catalog_cache.get_or_set('test-key', lambda: calls.append(1) or 'value')
+        self.assertEqual(calls, [1])
+
+    def test_a_timed_out_wait_leaves_the_other_builders_lock(self):
+        key = 'test-locked-key'
+        with self.settings(CATALOG_CACHE=dict(settings.CATALOG_CACHE, LOCK_WAIT=0.1)):
+            catalog_cache.shared.add(key + ':lock', 1)
+            self.assertEqual(catalog_cache.get_or_set(key, lambda: 'built anyway'), 'built anyway')
+            self.assertIsNotNone(catalog_cache.shared.get(key + ':lock'))
+
+    def test_shared_tier_is_shared_by_every_worker(self):
+        self.assertNotIn('LocMemCache', type(catalog_cache.shared).__name__)
+
+    async def test_async_get_or_set_awaits_other_builders_without_blocking_the_loop(self):
+        key = 'test-async-key'
+        await catalog_cache.shared.aadd(key + ':lock', 1)
+
+        async def other_process():
+            await asyncio.sleep(0.1)
+            await catalog_cache.shared.aset(key, 'built elsewhere')
+
+        async def producer():
+            return 'built here'
+
+        value, _ = await asyncio.gather(catalog_cache.aget_or_set(key, producer), other_process())
+        self.assertEqual(value, 'built elsewhere')
+
+
+class SessionCartTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product()
+        self.other = make_product(name='Other')
+        self.user = make_user()
+
+    def test_anonymous_cart_merges_on_login(self):
+        self.client.post(reverse('cart-add', args=[self.product.pk]))
+        self.client.post(reverse('cart-add', args=[self.other.pk]))
+        anonymous = Cart.objects.get(user=None)
+        self.assertIsNotNone(anonymous.session_key)
+
+        add_to_cart(Cart.objects.create(user=self.user), self.product.pk, 2)
+        self.client.post(reverse('login'), {'username': self.user.email, 'password': 'pass12345'})
+
+        self.assertFalse(Cart.objects.filter(pk=anonymous.pk).exists())
+        self.assertEqual(
+            dict(CartItem.objects.filter(cart__user=self.user).values_list('product_id', 'quantity')),
+            {self.product.pk: 3, self.other.pk: 1},
+        )
+
+    def test_anonymous_cart_view_without_session(self):
+        response = self.client.get(reverse('cart'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Cart.objects.exists())
+
+    def test_session_db_writes_are_batched(self):
+        from django.contrib.sessions.models import Session
+        from .sessions import SessionStore
+
+        store = SessionStore()
+        store['step'] = 1
+        store.save()
+        store['step'] = 2
+        store.save()
+        store['step'] = 3
+        store.save()
+        #later saves only reached the cache and queued a single flush for the end of the interval
+        self.assertEqual(Session.objects.get(pk=store.session_key).get_decoded()['step'], 1)
+        self.assertEqual(SessionStore(store.session_key).load()['step'], 3)
+        flush = Job.objects.get(name='flush_session')
+        self.assertGreater(flush.run_at, timezone.now())
+
+        Job.objects.update(run_at=timezone.now())
+        self.assertEqual(run_pending(), [True])
+        self.assertEqual(Session.objects.get(pk=store.session_key).get_decoded()['step'], 3)
+
+        #The next cache-only change queues the same row again instead of adding one
+        cache_alias = caches[settings.SESSION_CACHE_ALIAS]
+        cache_alias.delete(store.flush_marker_key)
+        store['step'] = 4
+        store.save()
+        store['step'] = 5
+        store.save()
+        self.assertEqual(list(Job.objects.values_list('status', 'attempts')), [(Job.Status.QUEUED, 0)])
+        store.delete()
+
+    def test_async_saves_write_behind_too(self):
+        from django.contrib.sessions.models import Session
+        from .sessions import SessionStore
+
+        store = SessionStore()
+
+        async def save_steps():
+            for step in (1, 2, 3):
+                await store.aset('step', step)
+                await store.asave()
+
+        async_to_sync(save_steps)()
+        self.assertEqual(Session.objects.get(pk=store.session_key).get_decoded()['step'], 1)
+        self.assertEqual(SessionStore(store.session_key).load()['step'], 3)
+        self.assertEqual(Job.objects.get().idempotency_key, f'flush-session:{store.session_key}')
+        async_to_sync(store.adelete)()
+        self.assertFalse(Session.objects.exists())
+
+
+def make_png(width=900, height=600):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 30, 30)).save(buffer, 'PNG')
+    return SimpleUploadedFile('photo.PNG', buffer.getvalue(), content_type='image/png')
+
+
+class ImagePipelineTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        overrides = override_settings(MEDIA_ROOT=self.media_root, IMAGE_PIPELINE={'ASYNC': False})
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def test_upload_is_stored_by_content_hash_with_webp_variants(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = make_product(image=make_png())
+        self.assertRegex(product.image.name, r'^products/[0-9a-f]{32}\.png$')
+
+        product.refresh_from_db()
+        self.assertEqual(product.image_variants['source'], product.image.name)
+        from PIL import Image
+        with Image.open(f"{self.media_root}/{product.image_variants['thumb']}") as thumb:
+            self.assertEqual(thumb.format, 'WEBP')
+            self.assertEqual(thumb.size, (160, 107))
+        self.assertTrue(product.card_image_url.endswith('-card.webp'))
+
+    def test_same_image_reuses_the_same_name(self):
+        first = make_product(image=make_png())
+        second = make_product(image=make_png())
+        self.assertEqual(first.image.name, second.image.name)
+
+    def test_profile_image_variants(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            user = make_user()
+            user.profile_image = make_png(300, 300)
+            user.save()
+        user.refresh_from_db()
+        self.assertRegex(user.profile_image.name, r'^profile_images/[0-9a-f]{32}\.png$')
+        self.assertTrue(user.avatar_url.endswith('-thumb.webp'))
+
+    def test_media_is_served_with_far_future_cache_headers(self):
+        from django.test import RequestFactory
+        from .views import media_file
+        product = make_product(image=make_png())
+        response = media_file(RequestFactory().get('/media/'), product.image.name)
+        self.assertIn('immutable', response['Cache-Control'])
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product(name='Async lamp')
+        self.user = make_user()
+
+    async def test_async_catalog_pages(self):
+        response = await self.async_client.get(reverse('async-product-list'))
+        self.assertContains(response, 'Async lamp')
+        response = await self.async_client.get(reverse('async-product-detail', args=[self.product.pk]))
+        self.assertContains(response, 'Async lamp')
+
+    async def test_async_cart_flow(self):
+        await self.async_client.aforce_login(self.user)
+        await self.async_client.post(reverse('async-cart-add', args=[self.product.pk]))
+        await self.async_client.post(reverse('async-cart-add', args=[self.product.pk]))
+        response = await self.async_client.get(reverse('async-cart'))
+        self.assertEqual(response.context['total'], Decimal('20.00'))
+
+        item = response.context['cart_items'][0]
+        await self.async_client.post(reverse('async-cart-update', args=[item.pk]), {'quantity': 5})
+        self.assertEqual((await CartItem.objects.aget(pk=item.pk)).quantity, 5)
+        await self.async_client.post(reverse('async-cart-remove', args=[item.pk]))
+        self.assertFalse(await CartItem.objects.filter(pk=item.pk).aexists())
+
+
+class ProductImportExportTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.seller = make_user('supplier', is_seller=True)
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+    def write(self, name, text):
+        path = f'{self.tmp}/{name}'
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+    def test_csv_import_rejects_bad_rows_and_keeps_the_rest(self):
+        path = self.write('feed.csv', (
+            'name,description,price,stock,category,seller\n'
+            'Lamp,Bright,19.99,4,home,supplier\n'
+            'Free lamp,Bad,0,4,home,supplier\n'
+            'Ghost,Bad,5,4,nowhere,supplier\n'
+            'Desk,Oak,120,2,Home & Living,\n'
+        ))
+        out, err = StringIO(), StringIO()
+        call_command('import_products', path, '--batch-size', '2', stdout=out, stderr=err)
+        self.assertIn('Imported 2 of 4 rows', out.getvalue())
+        self.assertIn('line 3: price: Price must be greater than zero.', err.getvalue())
+        self.assertIn('line 4: category', err.getvalue())
+        lamp = Product.objects.get(name='Lamp')
+        self.assertEqual((lamp.price, lamp.seller, lamp.category), (Decimal('19.99'), self.seller, Product.Categories.HOME))
+        self.assertEqual(get_search_backend().search('bright'), [lamp])
+
+    def test_jsonl_upserts_by_id(self):
+        product = make_product(name='Old name', stock=1)
+        path = self.write('feed.jsonl', (
+            json.dumps({'id': str(product.pk), 'name': 'New name', 'description': 'x', 'price': '9.50', 'stock': 7, 'category': 'BOOKS'}) + '\n'
+            + 'not json\n'
+        ))
+        err = StringIO()
+        call_command('import_products', path, stdout=StringIO(), stderr=err)
+        product.refresh_from_db()
+        self.assertEqual((product.name, product.stock, product.price), ('New name', 7, Decimal('9.50')))
+        self.assertEqual(Product.objects.count(), 1)
+        self.assertIn('invalid JSON', err.getvalue())
+
+    def test_export_round_trips_through_import(self):
+        make_product(name='Pen', seller=self.seller)
+        make_product(name='Ball', category=Product.Categories.SPORTS)
+        path = f'{self.tmp}/export.csv'
+        call_command('export_products', path, stdout=StringIO())
+        Product.objects.update(stock=0)
+        #seller lookup, then per batch: savepoint, upserts with and without a seller, search delete, search insert, release
+        with self.assertNumQueries(7):
+            call_command('import_products', path, stdout=StringIO())
+        self.assertEqual(set(Product.objects.values_list('name', 'stock')), {('Pen', 10), ('Ball', 10)})
+        self.assertEqual(Product.objects.get(name='Pen').seller, self.seller)
+
+    def test_blank_seller_cells_keep_the_stored_seller(self):
+        pen = make_product(name='Pen', seller=self.seller)
+        path = self.write('partial.csv', (
+            'id,name,description,price,stock,category,seller\n'
+            f'{pen.pk},Pen,Blue,2.50,8,books,\n'
+        ))
+        call_command('import_products', path, stdout=StringIO())
+        pen.refresh_from_db()
+        self.assertEqual((pen.stock, pen.seller), (8, self.seller))
+
+
+class ReplicaRouterTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.router = PrimaryReplicaRouter()
+
+    @override_settings(REPLICA_DATABASES=[])
+    def test_without_replicas_everything_stays_on_default(self):
+        self.assertIsNone(self.router.db_for_read(Product))
+
+    @override_settings(REPLICA_DATABASES=['replica'])
+    def test_catalog_reads_go_to_replica_unless_pinned(self):
+        #TestCase wraps every test in a transaction, step outside of it the way a request would
+        with mock.patch.object(connection, 'in_atomic_block', False):
+            self.assertEqual(self.router.db_for_read(Product), 'replica')
+            self.assertEqual(self.router.db_for_read(Review), 'replica')
+            self.assertIsNone(self.router.db_for_read(Order))
+            token = pin_to_primary()
+            try:
+                self.assertEqual(self.router.db_for_read(Product), 'default')
+            finally:
+                unpin(token)
+        self.assertEqual(self.router.db_for_read(Product), 'default')
+        self.assertEqual(self.router.db_for_write(Product), 'default')
+        self.assertFalse(self.router.allow_migrate('replica', 'api'))
+
+    @override_settings(REPLICA_DATABASES=['replica'])
+    def test_catalog_cache_is_filled_from_the_primary(self):
+        async def aproducer():
+            return self.router.db_for_read(Product)
+
+        outside_transactions = {'default': mock.Mock(in_atomic_block=False)}
+        with mock.patch('api.routers.connections', outside_transactions):
+            self.assertEqual(self.router.db_for_read(Product), 'replica')
+            self.assertEqual(catalog_cache.get_or_set('test-primary', lambda: self.router.db_for_read(Product)), 'default')
+            self.assertEqual(async_to_sync(catalog_cache.aget_or_set)('test-primary-async', aproducer), 'default')
+            self.assertEqual(self.router.db_for_read(Product), 'replica')
+
+    @override_settings(REPLICA_DATABASES=['replica'])
+    def test_writes_pin_the_client_to_the_primary(self):
+        from django.test import RequestFactory
+        factory = RequestFactory()
+        response = self.client.post(reverse('cart-add', args=[make_product().pk]))
+        self.assertIn(PIN_COOKIE, response.cookies)
+        pinned = factory.get('/', HTTP_COOKIE=f'{PIN_COOKIE}={response.cookies[PIN_COOKIE].value}')
+        self.assertTrue(request_is_pinned(pinned))
+        self.assertFalse(request_is_pinned(factory.get('/')))
+
+
+@override_settings(INSTRUMENTATION={'ENABLED': True, 'SLOW_QUERY_MS': None})
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+
+    def test_server_timing_reports_queries_templates_and_cache(self):
+        make_product()
+        response = self.client.get(reverse('product-list'))
+        timing = response['Server-Timing']
+        self.assertIn('db;dur=', timing)
+        self.assertIn('"1 queries, 0 repeated"', timing)
+        self.assertIn('tpl;dur=', timing)
+        self.assertIn('cache;desc=', timing)
+        self.assertNotIn('"0 hits, 0 misses"', timing)
+
+    def test_metrics_endpoint_is_staff_only_and_prometheus_formatted(self):
+        self.client.get(reverse('product-list'))
+        self.client.get(reverse('product-list'))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+
+        self.client.force_login(make_user('ops', is_staff=True))
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('http_request_duration_seconds{view="product-list",quantile="0.99"}', body)
+        self.assertIn('http_request_duration_seconds_count{view="product-list"} 2', body)
+        self.assertIn('http_request_db_queries_total{view="product-list"}', body)
+
+    @override_settings(INSTRUMENTATION={'ENABLED': True, 'SLOW_QUERY_MS': 0})
+    def test_slow_queries_are_logged(self):
+        with self.assertLogs('api.metrics', 'WARNING') as logs:
+            self.client.get(reverse('product-list'))
+        self.assertIn('Slow query', logs.output[0])
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        self.seller = make_user('seller', is_seller=True)
+        self.product = make_product(seller=self.seller, stock=3)
+        self.cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=self.cart, product=self.product, quantity=2)
+
+    def test_checkout_side_effects_run_in_the_worker(self):
+        order = checkout_cart(self.cart, self.user)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(Job.objects.filter(status=Job.Status.QUEUED).count(), 4)
+
+        call_command('run_jobs', '--once', '--concurrency', '1', stdout=StringIO())
+        #Plus the sales rollup update queued when the payment marked the order paid
+        self.assertEqual(Job.objects.filter(status=Job.Status.DONE).count(), 5)
+        self.assertEqual(list(SalesRollup.objects.values_list('status', 'units')), [(Order.Status.PAID, 2)])
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), ['seller@example.com', 'shopper@example.com'])
+        payment = Payment.objects.get(transaction_id=f'order-{order.pk}')
+        self.assertEqual(payment.amount, Decimal('20.00'))
+
+    def test_idempotency_key_deduplicates(self):
+        enqueue('create_order_payment', {'order_id': 'x'}, idempotency_key='same')
+        enqueue('create_order_payment', {'order_id': 'x'}, idempotency_key='same')
+        self.assertEqual(Job.objects.count(), 1)
+
+    def test_failures_back_off_then_give_up(self):
+        calls = []
+
+        @job('test_flaky')
+        def flaky():
+            calls.append(1)
+            raise RuntimeError('boom')
+
+        self.addCleanup(registry.pop, 'test_flaky')
+        enqueue('test_flaky', max_attempts=2)
+        with self.assertLogs('api.jobs', 'ERROR'):
+            self.assertEqual(run_pending(), [False])
+        queued = Job.objects.get()
+        self.assertEqual((queued.status, queued.attempts), (Job.Status.QUEUED, 1))
+        self.assertIn('boom', queued.last_error)
+        #Not due yet because of the backoff
+        self.assertEqual(run_pending(), [])
+
+        Job.objects.update(run_at=timezone.now())
+        with self.assertLogs('api.jobs', 'ERROR'):
+            self.assertEqual(run_pending(), [False])
+        self.assertEqual(Job.objects.get().status, Job.Status.FAILED)
+        self.assertEqual(len(calls), 2)
+
+    def test_prune_deletes_old_done_jobs_only(self):
+        old = timezone.now() - timedelta(days=8)
+        for i, status in enumerate([Job.Status.DONE, Job.Status.DONE, Job.Status.FAILED, Job.Status.QUEUED]):
+            enqueue('noop', idempotency_key=f'old-{i}')
+            Job.objects.filter(idempotency_key=f'old-{i}').update(status=status, updated_at=old)
+        enqueue('noop', idempotency_key='recent')
+        Job.objects.filter(idempotency_key='recent').update(status=Job.Status.DONE)
+        out = StringIO()
+        call_command('prune_jobs', '--batch-size', '1', stdout=out)
+        self.assertIn('Deleted 2 done jobs', out.getvalue())
+        self.assertEqual(set(Job.objects.values_list('idempotency_key', flat=True)), {'old-2', 'old-3', 'recent'})
+
+    def test_stale_running_job_is_claimed_again(self):
+        enqueue('create_order_payment', {'order_id': 'x'})
+        first = claim_jobs()
+        self.assertEqual(claim_jobs(), [])
+        Job.objects.update(locked_at=timezone.now() - timedelta(hours=1))
+        again = claim_jobs()
+        self.assertEqual([j.pk for j in again], [j.pk for j in first])
+        self.assertNotEqual(again[0].claim_token, first[0].claim_token)
+        self.assertEqual(again[0].attempts, 2)
+
+    def test_stale_job_without_attempts_left_is_failed_instead_of_claimed(self):
+        enqueue('create_order_payment', {'order_id': 'x'}, max_attempts=1)
+        self.assertEqual(len(claim_jobs()), 1)
+        Job.objects.update(locked_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(claim_jobs(), [])
+        self.assertEqual(Job.objects.get().status, Job.Status.FAILED)
+
+    @override_settings(JOB_QUEUE={'HEARTBEAT_INTERVAL': 0.01})
+    def test_running_jobs_refresh_their_lock(self):
+        @job('test_slow')
+        def slow():
+            time.sleep(0.1)
+
+        self.addCleanup(registry.pop, 'test_slow')
+        enqueue('test_slow')
+        with mock.patch('api.jobs.extend_lock') as extend_lock:
+            self.assertEqual(run_pending(), [True])
+        self.assertGreater(extend_lock.call_count, 1)
+
+    def test_low_stock_alert_skips_products_without_a_seller(self):
+        orphan = make_product(name='Orphan', stock=1)
+        enqueue('check_low_stock', {'product_ids': [str(orphan.pk), str(self.product.pk)]})
+        self.assertEqual(run_pending(), [True])
+        self.assertEqual([message.to for message in mail.outbox], [['seller@example.com']])
+
+
+#Outside TestCase's wrapping transaction so BEGIN IMMEDIATE and retries can be seen
+@isolated_caches
+class SqliteProfileTests(TransactionTestCase):
+    def test_checkout_begins_immediate(self):
+        user = make_user()
+        cart = Cart.objects.create(user=user)
+        CartItem.objects.create(cart=cart, product=make_product(), quantity=1)
+        with CaptureQueriesContext(connection) as queries:
+            checkout_cart(cart, user)
+        self.assertEqual(queries.captured_queries[0]['sql'], 'BEGIN IMMEDIATE')
+        self.assertIsNone(connection.transaction_mode)
+
+    def test_locked_errors_are_retried(self):
+        attempts = []
+
+        @retry_if_locked
+        def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise OperationalError('database is locked')
+            return 'done'
+
+        with override_settings(SQLITE_TUNING={'RETRY_DELAY': 0}):
+            self.assertEqual(flaky(), 'done')
+        self.assertEqual(len(attempts), 3)
+
+    @override_settings(SQLITE_TUNING={'ENABLED': True, 'BUSY_TIMEOUT': 1234})
+    def test_profile_pragmas_are_applied_to_new_connections(self):
+        #The in-memory test database is never reconnected, so run the receiver directly
+        connection.ensure_connection()
+        configure_connection(sender=connection.__class__, connection=connection)
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 1234)
+            cursor.execute('PRAGMA busy_timeout = 5000')
+
+    def test_benchmark_command_compares_profiles(self):
+        out = StringIO()
+        call_command('benchmark_sqlite', '--duration', '0.2', '--threads', '2', '--rows', '50', '--json', stdout=out)
+        self.assertEqual([result['label'] for result in json.loads(out.getvalue())], ['default', 'tuned'])
+
+
+#The sync half of the benchmark runs on worker threads with their own connections,
+#which can't see (or wait on) data inside TestCase's open transaction
+@isolated_caches
+class AsyncBenchmarkCommandTests(TransactionTestCase):
+    #Catalog reads may be routed to a replica alias (DB_REPLICA=1)
+    databases = '__all__'
+
+    def test_benchmark_command_reports_both_paths(self):
+        make_product()
+        out = StringIO()
+        call_command('benchmark_async_views', '--requests', '4', '--concurrency', '2', '--json', stdout=out)
+        results = json.loads(out.getvalue())
+        self.assertEqual([row['label'] for row in results], ['sync', 'async'])
+        self.assertTrue(all(row['requests'] == 4 for row in results))
+
+
+#Upper bounds on the queries each page and endpoint runs against a small fixture, measured
+#from a cold catalog cache as a logged in seller. Counts include the session user lookup and
+#savepoints. Raise a budget only together with the change that needs it.
+@override_settings(PAYMENTS={'WEBHOOK_SECRET': 'test-webhook-secret'})
+class QueryBudgetTests(TestCase):
+    BUDGETS = {
+        'register': ('get', 1),
+        'home': ('get', 1),
+        'login': ('get', 1),
+        'logout': ('post', 2),
+        'product-list': ('get', 2),
+        'product-list-by-category': ('get', 2),
+        'product-detail': ('get', 2),
+        'product-create': ('get', 1),
+        'cart': ('get', 3),
+        'cart-add': ('post', 13),
+        'cart-update': ('post', 10),
+        'cart-remove': ('post', 8),
+        'cart-batch': ('post', 13),
+        'checkout': ('post', 14),
+        'async-product-list': ('get', 2),
+        'async-product-list-by-category': ('get', 2),
+        'async-product-detail': ('get', 2),
+        'async-cart': ('get', 3),
+        'async-cart-add': ('post', 9),
+        'async-cart-update': ('post', 8),
+        'async-cart-remove': ('post', 8),
+        'metrics': ('get', 1),
+        'payment-webhook': ('post', 6),
+        'api-search': ('get', 5),
+        'api-search-autocomplete': ('get', 2),
+        'api-sales-report': ('get', 2),
+        'api-root': ('get', 1),
+        'api-product-list': ('get', 2),
+        'api-product-detail': ('get', 2),
+        'api-order-list': ('get', 3),
+        'api-order-detail': ('get', 3),
+        'api-cart-list': ('get', 3),
+        'api-cart-detail': ('get', 3),
+        'api-payment-list': ('get', 2),
+        'api-payment-detail': ('get', 2),
+        'api-review-list': ('get', 2),
+        'api-review-detail': ('get', 2),
+        'order-history': ('get', 2),
+        'api-order-history': ('get', 2),
+        'api-product-reviews': ('get', 2),
+        'api-product-review-summaries': ('get', 2),
+        'api-seller-product-list': ('get', 2),
+        'api-seller-product-detail': ('get', 2),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_user(role='seller', is_staff=True)
+        cls.products = [make_product(name=f'Budget lamp {i}', seller=cls.user) for i in range(5)]
+        cls.cart = Cart.objects.create(user=cls.user)
+        cls.item = CartItem.objects.create(cart=cls.cart, product=cls.products[0], quantity=1)
+        cls.order = Order.objects.create(user=cls.user)
+        OrderItem.objects.create(order=cls.order, product=cls.products[1], price=Decimal('10.00'), quantity=2)
+        cls.payment = Payment.objects.create(user=cls.user, amount=Decimal('20.00'))
+        cls.review = Review.objects.create(user=cls.user, product=cls.products[0], comment='Bright')
+
+    def request_for(self, name):
+        args = {
+            'product-list-by-category': [Product.Categories.BOOKS],
+            'async-product-list-by-category': [Product.Categories.BOOKS],
+            'product-detail': [self.products[0].pk],
+            'async-product-detail': [self.products[0].pk],
+            'cart-add': [self.products[2].pk],
+            'async-cart-add': [self.products[2].pk],
+            'cart-update': [self.item.pk],
+            'async-cart-update': [self.item.pk],
+            'cart-remove': [self.item.pk],
+            'async-cart-remove': [self.item.pk],
+            'api-product-detail': [self.products[0].pk],
+            'api-order-detail': [self.order.pk],
+            'api-cart-detail': [self.cart.pk],
+            'api-payment-detail': [self.payment.pk],
+            'api-review-detail': [self.review.pk],
+            'api-seller-product-detail': [self.products[0].pk],
+            'api-product-reviews': [self.products[0].pk],
+        }.get(name, [])
+        url = reverse(name, args=args)
+        if name in ('api-search', 'api-search-autocomplete'):
+            url += '?q=lamp'
+        if name == 'api-product-review-summaries':
+            url += '?ids=' + ','.join(str(product.pk) for product in self.products)
+        if name == 'cart-batch':
+            return {'path': url, 'data': {'items': [{'product': str(self.products[3].pk), 'quantity': 2}]}, 'content_type': 'application/json'}
+        if name == 'payment-webhook':
+            LocalGateway().charge(self.order, 'budget-charge')
+            body, signature = LocalGateway().webhook([LocalGateway().update('budget-charge', Payment.PaymentStatus.COMPLETED)])
+            return {'path': url, 'data': body, 'content_type': 'application/json', 'HTTP_X_PAYMENT_SIGNATURE': signature}
+        if name.endswith('cart-update'):
+            return {'path': url, 'data': {'quantity': 3}}
+        return {'path': url}
+
+    def test_every_url_has_a_budget(self):
+        from .urls import urlpatterns
+
+        def names(patterns):
+            for pattern in patterns:
+                if hasattr(pattern, 'url_patterns'):
+                    yield from names(pattern.url_patterns)
+                elif pattern.name:
+                    yield pattern.name
+
+        self.assertEqual(set(names(urlpatterns)) - {'media'}, set(self.BUDGETS))
+
+    def test_views_stay_within_their_query_budget(self):
+        for name, (method, budget) in self.BUDGETS.items():
+            with self.subTest(name), transaction.atomic():
+                self.client.force_login(self.user)
+                cache.clear()
+                catalog_cache.clear_local()
+                #Resolve the session's roles first, budgets are for a returning visitor
+                self.client.get(reverse('home'))
+                with CaptureQueriesContext(connection) as captured:
+                    response = getattr(self.client, method)(**self.request_for(name))
+                self.assertLess(response.status_code, 400)
+                self.assertLessEqual(
+                    len(captured), budget, '\n'.join(query['sql'] for query in captured.captured_queries)
+                )
+                transaction.set_rollback(True)
+
+
+class SerializerQueryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [make_user(f'budget{i}') for i in range(5)]
+        products = [make_product(name=f'Budget {i}', seller=cls.users[i]) for i in range(5)]
+        for user in cls.users:
+            cart = Cart.objects.create(user=user)
+            order = Order.objects.create(user=user)
+            for product in products[:3]:
+                CartItem.objects.create(cart=cart, product=product, quantity=2)
+                OrderItem.objects.create(order=order, product=product, price=product.price, quantity=1)
+                Review.objects.create(user=user, product=product, comment='Fine')
+            Payment.objects.create(user=user, amount=Decimal('30.00'))
+
+    #The same number of queries whether the page holds one row or all of them
+    def assertConstantQueries(self, serializer_class, queryset, num):
+        if hasattr(serializer_class, 'setup_eager_loading'):
+            queryset = serializer_class.setup_eager_loading(queryset)
+        for rows in (queryset[:1], queryset):
+            with self.assertNumQueries(num):
+                serializer_class(rows, many=True).data
+
+    def test_serializers_run_a_fixed_number_of_queries(self):
+        budgets = [
+            (ProductSerializer, Product.objects.all(), 1),
+            (OrderSerializer, Order.objects.all(), 2),
+            (CartSerializer, Cart.objects.all(), 2),
+            (CartItemSerializer, CartItem.objects.with_subtotals(), 1),
+            (ReviewSerializer, Review.objects.all(), 1),
+            (PaymentSerializer, Payment.objects.all(), 1),
+            (PublicUserSerializer, CustomUser.objects.all(), 1),
+            (PrivateUserSerializer, CustomUser.objects.all(), 1),
+        ]
+        for serializer_class, queryset, num in budgets:
+            with self.subTest(serializer_class.__name__):
+                self.assertConstantQueries(serializer_class, queryset, num)
+
+    def test_cart_totals_come_from_prefetched_lines(self):
+        carts = CartSerializer.setup_eager_loading(Cart.objects.all())
+        with self.assertNumQueries(2):
+            data = CartSerializer(carts, many=True).data
+        self.assertEqual(data[0]['total_price'], Decimal('60.00'))
+        self.assertEqual(len(data[0]['items']), 3)
+
+
+class SeedAndBenchmarkSuiteTests(TestCase):
+    def test_seed_database_bulk_loads_consistent_data(self):
+        counts = seed_database(users=20, products=50, order_items=200, reviews=30, batch_size=40)
+        self.assertEqual(counts['products'], 50)
+        self.assertEqual(OrderItem.objects.count(), 200)
+        self.assertEqual(Review.objects.count(), 30)
+        self.assertEqual(CustomUser.objects.filter(role='seller').count(), 2)
+        order = Order.objects.filter(user__username__startswith='seed').first()
+        self.assertEqual(order.total, sum(item.price * item.quantity for item in order.orderitem_set.all()))
+
+    def test_seed_data_refuses_to_seed_twice(self):
+        call_command('seed_data', '--users', '2', '--products', '2', '--order-items', '2', '--reviews', '0', stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('seed_data', '--users', '2', stdout=StringIO())
+
+    def test_compare_flags_regressions(self):
+        from .management.commands.benchmark_suite import Command as BenchmarkSuite
+
+        baseline = {'results': {'checkout': {'median_ms': 10.0, 'queries': 12}, 'cart_add': {'median_ms': 2.0, 'queries': 3}}}
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            json.dump(baseline, f)
+            f.flush()
+            command = BenchmarkSuite(stdout=StringIO())
+            command.compare({'checkout': {'median_ms': 11.0, 'queries': 12}, 'cart_add': {'median_ms': 2.0, 'queries': 3}}, f.name, 0.25)
+            with self.assertRaisesMessage(CommandError, 'checkout'):
+                command.compare({'checkout': {'median_ms': 14.0, 'queries': 12}, 'cart_add': {'median_ms': 2.0, 'queries': 3}}, f.name, 0.25)
+            with self.assertRaisesMessage(CommandError, 'cart_add'):
+                command.compare({'checkout': {'median_ms': 10.0, 'queries': 12}, 'cart_add': {'median_ms': 2.0, 'queries': 4}}, f.name, 0.25)
+
+
+class RolePermissionTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = make_user('customer')
+        self.seller = make_user('seller', role='seller')
+        self.other_seller = make_user('other', is_seller=True)
+        self.product = make_product(name='Own lamp', seller=self.seller)
+        self.other_product = make_product(name='Other lamp', seller=self.other_seller)
+
+    def test_create_product_requires_a_seller(self):
+        url = reverse('product-create')
+        self.assertRedirects(self.client.get(url), f"{reverse('login')}?next={url}", fetch_redirect_response=False)
+        self.client.force_login(self.customer)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(self.seller)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_nav_reads_roles_from_the_session(self):
+        self.client.force_login(self.seller)
+        self.assertContains(self.client.get(reverse('home')), reverse('product-create'))
+        #Only the session user lookup, the roles come from the session
+        with self.assertNumQueries(1):
+            self.client.get(reverse('home'))
+
+    def test_role_change_invalidates_cached_roles(self):
+        self.client.force_login(self.customer)
+        self.assertNotContains(self.client.get(reverse('home')), reverse('product-create'))
+        self.customer.role = 'seller'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.customer.save()
+        self.assertContains(self.client.get(reverse('home')), reverse('product-create'))
+
+    def test_unrelated_saves_keep_the_generation(self):
+        self.client.force_login(self.customer)
+        self.client.get(reverse('home'))
+        key = roles.generation_key(self.customer.pk)
+        token = roles.get_cache().get(key)
+        self.assertIsNotNone(token)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.customer.save(update_fields=['last_login'])
+        self.assertEqual(roles.get_cache().get(key), token)
+
+    def test_generation_tokens_are_shared_by_every_worker(self):
+        self.assertEqual(roles.get_cache(), caches[settings.SESSION_CACHE_ALIAS])
+        self.assertNotIn('LocMemCache', type(roles.get_cache()).__name__)
+
+    def test_group_permissions_are_loaded_on_demand_and_invalidated(self):
+        from django.contrib.auth.models import Group, Permission
+
+        group = Group.objects.create(name='editors')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.customer.groups.add(group)
+        self.client.force_login(self.customer)
+        request = self.client.get(reverse('home')).wsgi_request
+        self.assertFalse(roles.get_authorization(request).has_perm('api.change_product'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            group.permissions.add(Permission.objects.get(codename='change_product'))
+        request = self.client.get(reverse('home')).wsgi_request
+        self.assertTrue(roles.get_authorization(request).has_perm('api.change_product'))
+
+    def test_seller_api_is_scoped_to_own_products(self):
+        url = reverse('api-seller-product-list')
+        self.client.force_login(self.customer)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.client.force_login(self.seller)
+        self.assertEqual([row['name'] for row in self.client.get(url).json()['results']], ['Own lamp'])
+        response = self.client.post(url, {'name': 'New lamp', 'description': 'Bright', 'price': '12.00', 'stock': 3, 'category': Product.Categories.HOME})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Product.objects.get(name='New lamp').seller, self.seller)
+        other_url = reverse('api-seller-product-detail', args=[self.other_product.pk])
+        self.assertEqual(self.client.patch(other_url, {'price': '1.00'}, content_type='application/json').status_code, 404)
+
+    def test_admin_is_not_a_role_users_can_give_themselves(self):
+        victim_order = Order.objects.create(user=self.customer)
+        response = self.client.post(reverse('register'), {
+            'username': 'intruder', 'email': 'intruder@example.com', 'role': 'admin',
+            'password1': 'x9!long-enough', 'password2': 'x9!long-enough',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('role', response.context['form'].errors)
+        self.assertFalse(CustomUser.objects.filter(username='intruder').exists())
+
+        #Role stored as admin some other way: still no admin without the staff flags
+        self.client.force_login(make_user('intruder', role='admin'))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('api-sales-report')).status_code, 403)
+        self.assertNotContains(self.client.get(reverse('order-history')), str(victim_order.pk))
+        url = reverse('api-seller-product-detail', args=[self.other_product.pk])
+        self.assertEqual(self.client.patch(url, {'stock': 7}, content_type='application/json').status_code, 403)
+
+    def test_admins_manage_every_product(self):
+        self.client.force_login(make_user('admin', is_staff=True))
+        url = reverse('api-seller-product-detail', args=[self.other_product.pk])
+        response = self.client.patch(url, {'stock': 7}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.other_product.refresh_from_db()
+        self.assertEqual(self.other_product.stock, 7)
+
+
+class ReviewAggregateTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user()
+        self.product = make_product(name='Reviewed lamp')
+
+    def review(self, product=None, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Review.objects.create(user=self.user, product=product or self.product, comment='Nice', **kwargs)
+
+    def test_stats_follow_review_writes(self):
+        first = self.review()
+        second = self.review()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.review_count, 2)
+        self.assertEqual(self.product.last_reviewed_at, second.created)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.review_count, 1)
+        self.assertEqual(self.product.last_reviewed_at, first.created)
+
+    def test_moving_a_review_fixes_both_products(self):
+        other = make_product(name='Other lamp')
+        self.review(other)
+        moved = Review.objects.get(pk=self.review().pk)
+        moved.product = other
+        with self.captureOnCommitCallbacks(execute=True):
+            moved.save()
+        self.product.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((self.product.review_count, self.product.last_reviewed_at), (0, None))
+        self.assertEqual((other.review_count, other.last_reviewed_at), (2, moved.created))
+
+    def test_reviews_of_an_unknown_product_are_404(self):
+        self.assertEqual(self.client.get(reverse('api-product-reviews', args=[uuid.uuid4()])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('api-product-reviews', args=[self.product.pk])).status_code, 200)
+
+    def test_catalog_page_reads_review_counts_with_the_products(self):
+        products = [make_product(name=f'Card {i}') for i in range(47)]
+        for product in products[:10]:
+            self.review(product)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('product-list') + '?page_size=48')
+        self.assertContains(response, '1 review<', count=10)
+
+    def test_cached_pages_show_new_reviews(self):
+        url = reverse('product-detail', args=[self.product.pk])
+        self.assertNotContains(self.client.get(url), 'review')
+        self.review()
+        self.assertContains(self.client.get(url), '1 review,')
+        self.assertEqual(self.client.get(reverse('api-product-detail', args=[self.product.pk])).json()['review_count'], 1)
+
+    def test_review_feed_is_cursor_paginated_with_authors(self):
+        for _ in range(5):
+            self.review()
+        url = reverse('api-product-reviews', args=[self.product.pk]) + '?page_size=2'
+        with self.assertNumQueries(1):
+            page = self.client.get(url).json()
+        self.assertEqual(len(page['results']), 2)
+        self.assertEqual(page['results'][0]['user']['username'], 'shopper')
+        seen = [row['id'] for row in page['results']]
+        while page['next']:
+            page = self.client.get(page['next']).json()
+            seen.extend(row['id'] for row in page['results'])
+        self.assertEqual(seen, sorted(seen, reverse=True))
+        self.assertEqual(len(seen), 5)
+
+    def test_summaries_for_many_products_in_one_query(self):
+        other = make_product(name='Quiet lamp')
+        self.review()
+        ids = f'{self.product.pk},{other.pk},{uuid.uuid4()},nonsense'
+        with self.assertNumQueries(1):
+            results = self.client.get(reverse('api-product-review-summaries') + f'?ids={ids}').json()['results']
+        counts = {row['id']: row['review_count'] for row in results}
+        self.assertEqual(counts, {str(self.product.pk): 1, str(other.pk): 0})
+
+    def test_backfill_fixes_bulk_created_reviews(self):
+        Review.objects.bulk_create([Review(user=self.user, product=self.product, comment='Bulk') for _ in range(3)])
+        out = StringIO()
+        call_command('backfill_review_stats', '--verify', stdout=out)
+        self.assertIn('1 with wrong review stats', out.getvalue())
+        call_command('backfill_review_stats', stdout=StringIO())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.review_count, 3)
+        self.assertIsNotNone(self.product.last_reviewed_at)
+
+
+class OrderHistoryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = make_user()
+        cls.other = make_user('other')
+        product = make_product()
+        cls.orders = []
+        for i in range(30):
+            order = Order.objects.create(user=cls.user, status=Order.Status.SHIPPED if i % 3 == 0 else Order.Status.PAID)
+            OrderItem.objects.create(order=order, product=product, price=Decimal('2.50'), quantity=i % 4 + 1)
+            cls.orders.append(order)
+        Order.objects.create(user=cls.other)
+        #Half of them placed in the same instant, the cursor has to break the ties
+        Order.objects.filter(pk__in=[order.pk for order in cls.orders[:15]]).update(created_at=timezone.now() - timedelta(days=1))
+
+    def test_summaries_annotate_item_count_and_total(self):
+        with self.assertNumQueries(1):
+            rows = {order.pk: order for order in Order.objects.summaries()}
+        self.assertEqual(rows[self.orders[2].pk].item_count, 3)
+        self.assertEqual(rows[self.orders[2].pk].total, Decimal('7.50'))
+
+    def test_history_pages_walk_every_order_once(self):
+        self.client.force_login(self.user)
+        seen = []
+        url = reverse('order-history') + '?page_size=7'
+        while url:
+            with self.assertNumQueries(2):
+                page = self.client.get(url).context['page']
+            seen.extend(order.pk for order in page)
+            url = reverse('order-history') + f'?page_size=7&after={page.next_cursor}' if page.has_next else None
+        self.assertEqual(len(seen), 30)
+        self.assertEqual(set(seen), {order.pk for order in self.orders})
+
+    def test_status_filter_and_staff_view(self):
+        self.client.force_login(self.user)
+        page = self.client.get(reverse('order-history') + '?status=Shipped').context['page']
+        self.assertEqual(len(page), 10)
+
+        self.client.force_login(make_user('staff', is_staff=True))
+        page = self.client.get(reverse('order-history') + '?status=Pending').context['page']
+        self.assertEqual([order.user_id for order in page], [self.other.pk])
+        self.assertEqual(len(self.client.get(reverse('order-history') + '?page_size=100').context['page']), 31)
+
+    def test_html_and_api_agree_on_who_sees_every_order(self):
+        for user, expected in ((make_user('self-made', role='admin'), 0), (make_user('staff', is_staff=True), 31)):
+            self.client.force_login(user)
+            page = self.client.get(reverse('order-history') + '?page_size=100').context['page']
+            api = self.client.get(reverse('api-order-history') + '?page_size=100').json()['results']
+            self.assertEqual((len(page), len(api)), (expected, expected), user.username)
+
+    def test_api_history_returns_summaries(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('api-order-history') + '?status=Shipped&page_size=5')
+        results = response.json()['results']
+        self.assertEqual(len(results), 5)
+        self.assertEqual(set(results[0]), {'order_id', 'user', 'created_at', 'status', 'item_count', 'total'})
+        self.assertTrue(all(row['status'] == 'Shipped' for row in results))
+
+    def test_first_page_reads_the_history_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN is SQLite specific')
+        queryset = Order.objects.summaries().filter(user=self.user).order_by('-created_at', '-pk')[:24]
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join(str(row) for row in cursor.fetchall())
+        self.assertIn('order_user_created_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+@override_settings(PAYMENTS={'WEBHOOK_SECRET': 'test-webhook-secret'})
+class PaymentTests(TestCase):
+    def setUp(self):
+        super().setUp()
+        LocalGateway.reset()
+        self.gateway = LocalGateway()
+        self.user = make_user()
+        self.order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=self.order, product=make_product(), price=Decimal('12.50'), quantity=2)
+        self.order.refresh_from_db()
+
+    def post_webhook(self, events, signature=None):
+        body, valid_signature = self.gateway.webhook(events)
+        return self.client.post(
+            reverse('payment-webhook'), body, content_type='application/json',
+            HTTP_X_PAYMENT_SIGNATURE=signature or valid_signature,
+        )
+
+    def test_charge_job_records_the_payment_and_pays_the_order(self):
+        create_order_payment(str(self.order.pk))
+        create_order_payment(str(self.order.pk))
+        payment = Payment.objects.get()
+        self.assertEqual((payment.order_id, payment.amount, payment.status), (self.order.pk, Decimal('25.00'), 'Completed'))
+        self.assertEqual(payment.gateway, 'local')
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, Order.Status.PAID)
+
+    def test_webhook_redeliveries_and_stale_events_change_nothing(self):
+        charged = self.gateway.charge(self.order, 'tx-1')
+        refunded = self.gateway.update('tx-1', Payment.PaymentStatus.REFUNDED)
+        self.assertEqual(self.post_webhook([refunded]).status_code, 200)
+        #The charge arrives after the refund, and the refund is delivered twice
+        with self.assertNumQueries(6):
+            response = self.post_webhook([charged, refunded, refunded])
+        self.assertEqual(response.json(), {'received': 3, 'unmatched': []})
+        payment = Payment.objects.get(transaction_id='tx-1')
+        self.assertEqual(payment.status, Payment.PaymentStatus.REFUNDED)
+        self.assertEqual(payment.gateway_updated_at, refunded.occurred_at)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, Order.Status.CANCELLED)
+
+    def test_webhook_rejects_bad_signatures_and_payloads(self):
+        event = self.gateway.charge(self.order, 'tx-1')
+        self.assertEqual(self.post_webhook([event], signature='0' * 64).status_code, 403)
+        body = b'{"events": [{"transaction_id": "tx-1", "status": "Bogus"}]}'
+        response = self.client.post(
+            reverse('payment-webhook'), body, content_type='application/json',
+            HTTP_X_PAYMENT_SIGNATURE=self.gateway.sign(body),
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(reverse('payment-webhook')).status_code, 405)
+        self.assertFalse(Payment.objects.exists())
+
+    def test_webhooks_are_rejected_without_a_secret(self):
+        body, signature = self.gateway.webhook([self.gateway.charge(self.order, 'tx-1')])
+        with self.settings(PAYMENTS={}):
+            response = self.client.post(
+                reverse('payment-webhook'), body, content_type='application/json', HTTP_X_PAYMENT_SIGNATURE=signature,
+            )
+            with self.assertRaises(ImproperlyConfigured):
+                self.gateway.sign(body)
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Payment.objects.exists())
+
+    def test_events_for_unknown_orders_are_returned(self):
+        event = PaymentEvent('tx-lost', 'Completed', Decimal('5.00'), timezone.now(), uuid.uuid4())
+        self.assertEqual(apply_events([event]), [event])
+        self.assertFalse(Payment.objects.exists())
+
+    def test_orderless_events_update_the_payment_of_their_transaction(self):
+        apply_events([self.gateway.charge(self.order, 'tx-1')], 'local')
+        refund = PaymentEvent('tx-1', 'Refunded', Decimal('25.00'), timezone.now())
+        unknown = PaymentEvent('tx-other', 'Refunded', Decimal('5.00'), timezone.now())
+        #The owners lookup stays one query for both kinds of events
+        with self.assertNumQueries(1 + 1 + 1 + 1 + 2):
+            self.assertEqual(apply_events([refund, unknown], 'local'), [unknown])
+        payment = Payment.objects.get()
+        self.assertEqual((payment.status, payment.order_id, payment.user_id), ('Refunded', self.order.pk, self.user.pk))
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, Order.Status.CANCELLED)
+
+    def test_reconcile_matches_settlements_in_batches(self):
+        orders = [self.order]
+        for i in range(9):
+            order = Order.objects.create(user=self.user, total=Decimal('10.00'))
+            orders.append(order)
+        events = [self.gateway.charge(order, f'tx-{i}') for i, order in enumerate(orders)]
+        apply_events(events[:5], 'local')
+        self.gateway.update('tx-1', Payment.PaymentStatus.REFUNDED, amount=Decimal('3.00'))
+
+        out = StringIO()
+        call_command('reconcile_payments', '--dry-run', stdout=out)
+        self.assertIn('10 settlements: 5 missing payments, 1 status changes, 1 amount mismatches', out.getvalue())
+        self.assertEqual(Payment.objects.count(), 5)
+
+        #Three batches of: the lookup, the order owners, the upsert, one order update per
+        #payment status in the batch (only the refund adds a second) and the savepoint pair.
+        #The two batches that change orders also queue a sales rollup update.
+        with self.assertNumQueries(3 * 6 + 1 + 2):
+            call_command('reconcile_payments', '--batch-size', '4', stdout=StringIO())
+        self.assertEqual(Payment.objects.filter(status='Completed').count(), 9)
+        self.assertEqual(Order.objects.filter(status=Order.Status.PAID).count(), 9)
+        self.assertEqual(Order.objects.get(pk=orders[1].pk).status, Order.Status.CANCELLED)
+
+        out = StringIO()
+        call_command('reconcile_payments', '--dry-run', stdout=out)
+        self.assertIn('0 missing payments, 0 status changes', out.getvalue())
+
+
+class AdminTests(TestCase):
+    CHANGELISTS = ['customuser', 'product', 'order', 'orderitem', 'cart', 'payment', 'review']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = make_user('admin', is_staff=True, is_superuser=True)
+        cls.seller = make_user('seller', is_seller=True)
+
+    def add_rows(self, count):
+        for i in range(count):
+            user = make_user(f'customer{CustomUser.objects.count()}')
+            product = make_product(name=f'Desk {i}', seller=self.seller)
+            order = Order.objects.create(user=user)
+            OrderItem.objects.create(order=order, product=product, price=Decimal('4.00'), quantity=1)
+            cart = Cart.objects.create(user=user)
+            CartItem.objects.create(cart=cart, product=product)
+            Payment.objects.create(user=user, order=order, amount=Decimal('4.00'), transaction_id=f'admin-{user.pk}')
+            Review.objects.create(user=user, product=product, comment='Sturdy')
+        Order.objects.create()
+        Cart.objects.create(session_key='guest')
+
+    def changelist_queries(self, name, query=''):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(reverse(f'admin:api_{name}_changelist') + query)
+        self.assertEqual(response.status_code, 200)
+        return len(captured)
+
+    def test_changelists_cost_the_same_for_any_number_of_rows(self):
+        self.client.force_login(self.admin)
+        self.add_rows(2)
+        few = {name: self.changelist_queries(name) for name in self.CHANGELISTS}
+        self.add_rows(8)
+        many = {name: self.changelist_queries(name) for name in self.CHANGELISTS}
+        self.assertEqual(few, many)
+
+    def test_change_pages_and_searches(self):
+        self.client.force_login(self.admin)
+        self.add_rows(3)
+        small, large = Order.objects.filter(user__isnull=False)[:2]
+        for product in Product.objects.all():
+            OrderItem.objects.create(order=large, product=product, price=Decimal('1.00'), quantity=2)
+        #The first page also caches the content types
+        self.client.get(reverse('admin:api_order_change', args=[small.pk]))
+        self.assertEqual(
+            self.page_queries(reverse('admin:api_order_change', args=[small.pk])),
+            self.page_queries(reverse('admin:api_order_change', args=[large.pk])),
+        )
+        cart = Cart.objects.filter(user__isnull=False).first()
+        self.client.get(reverse('admin:api_cart_change', args=[cart.pk]))
+        one_line = self.page_queries(reverse('admin:api_cart_change', args=[cart.pk]))
+        for product in Product.objects.exclude(cartitem__cart=cart):
+            CartItem.objects.create(cart=cart, product=product)
+        self.assertEqual(self.page_queries(reverse('admin:api_cart_change', args=[cart.pk])), one_line)
+        self.assertEqual(self.changelist_queries('orderitem', '?q=not-a-uuid'), self.changelist_queries('orderitem', f'?q={small.pk}'))
+        response = self.client.get(reverse('admin:api_product_changelist') + '?q=desk')
+        self.assertEqual(len(response.context['cl'].result_list), 3)
+
+    def page_queries(self, url):
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(captured)
+
+    def test_bulk_actions_are_single_updates(self):
+        self.client.force_login(self.admin)
+        self.add_rows(4)
+        orders = list(Order.objects.values_list('pk', flat=True))
+        with CaptureQueriesContext(connection) as captured:
+            self.client.post(reverse('admin:api_order_changelist'), {'action': 'mark_shipped', '_selected_action': orders})
+        self.assertEqual(Order.objects.filter(status=Order.Status.SHIPPED).count(), len(orders))
+        self.assertEqual(sum(query['sql'].startswith('UPDATE') for query in captured.captured_queries), 1)
+
+        products = list(Product.objects.values_list('pk', flat=True))
+        url = reverse('admin:api_product_changelist')
+        self.client.post(url, {'action': 'set_stock', 'stock': 7, '_selected_action': products})
+        with CaptureQueriesContext(connection) as captured:
+            self.client.post(url, {'action': 'add_stock', 'stock': -10, '_selected_action': products[:2]})
+        self.assertEqual(sum(query['sql'].startswith('UPDATE') for query in captured.captured_queries), 1)
+        self.assertEqual(sorted(Product.objects.values_list('stock', flat=True)), [0, 0, 7, 7])
+
+    def test_unfiltered_order_changelist_reads_an_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN is SQLite specific')
+        queryset = Order.objects.select_related('user').order_by('-created_at', '-order_id')[:50]
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join(str(row) for row in cursor.fetchall())
+        self.assertIn('order_created_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class SalesRollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = make_user()
+        cls.sellers = [make_user(f'seller{i}', is_seller=True) for i in range(2)]
+        cls.admin = make_user('admin', is_staff=True)
+        cls.products = [
+            make_product(seller=cls.sellers[0], category=Product.Categories.BOOKS, price=Decimal('5.00')),
+            make_product(seller=cls.sellers[0], category=Product.Categories.TOYS, price=Decimal('8.00')),
+            make_product(seller=cls.sellers[1], category=Product.Categories.BOOKS, price=Decimal('12.00')),
+            make_product(category=Product.Categories.HOME, price=Decimal('3.00')),
+        ]
+        cls.orders = []
+        for i in range(12):
+            order = Order.objects.create(user=cls.customer)
+            for j, product in enumerate(cls.products):
+                if (i + j) % 3:
+                    OrderItem.objects.create(order=order, product=product, price=product.price, quantity=i % 4 + 1)
+            cls.orders.append(order)
+            Order.objects.filter(pk=order.pk).update(created_at=timezone.now() - timedelta(days=i % 5))
+
+    def live_totals(self):
+        rows = OrderItem.objects.values(
+            category=F('product__category'), seller=F('product__seller'), status=F('order__status')
+        ).annotate(units=Sum('quantity'), revenue=Sum(F('quantity') * F('price')))
+        return {(row['category'], row['seller'], row['status']): (row['units'], row['revenue']) for row in rows}
+
+    def rollup_totals(self):
+        rows = sales_report(group_by=['category', 'seller', 'status'])
+        return {(row['category'], row['seller'], row['status']): (row['units'], row['revenue']) for row in rows}
+
+    def test_incremental_updates_follow_status_changes(self):
+        with self.assertNumQueries(7):
+            self.assertEqual(update_rollups(), 12)
+        self.assertEqual(update_rollups(), 0)
+        self.assertEqual(self.rollup_totals(), self.live_totals())
+
+        #A save queues the order, a queryset update relies on the sweep
+        order = Order.objects.get(pk=self.orders[0].pk)
+        order.status = Order.Status.SHIPPED
+        order.save()
+        self.assertEqual(Job.objects.get().payload, {'order_ids': [str(order.pk)]})
+        Order.objects.filter(pk__in=[order.pk for order in self.orders[5:]]).update(status=Order.Status.PAID)
+        call_command('run_jobs', '--once', '--concurrency', '1', stdout=StringIO())
+        self.assertEqual(update_rollups(), 7)
+        self.assertEqual(self.rollup_totals(), self.live_totals())
+        self.assertFalse(SalesRollup.objects.filter(order_count=0).exists())
+
+        Order.objects.get(pk=self.orders[1].pk).delete()
+        self.assertEqual(self.rollup_totals(), self.live_totals())
+
+    def test_deleting_a_stale_instance_uncounts_the_order(self):
+        stale = Order.objects.get(pk=self.orders[0].pk)
+        update_rollups()
+        stale.delete()
+        self.assertEqual(self.rollup_totals(), self.live_totals())
+
+    def test_line_edits_are_recounted(self):
+        update_rollups()
+        item = OrderItem.objects.filter(order=self.orders[2]).first()
+        item.quantity += 5
+        item.save()
+        OrderItem.objects.create(order=self.orders[2], product=self.products[3], price=Decimal('3.00'), quantity=2)
+        OrderItem.objects.filter(order=self.orders[3]).first().delete()
+        moved = OrderItem.objects.filter(order=self.orders[4]).first()
+        moved.order = self.orders[6]
+        moved.save()
+        self.assertEqual(Order.objects.filter(ROLLUP_PENDING).count(), 4)
+        call_command('run_jobs', '--once', '--concurrency', '1', stdout=StringIO())
+        self.assertFalse(Order.objects.filter(ROLLUP_PENDING).exists())
+        self.assertEqual(self.rollup_totals(), self.live_totals())
+        self.assertFalse(SalesRollup.objects.filter(order_count=0).exists())
+
+    def test_deleting_orders_uncounts_them_in_one_go(self):
+        update_rollups()
+        table = SalesRollup._meta.db_table
+
+        def rollup_queries(orders):
+            with CaptureQueriesContext(connection) as captured:
+                Order.objects.filter(pk__in=[order.pk for order in orders]).delete()
+            #Reads of the buckets: one per uncount, whatever the number of orders
+            return len([query for query in captured if query['sql'].startswith('SELECT') and table in query['sql']])
+
+        self.assertEqual(rollup_queries(self.orders[:2]), 1)
+        self.assertEqual(rollup_queries(self.orders[2:9]), 1)
+        self.assertEqual(self.rollup_totals(), self.live_totals())
+
+    def test_rebuild_in_chunks_matches_the_incremental_rollups(self):
+        update_rollups()
+        Order.objects.filter(pk__in=[order.pk for order in self.orders[::2]]).update(status=Order.Status.DELIVERED)
+        update_rollups()
+        incremental = set(SalesRollup.objects.values_list('day', 'category', 'seller', 'status', 'order_count', 'units', 'revenue'))
+        SalesRollup.objects.all().delete()
+        Order.objects.update(rolled_up_status=None)
+
+        out = StringIO()
+        call_command('rebuild_sales_rollups', '--chunk-days', '2', stdout=out)
+        self.assertIn('Rebuilt the sales rollups', out.getvalue())
+        rebuilt = set(SalesRollup.objects.values_list('day', 'category', 'seller', 'status', 'order_count', 'units', 'revenue'))
+        self.assertEqual(rebuilt, incremental)
+        self.assertFalse(Order.objects.filter(rolled_up_status__isnull=True).exists())
+
+    def test_pending_orders_are_found_through_the_partial_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN is SQLite specific')
+        sql, params = Order.objects.filter(ROLLUP_PENDING).order_by('created_at').values_list('pk')[:100].query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join(str(row) for row in cursor.fetchall())
+        self.assertIn('order_rollup_pending_idx', plan)
+
+    def test_report_api_scopes_sellers_and_validates_filters(self):
+        update_rollups()
+        url = reverse('api-sales-report')
+        self.client.force_login(self.sellers[0])
+        rows = self.client.get(url + '?group_by=seller,category').json()['results']
+        self.assertEqual({row['seller'] for row in rows}, {self.sellers[0].pk})
+        self.assertEqual({row['category'] for row in rows}, {Product.Categories.BOOKS, Product.Categories.TOYS})
+
+        self.client.force_login(self.admin)
+        response = self.client.get(url + f'?group_by=month,status&category=books&seller={self.sellers[1].pk}')
+        self.assertEqual(response.status_code, 200)
+        expected = OrderItem.objects.filter(product=self.products[2]).aggregate(units=Sum('quantity'))['units']
+        self.assertEqual(sum(row['units'] for row in response.json()['results']), expected)
+        for query in ('?group_by=week', '?status=Lost', '?category=nope', '?start=yesterday', '?seller=x'):
+            self.assertEqual(self.client.get(url + query).status_code, 400, query)
+
+        self.client.force_login(self.customer)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        #role='admin' without the staff flags is no admin
+        self.client.force_login(make_user('self-made', role='admin'))
+        self.assertEqual(self.client.get(url).status_code, 403)
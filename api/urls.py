@@ -1,4 +1,5 @@
-from django.urls import path
+from django.urls import path, include
+from rest_framework.routers import DefaultRouter
 from django.contrib.auth import views as auth_views
 from django.contrib.auth.views import LoginView
 from .views import (
@@ -12,9 +13,41 @@ from .views import (
     CartAddView,
     CartUpdateView,
     CartRemoveView,
+    CartBatchUpdateView,
     CheckoutView,
+    OrderHistoryView,
+    metrics_view,
+    payment_webhook,
+)
+from .async_views import (
+    AsyncProductListView,
+    AsyncProductListByCategoryView,
+    AsyncProductDetailView,
+    AsyncCartView,
+    AsyncCartAddView,
+    AsyncCartUpdateView,
+    AsyncCartRemoveView,
+)
+from .viewsets import (
+    ProductViewSet,
+    OrderViewSet,
+    CartViewSet,
+    PaymentViewSet,
+    ReviewViewSet,
+    SellerProductViewSet,
+    ProductSearchView,
+    ProductAutocompleteView,
+    SalesReportView,
 )
 
+router = DefaultRouter()
+router.register('products', ProductViewSet, basename='api-product')
+router.register('orders', OrderViewSet, basename='api-order')
+router.register('carts', CartViewSet, basename='api-cart')
+router.register('payments', PaymentViewSet, basename='api-payment')
+router.register('reviews', ReviewViewSet, basename='api-review')
+router.register('seller/products', SellerProductViewSet, basename='api-seller-product')
+
 urlpatterns = [
     path('', register, name='register'),
     path("home/", home, name="home"),
@@ -29,9 +62,34 @@ urlpatterns = [
     # Cart URLs
     path('cart/', CartView.as_view(), name='cart'),
     path('cart/add/<uuid:pk>/', CartAddView.as_view(), name='cart-add'),
-    path('cart/update/<uuid:pk>/', CartUpdateView.as_view(), name='cart-update'),
-    path('cart/remove/<uuid:pk>/', CartRemoveView.as_view(), name='cart-remove'),
+    path('cart/update/<int:pk>/', CartUpdateView.as_view(), name='cart-update'),
+    path('cart/remove/<int:pk>/', CartRemoveView.as_view(), name='cart-remove'),
+    path('cart/batch/', CartBatchUpdateView.as_view(), name='cart-batch'),
 
     # Checkout
     path('checkout/', CheckoutView.as_view(), name='checkout'),
+
+    # Order history
+    path('orders/', OrderHistoryView.as_view(), name='order-history'),
+
+    # Async (ASGI) versions of the catalog and cart pages
+    path('async/products/', AsyncProductListView.as_view(), name='async-product-list'),
+    path('async/products/category/<str:category>/', AsyncProductListByCategoryView.as_view(), name='async-product-list-by-category'),
+    path('async/products/<uuid:pk>/', AsyncProductDetailView.as_view(), name='async-product-detail'),
+    path('async/cart/', AsyncCartView.as_view(), name='async-cart'),
+    path('async/cart/add/<uuid:pk>/', AsyncCartAddView.as_view(), name='async-cart-add'),
+    path('async/cart/update/<int:pk>/', AsyncCartUpdateView.as_view(), name='async-cart-update'),
+    path('async/cart/remove/<int:pk>/', AsyncCartRemoveView.as_view(), name='async-cart-remove'),
+
+    # Payment gateway callbacks
+    path('payments/webhook/', payment_webhook, name='payment-webhook'),
+
+    # Request metrics (staff only)
+    path('metrics/', metrics_view, name='metrics'),
+
+    # REST API
+    path('api/v1/search/', ProductSearchView.as_view(), name='api-search'),
+    path('api/v1/search/autocomplete/', ProductAutocompleteView.as_view(), name='api-search-autocomplete'),
+    path('api/v1/reports/sales/', SalesReportView.as_view(), name='api-sales-report'),
+    path('api/v1/', include(router.urls)),
 ]
\ No newline at end of file
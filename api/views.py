@@ -3,15 +3,30 @@ from django.views import View
 from django.contrib.auth.decorators import user_passes_test
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.contrib.auth import login
 from .models import Product, Cart, CartItem, Order
 from .forms import ProductForm, CustomUserCreationForm
 from django.contrib import messages
+from django.conf import settings
+from django.views.static import serve as static_serve
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse, JsonResponse
+import json
+from .cache import cached_product, cached_product_page, cached_product_fragment
+from .checkout import checkout_cart, EmptyCartError, OutOfStockError
+from .cart import get_request_cart, add_to_cart, set_item_quantity, remove_item, update_cart_items
+from .pagination import timeline_paginate
+from .payments import apply_events, get_gateway
+from .reservations import InsufficientStockError
+from .roles import get_authorization, seller_required
+from . import metrics
 
 
 def register(request):
     if request.method == "POST":
-        form = CustomUserCreationForm(request.POST)
+        form = CustomUserCreationForm(request.POST, request.FILES)
         if form.is_valid():
             user = form.save()
             login(request, user) # automatically log's the user in after registration
@@ -21,12 +36,42 @@ def register(request):
     return render(request, "api/register.html", {"form": form})
 
 
+#Development media server. Uploaded images and their variants are stored under content
+#hashed names so they can be cached by browsers for a year.
+def media_file(request, path):
+    response = static_serve(request, path, document_root=settings.MEDIA_ROOT)
+    response["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+#Prometheus scrape endpoint for the request metrics collected by metrics.InstrumentationMiddleware
+def metrics_view(request):
+    if not get_authorization(request).has_perm("view_metrics"):
+        raise PermissionDenied
+    return HttpResponse(metrics.registry.render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+#Payment gateway callbacks. They come in bursts and are acknowledged as soon as the events are
+#stored: one upsert keyed on transaction_id (redeliveries and stale events change nothing) plus
+#the order status updates, no session, no per event queries.
+@csrf_exempt
+@require_POST
+def payment_webhook(request):
+    gateway = get_gateway()
+    if not gateway.verify_signature(request.body, request.headers.get(gateway.signature_header, "")):
+        return JsonResponse({"error": "Invalid signature."}, status=403)
+    try:
+        events = gateway.parse_webhook(request.body)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    unmatched = apply_events(events, gateway.name)
+    return JsonResponse({"received": len(events), "unmatched": [event.transaction_id for event in unmatched]})
+
+
 def home(request):
     return render(request, "api/home.html")
 
-def is_seller(user):
-    return user.role == "seller" or user.is_superuser
-
+@seller_required
 def create_product(request):
     if request.method == 'POST':
         form = ProductForm(request.POST, request.FILES)
@@ -44,64 +89,132 @@ def create_product(request):
     return render(request, 'api/product_create.html', {'form': form})
 
 
+def product_cards(page):
+    return [(product, cached_product_fragment(product, "api/includes/product_card.html")) for product in page]
+
+
 class ProductListView(View):
     def get(self, request):
-        products = Product.objects.all()
-        return render(request, "api/product_list.html", {"products": products})
+        page = cached_product_page(request)
+        return render(request, "api/product_list.html", {
+            "products": page,
+            "cards": product_cards(page),
+            "page": page,
+            "categories": Product.Categories.choices,
+        })
 
 class ProductDetailView(View):
     def get(self, request, pk):
-        product = get_object_or_404(Product, pk=pk)
-        return render(request, "api/product_detail.html", {"product": product})
+        product = cached_product(pk)
+        return render(request, "api/product_detail.html", {
+            "product": product,
+            "detail_html": cached_product_fragment(product, "api/includes/product_detail_body.html"),
+        })
 
 class ProductListByCategoryView(View):
     def get(self, request, category):
-        products = Product.objects.filter(category__iexact=category)
-        return render(request, "api/product_list.html", {"products": products, "category": category})
+        current_category = Product.normalize_category(category)
+        if current_category is None:
+            raise Http404("Unknown category")
+        #Exact match on the normalized value so (category, id) index serves filter + ordering
+        page = cached_product_page(request, current_category)
+        return render(request, "api/product_list.html", {
+            "products": page,
+            "cards": product_cards(page),
+            "page": page,
+            "categories": Product.Categories.choices,
+            "current_category": current_category,
+        })
     
 
 
-@method_decorator(login_required, name="dispatch")
+#Cart views work for anonymous visitors too, their cart lives on the session
+#and is merged into the user's cart when they log in (see signals.py)
 class CartView(View):
     def get(self, request):
-        cart, created = Cart.objects.get_or_create(user=request.user)
-        return render(request, "api/cart.html", {"cart": cart})
+        cart = get_request_cart(request, create=request.user.is_authenticated)
+        return render(request, "api/cart.html", {
+            "cart": cart,
+            "cart_items": cart.line_items if cart else [],
+            "total": cart.get_total if cart else 0,
+        })
 
-@method_decorator(login_required, name="dispatch")
 class CartAddView(View):
     def post(self, request, pk):
-        product = get_object_or_404(Product, pk=pk)
-        cart, created = Cart.objects.get_or_create(user=request.user)
-        cart_item, created = CartItem.objects.get_or_create(cart=cart, product=product)
-        cart_item.quantity += 1
-        cart_item.save()
+        cart = get_request_cart(request)
+        try:
+            add_to_cart(cart, pk)
+        except Product.DoesNotExist:
+            raise Http404("Product not found")
+        except InsufficientStockError as e:
+            messages.error(request, str(e))
         return redirect("cart")
 
-@method_decorator(login_required, name="dispatch")
 class CartUpdateView(View):
     def post(self, request, pk):
-        cart_item = get_object_or_404(CartItem, pk=pk, cart__user=request.user)
-        quantity = int(request.POST.get("quantity", 1))
+        try:
+            quantity = int(request.POST.get("quantity", 1))
+        except ValueError:
+            quantity = 0
         if quantity > 0:
-            cart_item.quantity = quantity
-            cart_item.save()
+            cart = get_request_cart(request, create=False)
+            try:
+                if cart is None or not set_item_quantity(cart, pk, quantity):
+                    raise Http404("Cart item not found")
+            except InsufficientStockError as e:
+                messages.error(request, str(e))
         return redirect("cart")
 
-@method_decorator(login_required, name="dispatch")
 class CartRemoveView(View):
     def post(self, request, pk):
-        cart_item = get_object_or_404(CartItem, pk=pk, cart__user=request.user)
-        cart_item.delete()
+        cart = get_request_cart(request, create=False)
+        if cart is None or not remove_item(cart, pk):
+            raise Http404("Cart item not found")
         return redirect("cart")
+
+#Add or update many cart lines in one request.
+#Body: {"items": [{"product": "<uuid>", "quantity": 2}, ...]}, quantity 0 removes the line.
+class CartBatchUpdateView(View):
+    def post(self, request):
+        try:
+            payload = json.loads(request.body)
+            quantities = {item["product"]: item["quantity"] for item in payload["items"]}
+            cart = get_request_cart(request)
+            unknown = update_cart_items(cart, quantities)
+        except InsufficientStockError as e:
+            return JsonResponse({"error": str(e), "product": str(e.product_id), "available": e.available}, status=409)
+        except (ValueError, KeyError, TypeError):
+            return JsonResponse({"error": "Invalid cart payload."}, status=400)
+        return JsonResponse({"updated": len(quantities) - len(unknown), "unknown_products": [str(pk) for pk in unknown]})
     
+#Newest orders first, a page of summaries per query (item counts annotated, no items loaded).
+#Staff see every customer's orders; anyone can narrow them down with ?status=.
+@method_decorator(login_required, name="dispatch")
+class OrderHistoryView(View):
+    def get(self, request):
+        orders = Order.objects.summaries()
+        if not get_authorization(request).has_perm("view_all_orders"):
+            orders = orders.filter(user=request.user)
+        status = request.GET.get("status")
+        if status in Order.Status.values:
+            orders = orders.filter(status=status)
+        else:
+            status = None
+        return render(request, "api/order_history.html", {
+            "page": timeline_paginate(orders, request),
+            "statuses": Order.Status.choices,
+            "current_status": status,
+        })
+
 @method_decorator(login_required, name="dispatch")
 class CheckoutView(View):
     def post(self, request):
         cart = get_object_or_404(Cart, user=request.user)
-        if cart.items.exists():
-            order = Order.objects.create(user=request.user)
-            for item in cart.items.all():
-                order.items.create(product=item.product, quantity=item.quantity)
-            cart.items.all().delete()  # clear cart after checkout
-            return render(request, "api/checkout_success.html", {"order": order})
-        return redirect("cart")
\ No newline at end of file
+        try:
+            order = checkout_cart(cart, request.user)
+        except EmptyCartError:
+            return redirect("cart")
+        except OutOfStockError as e:
+            messages.error(request, str(e))
+            return redirect("cart")
+        return render(request, "api/checkout_success.html", {"order": order})
\ No newline at end of file
@@ -0,0 +1,275 @@
+import hashlib
+import uuid
+from datetime import date, timedelta
+
+from django.http import Http404
+from django.utils import timezone
+from rest_framework import mixins, permissions, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from .analytics import DIMENSIONS, sales_report
+from .cache import catalog_cache, list_scopes, product_scope
+from .mixins import ConditionalGetMixin, EagerLoadingQuerysetMixin, SparseFieldsetViewMixin
+from .models import Cart, Order, Payment, Product, Review
+from .pagination import MAX_PAGE_SIZE, ApiCursorPagination, CartCursorPagination, OrderCursorPagination, ProductCursorPagination, ReviewCursorPagination
+from .roles import HasRole, IsProductSellerOrAdmin, IsSeller, get_authorization
+from .search import get_search_backend
+from .serializers import CartSerializer, OrderSerializer, OrderSummarySerializer, PaymentSerializer, ProductSerializer, ReviewSerializer, ReviewSummarySerializer, SellerProductSerializer
+
+
+#Ids from URLs and query strings, None unless the value is a UUID (in any of its spellings)
+def parse_uuid(value):
+    if not value:
+        return None
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        return None
+
+
+#REST API mounted under /api/v1/ (see urls.py)
+class ApiViewSetMixin(ConditionalGetMixin, SparseFieldsetViewMixin, EagerLoadingQuerysetMixin):
+    pass
+
+
+class ProductViewSet(ApiViewSetMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Product.objects.all()
+    serializer_class = ProductSerializer
+    pagination_class = ProductCursorPagination
+    etag_per_user = False
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        category = Product.normalize_category(self.request.query_params.get('category'))
+        if category:
+            queryset = queryset.filter(category=category)
+        return queryset
+
+    #Serialized payloads and their validators are cached per catalog/product version
+    def cached_payload(self, name, scopes, build):
+        url_hash = hashlib.md5(self.request.build_absolute_uri().encode(), usedforsecurity=False).hexdigest()
+        payload = catalog_cache.get_or_set(catalog_cache.make_key(name, scopes, url_hash), build)
+        return self.respond_conditionally(payload['etag'], payload['last_modified'], lambda: Response(payload['data']))
+
+    def list(self, request, *args, **kwargs):
+        category = Product.normalize_category(request.query_params.get('category'))
+
+        def build():
+            objects = list(self.paginate_queryset(self.filter_queryset(self.get_queryset())))
+            etag, last_modified = self.get_validators(objects)
+            data = self.get_paginated_response(self.get_serializer(objects, many=True).data).data
+            return {'etag': etag, 'last_modified': last_modified, 'data': data}
+
+        return self.cached_payload('api-product-list', list_scopes(category), build)
+
+    #The scope is built from the parsed id: invalidate_product bumps it for the canonical
+    #spelling, so an uppercase or unhyphenated id must not get a scope of its own
+    def retrieve(self, request, *args, **kwargs):
+        product_id = parse_uuid(kwargs[self.lookup_field])
+        if product_id is None:
+            raise Http404("Product not found")
+
+        def build():
+            instance = self.get_object()
+            etag, last_modified = self.get_validators([instance])
+            return {'etag': etag, 'last_modified': last_modified, 'data': self.get_serializer(instance).data}
+
+        return self.cached_payload('api-product', [product_scope(product_id)], build)
+
+    #GET /api/v1/products/<id>/reviews/ newest first, authors joined in the same query
+    @action(detail=True, methods=['get'])
+    def reviews(self, request, pk=None):
+        product_id = parse_uuid(pk)
+        if product_id is None:
+            raise Http404("Product not found")
+        queryset = ReviewSerializer.setup_eager_loading(Review.objects.filter(product_id=product_id))
+        paginator = ReviewCursorPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        #Only an empty page costs the existence check
+        if not page and not Product.objects.filter(pk=product_id).exists():
+            raise Http404("Product not found")
+        return paginator.get_paginated_response(ReviewSerializer(page, many=True).data)
+
+    #GET /api/v1/products/review-summaries/?ids=<id>,<id>,... one query for a whole page of cards
+    @action(detail=False, methods=['get'], url_path='review-summaries')
+    def review_summaries(self, request):
+        ids = [product_id for product_id in map(parse_uuid, request.query_params.get('ids', '').split(',')) if product_id]
+        products = Product.objects.filter(pk__in=ids[:MAX_PAGE_SIZE]).only('id', 'review_count', 'last_reviewed_at')
+        return Response({'results': ReviewSummarySerializer(products, many=True).data})
+
+
+#Product management for sellers: their own products only, admins manage the whole catalog
+class SellerProductViewSet(ApiViewSetMixin, viewsets.ModelViewSet):
+    queryset = Product.objects.all()
+    serializer_class = SellerProductSerializer
+    pagination_class = ProductCursorPagination
+    permission_classes = [IsSeller, IsProductSellerOrAdmin]
+
+    def get_queryset(self):
+        everything = get_authorization(self.request).has_perm('manage_all_products')
+        return super().get_queryset().managed_by(self.request.user, everything=everything)
+
+    def perform_create(self, serializer):
+        serializer.save(seller=self.request.user)
+
+
+#Orders, carts and payments are only visible to their owner (staff see everything)
+#Rows of the requesting user only, unless their roles grant view_all_permission (admins when unset).
+#The HTML pages check the same authorization, so both show the same rows.
+class OwnedQuerysetMixin:
+    owner_field = 'user'
+    view_all_permission = None
+
+    def sees_all(self):
+        authorization = get_authorization(self.request)
+        if self.view_all_permission:
+            return authorization.has_perm(self.view_all_permission)
+        return authorization.has_role('admin')
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.sees_all():
+            return queryset
+        return queryset.filter(**{self.owner_field: self.request.user})
+
+
+class OrderViewSet(ApiViewSetMixin, OwnedQuerysetMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Order.objects.all()
+    serializer_class = OrderSerializer
+    pagination_class = OrderCursorPagination
+    permission_classes = [permissions.IsAuthenticated]
+    view_all_permission = 'view_all_orders'
+
+    #?status=Shipped, served by order_status_created_idx for staff and order_user_created_idx otherwise
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        status = self.request.query_params.get('status')
+        if status in Order.Status.values:
+            queryset = queryset.filter(status=status)
+        return queryset
+
+    def get_serializer_class(self):
+        return OrderSummarySerializer if self.action == 'history' else super().get_serializer_class()
+
+    #GET /api/v1/orders/history/ the same orders as summaries: item count and total, no items
+    @action(detail=False, methods=['get'])
+    def history(self, request):
+        return self.list(request)
+
+
+class CartViewSet(ApiViewSetMixin, OwnedQuerysetMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Cart.objects.all()
+    serializer_class = CartSerializer
+    pagination_class = CartCursorPagination
+    permission_classes = [permissions.IsAuthenticated]
+
+    #Subtotals and the total follow the products' prices, which the cart's own updated_at
+    #doesn't see. The lines and their products are already loaded for the serializer.
+    def object_stamp(self, obj):
+        return max([obj.updated_at] + [item.product.updated_at for item in obj.line_items])
+
+    def object_validator(self, obj, stamp):
+        lines = ','.join(f'{item.product_id}x{item.quantity}={item.subtotal}' for item in obj.line_items)
+        return f'{super().object_validator(obj, stamp)}:{lines}:{obj.get_total}'
+
+
+class PaymentViewSet(ApiViewSetMixin, OwnedQuerysetMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Payment.objects.all()
+    serializer_class = PaymentSerializer
+    pagination_class = ApiCursorPagination
+    permission_classes = [permissions.IsAuthenticated]
+
+
+class ReviewViewSet(ApiViewSetMixin, mixins.CreateModelMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = Review.objects.all()
+    serializer_class = ReviewSerializer
+    pagination_class = ReviewCursorPagination
+    last_modified_field = 'created'
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        product = parse_uuid(self.request.query_params.get('product'))
+        if product:
+            queryset = queryset.filter(product_id=product)
+        return queryset
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user)
+
+
+#GET /api/v1/search/?q=running shoes&category=...&limit=20&offset=0
+#Ranked results plus category and price facet counts for the whole match set
+class ProductSearchView(APIView):
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request):
+        query = request.query_params.get('q', '')
+        category = Product.normalize_category(request.query_params.get('category'))
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 20)), MAX_PAGE_SIZE))
+            offset = max(0, int(request.query_params.get('offset', 0)))
+        except ValueError:
+            limit, offset = 20, 0
+
+        backend = get_search_backend()
+        products = backend.search(query, category=category, limit=limit, offset=offset)
+        return Response({
+            'query': query,
+            'results': ProductSerializer(products, many=True, context={'request': request}).data,
+            'facets': backend.facets(query),
+        })
+
+
+#GET /api/v1/search/autocomplete/?q=run
+class ProductAutocompleteView(APIView):
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request):
+        return Response({'suggestions': get_search_backend().autocomplete(request.query_params.get('q', ''))})
+
+
+def split_param(value):
+    return [part.strip() for part in (value or '').split(',') if part.strip()]
+
+
+#GET /api/v1/reports/sales/?start=2026-01-01&end=2026-12-31&group_by=month,category&status=Paid,Shipped
+#Sums over the sales rollups (see analytics.py), 30 days up to today by default. Also takes
+#comma separated category= and, for admins, seller= user ids; sellers only see their own sales.
+class SalesReportView(APIView):
+    permission_classes = [HasRole]
+    required_roles = ('seller', 'admin')
+
+    def get(self, request):
+        params = request.query_params
+        try:
+            end = date.fromisoformat(params['end']) if params.get('end') else timezone.localdate()
+            start = date.fromisoformat(params['start']) if params.get('start') else end - timedelta(days=29)
+        except ValueError:
+            raise ValidationError({'detail': 'start and end must be YYYY-MM-DD dates.'})
+        group_by = split_param(params.get('group_by')) or ['day']
+        if set(group_by) - DIMENSIONS.keys():
+            raise ValidationError({'group_by': f"Choose from {', '.join(DIMENSIONS)}."})
+        categories = [Product.normalize_category(value) for value in split_param(params.get('category'))]
+        if None in categories:
+            raise ValidationError({'category': 'Unknown category.'})
+        statuses = split_param(params.get('status'))
+        if set(statuses) - set(Order.Status.values):
+            raise ValidationError({'status': f"Choose from {', '.join(Order.Status.values)}."})
+        if get_authorization(request).has_perm('view_all_sales'):
+            try:
+                sellers = [int(value) for value in split_param(params.get('seller'))]
+            except ValueError:
+                raise ValidationError({'seller': 'Seller ids are numbers.'})
+        else:
+            sellers = [request.user.pk]
+
+        rows = sales_report(start, end, group_by, categories, sellers, statuses)
+        return Response({
+            'start': start,
+            'end': end,
+            'group_by': group_by,
+            'results': [dict(row, revenue=str(row['revenue'])) for row in rows],
+        })
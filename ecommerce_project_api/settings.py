@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -42,7 +43,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.metrics.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'api.routers.ReplicaPinMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -53,7 +56,22 @@ MIDDLEWARE = [
 
 CORS_ALLOW_ALL_ORIGINS = True
 
-SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+# Per request timings, query counts and cache hits (api/metrics.py): Server-Timing headers
+# and Prometheus metrics at /metrics/. The middleware removes itself when disabled.
+INSTRUMENTATION = {
+    'ENABLED': bool(os.environ.get('INSTRUMENTATION')),
+    'SERVER_TIMING': True,
+    'SLOW_QUERY_MS': 100,
+    'SAMPLE_SIZE': 1000,
+}
+
+# Sessions are read from the cache and written behind to the database at most once
+# every SESSION_DB_WRITE_INTERVAL seconds; changes in between are flushed by the
+# flush_session job, so run_jobs must be running (see api/sessions.py).
+# 'django.contrib.sessions.backends.signed_cookies' removes server side storage entirely.
+SESSION_ENGINE = 'api.sessions'
+SESSION_CACHE_ALIAS = 'sessions'
+SESSION_DB_WRITE_INTERVAL = 60
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
@@ -69,6 +87,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'api.roles.authorization',
             ],
         },
     },
@@ -83,6 +102,74 @@ STATICFILES_DIRS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+STORAGES = {
+    'default': {
+        'BACKEND': 'api.storage.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
+# Stream every upload to a temporary file instead of holding small ones in memory
+FILE_UPLOAD_HANDLERS = [
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
+# Resized WebP variants of product and profile images (see api/images.py)
+IMAGE_PIPELINE = {
+    'ASYNC': True,
+    'WORKERS': 2,
+    'QUALITY': 80,
+    'SIZES': {'thumb': 160, 'card': 400, 'large': 1200},
+}
+
+# Database job queue (api/jobs.py), run with `python manage.py run_jobs`. Workers refresh
+# the lock of a running job every HEARTBEAT_INTERVAL seconds; a job whose lock is older
+# than LOCK_TIMEOUT lost its worker. Run `python manage.py prune_jobs` from cron to delete
+# done jobs older than RETENTION_DAYS.
+JOB_QUEUE = {
+    'LOCK_TIMEOUT': 300,
+    'HEARTBEAT_INTERVAL': 30,
+    'BACKOFF_BASE': 5,
+    'BACKOFF_MAX': 3600,
+    'RETENTION_DAYS': 7,
+}
+
+# Sellers get an email when checkout leaves a product at or below this many units
+LOW_STOCK_THRESHOLD = 5
+
+# Cart stock holds (api/reservations.py); run `python manage.py sweep_reservations` from cron.
+# CACHE_ALIAS must name a shared cache, see CACHES['sessions'] below.
+STOCK_RESERVATIONS = {
+    'CACHE_ALIAS': 'sessions',
+    'HOLD_TTL': 900,
+    'COUNTER_TIMEOUT': 60,
+}
+
+# Role authorization (api/roles.py): roles and permissions are cached in the session and
+# re-resolved when the per user generation token in this cache is dropped by a role change.
+# CACHE_ALIAS must name a shared cache, see CACHES['sessions'] below.
+ROLE_AUTHORIZATION = {
+    'CACHE_ALIAS': 'sessions',
+}
+
+# Payment gateway (api/payments.py). LocalGateway is an in-process fake; webhooks are signed
+# with WEBHOOK_SECRET, which must be set: without it every webhook is rejected.
+# Run `python manage.py reconcile_payments` from cron.
+PAYMENTS = {
+    'GATEWAY': 'api.payments.LocalGateway',
+    'WEBHOOK_SECRET': os.environ.get('PAYMENT_WEBHOOK_SECRET'),
+    'BATCH_SIZE': 1000,
+}
+
+# Sales rollups (api/analytics.py): kept up to date by the update_sales_rollups job; rebuild
+# or catch up with `python manage.py rebuild_sales_rollups [--pending]`.
+SALES_ROLLUPS = {
+    'BATCH_SIZE': 1000,
+    'CHUNK_DAYS': 31,
+}
+
 WSGI_APPLICATION = 'ecommerce_project_api.wsgi.application'
 
 
@@ -93,9 +180,93 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Keep connections open between requests instead of reconnecting every time.
+        # On Postgres use 'OPTIONS': {'pool': True} (psycopg[pool]) with CONN_MAX_AGE = 0.
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Read replicas (api/routers.py). Catalog and review reads go to REPLICA_DATABASES and
+# writes to default. Locally, DB_REPLICA=1 adds a second SQLite file kept up to date with
+# `python manage.py sync_sqlite_replica --interval 5`.
+REPLICA_DATABASES = []
+REPLICA_READ_MODELS = ['api.product', 'api.review']
+# How long a client that wrote something keeps reading from the primary
+REPLICA_STICKY_SECONDS = 10
+
+if os.environ.get('DB_REPLICA'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db_replica.sqlite3',
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
+        'TEST': {'MIRROR': 'default'},
+    }
+    REPLICA_DATABASES = ['replica']
+
+DATABASE_ROUTERS = ['api.routers.PrimaryReplicaRouter']
+
+# Opt-in SQLite production profile (api/sqlite.py): WAL, synchronous=NORMAL, mmap, a larger
+# page cache and a busy timeout on every connection. Compare with `manage.py benchmark_sqlite`.
+SQLITE_TUNING = {
+    'ENABLED': bool(os.environ.get('SQLITE_TUNED')),
+    'JOURNAL_MODE': 'wal',
+    'SYNCHRONOUS': 'normal',
+    'BUSY_TIMEOUT': 5000,
+    'CACHE_SIZE': -64000,
+    'MMAP_SIZE': 256 * 1024 * 1024,
+    'LOCK_RETRIES': 5,
+}
+
+
+# Cache
+# The shared tier for api.cache; swap for Redis/Memcached in production.
+# api.cache keeps a small per-process LRU in front of it.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ecommerce-default',
+        'TIMEOUT': 600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+    # Sessions, role generation tokens (ROLE_AUTHORIZATION) and stock reservation counters
+    # (STOCK_RESERVATIONS) must be seen by every worker process: in per process memory like
+    # LocMemCache a revoked role would stay valid on the other workers and each worker would
+    # run its own stock admission gate. Hence a file based cache on the local disk; use Redis
+    # when the workers run on more than one host (its atomic incr also makes the reservation
+    # counters exact). Any cache these settings point at needs the same property.
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'sessions',
+        'TIMEOUT': 1209600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+    # Shared tier of the catalog cache (api/cache.py), shared for the same reason as the
+    # sessions so version bumps reach every worker; a directory of its own keeps culling
+    # catalog pages from evicting sessions.
+    'catalog': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'catalog',
+        'TIMEOUT': 600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+
+CATALOG_CACHE = {
+    'CACHE_ALIAS': 'catalog',
+    'TIMEOUT': 600,
+    'LOCAL_MAX_ENTRIES': 1000,
+    'VERSION_TTL': 2,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators